@@ -1,442 +1,317 @@
 import asyncio
+import contextvars
+import functools
+import re
 import uuid
-from typing import Optional
+from pathlib import Path
+from typing import Optional, Union
 
-import aiohttp
+from .comfyui_backend import ComfyUIBackend, ComfyUIJobError  # noqa: F401  供 main.py 等调用方导入
+from .scheduler import JobScheduler
 
+# 当前任务（asyncio 上下文）固定使用的后端：上传图片时选定，提交并取回结果后释放。
+# 上传的文件名只存在于接收它的服务器上，所以同一个任务的上传、提交、取结果必须走同一个后端。
+_pinned_backend: contextvars.ContextVar = contextvars.ContextVar("comfyui_pinned_backend", default=None)
 
-class ComfyUIAPI:
-    def __init__(self, server_url: str = "http://127.0.0.1:8188", timeout: int = 300):
-        self.server_url = server_url
-        self.timeout = timeout
-        # 用 UUID 避免多 AstrBot 实例共享同一 ComfyUI 时 client_id 撞号导致的归属判错
-        self.client_id = uuid.uuid4().hex
-        # 插件级别的异步锁，确保同一时刻只有一个任务进入"等待队列空闲→提交"流程
-        self._submit_lock = asyncio.Lock()
 
-    async def get_queue_info(self) -> dict:
-        """获取 ComfyUI 队列状态（运行中和等待中的任务）
+def releases_job(func):
+    """引擎 generate 方法的装饰器：结束时（包括提前返回、出错或被取消）释放上传阶段固定的后端
 
-        返回格式: {"queue_running": [[prompt_id, workflow, client_id], ...], "queue_pending": [...]}
-        每个队列项为 [prompt_id, prompt_workflow_dict, client_id]
-        """
+    上传后因配置错误提前返回、或在提交前被取消的任务，不会一直计入该后端的负载。
+    """
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f"{self.server_url}/queue") as resp:
-                    if resp.status == 200:
-                        return await resp.json()
-        except Exception:
-            pass
-        return {"queue_running": [], "queue_pending": []}
+            return await func(self, *args, **kwargs)
+        finally:
+            self.api.release_job()
+    return wrapper
 
-    async def is_queue_busy(self) -> bool:
-        """通过 ComfyUI 接口检测队列中是否有未完成的任务"""
-        info = await self.get_queue_info()
-        return len(info.get("queue_running", [])) > 0 or len(info.get("queue_pending", [])) > 0
 
-    def _is_own_task(self, queue_item) -> bool:
-        """判断队列项是否为本插件提交的任务
+class ComfyUIAPI:
+    """ComfyUI 多后端调度入口
+
+    server_url 可以是单个地址、地址列表，或用逗号/空白分隔的多个地址。
+    每个任务被分配到（本插件任务数 + 总任务数）最少的健康后端；
+    请求失败的后端会暂时移出调度，冷却后自动重新探测。
+    对外方法与单后端时保持一致，引擎代码无需感知后端数量。
 
-        ComfyUI 队列项格式为 (number, prompt_id, prompt_workflow_dict, client_id)
-        也可能为 (prompt_id, prompt_workflow_dict, client_id) 旧格式
-        client_id 可能在索引 3 或 2，需要兼容两种格式
+    并发由 JobScheduler 控制：每个可用后端同时保持 max_inflight 个本插件任务，
+    超出的任务按群/用户公平轮转排队。
+    """
+
+    # 记录 prompt_id -> 后端 的上限，用于 queue_prompt 之后按 prompt_id 取结果
+    PROMPT_BACKENDS_LIMIT = 1024
+
+    def __init__(self, server_url: Union[str, list] = "http://127.0.0.1:8188", timeout: int = 300,
+                 pool_size: int = 16, max_inflight: int = 2):
+        self.timeout = timeout
+        self.max_inflight = max(1, int(max_inflight))
+        # 所有后端共用同一个 client_id，便于识别本插件提交的任务
+        self.client_id = uuid.uuid4().hex
+        urls = self._parse_server_urls(server_url) or ["http://127.0.0.1:8188"]
+        self.backends = [ComfyUIBackend(url, timeout, pool_size, client_id=self.client_id) for url in urls]
+        # 负载相同时轮转起点，避免总是落在第一个后端
+        self._rr_offset = 0
+        self._prompt_backends: dict = {}
+        # 已分配到后端但尚未提交的任务数，尚未出现在队列快照里，选择后端时一并计入负载
+        self._assigned: dict = {b: 0 for b in self.backends}
+        self.scheduler = JobScheduler(self._scheduler_capacity)
+
+    @staticmethod
+    def _parse_server_urls(server_url) -> list:
+        if isinstance(server_url, (list, tuple)):
+            parts = [str(u) for u in server_url]
+        else:
+            parts = re.split(r'[,\s]+', str(server_url or ""))
+        urls = []
+        for part in parts:
+            url = part.strip().rstrip("/")
+            if url and url not in urls:
+                urls.append(url)
+        return urls
+
+    @property
+    def server_url(self) -> str:
+        return self.backends[0].server_url
+
+    async def close(self):
+        """关闭所有后端的连接与后台任务"""
+        await asyncio.gather(*(b.close() for b in self.backends), return_exceptions=True)
+
+    # ----- 调度 -----
+
+    def _scheduler_capacity(self) -> int:
+        """本插件可同时在 ComfyUI 上的任务数：每个可用后端 max_inflight 个"""
+        available = sum(1 for b in self.backends if b.is_available())
+        return self.max_inflight * max(1, available)
+
+    async def _select_backend(self) -> ComfyUIBackend:
+        """选择负载最低的健康后端
+
+        负载 = 本插件在该后端的运行/排队任务数 + 该后端全部运行/排队任务数
+        + 已分配但尚未提交的任务数，队列信息来自各后端共享的队列快照。
+        没有健康后端时仍返回一个，让请求本身报错。
         """
+        if len(self.backends) == 1:
+            return self.backends[0]
+
+        from astrbot.api import logger
+        candidates = [b for b in self.backends if b.is_available()] or list(self.backends)
+        infos = await asyncio.gather(*(b.get_queue_info() for b in candidates))
+
+        start = self._rr_offset % len(candidates)
+        self._rr_offset += 1
+        best, best_load = None, None
+        for i in range(len(candidates)):
+            idx = (start + i) % len(candidates)
+            backend = candidates[idx]
+            if not backend.healthy:
+                continue
+            status = backend._summarize_queue(infos[idx])
+            load = (status["own_running"] + status["own_pending"]
+                    + status["total_running"] + status["total_pending"]
+                    + self._assigned.get(backend, 0))
+            if best_load is None or load < best_load:
+                best, best_load = backend, load
+
+        if best is None:
+            logger.warning("[ComfyUI] 没有可用的后端，尝试使用第一个后端")
+            return candidates[0]
+        logger.info(f"[ComfyUI] 任务分配到后端 {best.server_url}（负载 {best_load}）")
+        return best
+
+    async def _job_backend(self) -> ComfyUIBackend:
+        """当前任务已固定后端则复用，否则选择一个并固定"""
+        backend = _pinned_backend.get()
+        if backend is None:
+            backend = await self._select_backend()
+            self._assigned[backend] += 1
+            _pinned_backend.set(backend)
+        return backend
+
+    def _release_backend(self):
+        """任务已提交（已体现在队列快照中）或放弃时释放固定"""
+        backend = _pinned_backend.get()
+        if backend is not None:
+            self._assigned[backend] = max(0, self._assigned[backend] - 1)
+            _pinned_backend.set(None)
+
+    def release_job(self):
+        """放弃当前任务（已上传但不再提交）时释放固定的后端；未固定时无操作"""
+        self._release_backend()
+
+    def _remember_prompt(self, prompt_id: str, backend: ComfyUIBackend):
+        self._prompt_backends[prompt_id] = backend
+        while len(self._prompt_backends) > self.PROMPT_BACKENDS_LIMIT:
+            self._prompt_backends.pop(next(iter(self._prompt_backends)))
+
+    def _backend_for_prompt(self, prompt_id: str) -> ComfyUIBackend:
+        return self._prompt_backends.get(str(prompt_id), self.backends[0])
+
+    # ----- 上传 / 提交 -----
+
+    async def upload_image(self, filename: str, image_data: bytes) -> bool:
+        """上传图片到当前任务固定的后端（尚未固定时先选择后端）"""
+        backend = await self._job_backend()
         try:
-            if isinstance(queue_item, (list, tuple)):
-                # 4元素格式: (number, prompt_id, workflow, client_id)
-                if len(queue_item) >= 4:
-                    return str(queue_item[3]) == self.client_id
-                # 3元素格式: (prompt_id, workflow, client_id)
-                if len(queue_item) >= 3:
-                    return str(queue_item[2]) == self.client_id
+            ok = await backend.upload_image(filename, image_data)
         except Exception:
-            pass
-        return False
+            self._release_backend()
+            raise
+        if not ok:
+            self._release_backend()
+        return ok
 
-    async def get_own_queue_status(self) -> dict:
-        """获取本插件提交的任务在队列中的状态
+    async def upload_input_image(self, image_data: bytes) -> Optional[str]:
+        """按内容哈希上传输入图片到当前任务固定的后端，返回文件名，失败返回 None
 
-        Returns:
-            {"own_running": int, "own_pending": int, "total_running": int, "total_pending": int}
-        """
-        info = await self.get_queue_info()
-        running = info.get("queue_running", [])
-        pending = info.get("queue_pending", [])
-        return {
-            "own_running": sum(1 for item in running if self._is_own_task(item)),
-            "own_pending": sum(1 for item in pending if self._is_own_task(item)),
-            "total_running": len(running),
-            "total_pending": len(pending),
-        }
-
-    def _get_prompt_id_from_item(self, queue_item) -> Optional[str]:
-        """从队列项中提取 prompt_id
-
-        ComfyUI 队列项格式为 (number, prompt_id, prompt_workflow_dict, client_id)
-        也可能为 (prompt_id, prompt_workflow_dict, client_id) 旧格式
-        prompt_id 可能在索引 1 或 0，需要兼容两种格式
+        相同内容在同一后端只上传一次，重复的输入直接复用已上传的文件。
         """
+        backend = await self._job_backend()
         try:
-            if isinstance(queue_item, (list, tuple)):
-                if len(queue_item) >= 4:
-                    return str(queue_item[1])
-                if len(queue_item) >= 1:
-                    return str(queue_item[0])
-        except Exception:
-            pass
-        return None
+            filename = await backend.upload_input_image(image_data)
+        except BaseException:
+            self._release_backend()
+            raise
+        if not filename:
+            self._release_backend()
+        return filename
 
-    async def is_prompt_in_queue(self, prompt_id: str) -> bool:
-        """检测指定 prompt_id 是否仍在 ComfyUI 队列中（运行中或等待中）"""
-        info = await self.get_queue_info()
-        for item in info.get("queue_running", []):
-            if self._get_prompt_id_from_item(item) == str(prompt_id):
-                return True
-        for item in info.get("queue_pending", []):
-            if self._get_prompt_id_from_item(item) == str(prompt_id):
-                return True
-        return False
-
-    async def _wait_queue_idle(self, poll_interval: float = 2.0, max_wait: float = 300.0, on_wait_callback=None) -> float:
-        """轮询等待本插件的任务完成（仅关注本 client_id 提交的任务）
-
-        只在队列中没有本插件提交的运行中任务时才返回，
-        不受外部其他客户端提交的任务影响。
-        超过 max_wait 后放弃等待直接提交，由 ComfyUI 自身队列接管排队。
-
-        Args:
-            poll_interval: 轮询间隔秒数
-            max_wait: 最大等待秒数，超时后放弃排队直接提交任务
-            on_wait_callback: 等待中的回调函数，签名为 async (running: int, pending: int, waited: float) -> None，
-                              每分钟调用一次，用于向用户通知等待状态
+    async def upload_input_images(self, images: list) -> Optional[list]:
+        """并发上传多张输入图片到当前任务固定的后端
 
         Returns:
-            已等待的秒数
+            与 images 顺序一致的文件名列表；任一张上传失败返回 None（已释放固定），出错时抛出第一个异常
         """
-        from astrbot.api import logger
-        waited = 0.0
-        last_notify_time = -60.0  # 初始化为-60，确保首次检测到排队时立即通知
-        while True:
-            status = await self.get_own_queue_status()
-
-            # 只有本插件没有运行中的任务时才返回（允许排队中，因为我们要提交的会排在后面）
-            if status["own_running"] == 0:
-                return waited
-
-            # 超过最大等待时间，放弃排队直接提交
-            if waited >= max_wait:
-                logger.warning(f"[ComfyUI] 队列等待超时（{max_wait:.0f}s），放弃排队直接提交任务")
-                return waited
-
-            logger.info(f"[ComfyUI] 本插件任务运行中，等待... (本插件运行: {status['own_running']}, 本插件排队: {status['own_pending']}, 总运行: {status['total_running']}, 总排队: {status['total_pending']}, 已等待: {waited:.0f}s)")
-
-            # 通过回调通知用户（首次立即通知，之后每隔60秒通知一次）
-            if on_wait_callback and waited - last_notify_time >= 60:
-                last_notify_time = waited
-                try:
-                    await on_wait_callback(status["total_running"], status["total_pending"], waited)
-                except Exception as e:
-                    logger.error(f"[ComfyUI] 队列等待回调异常: {e}")
-
-            await asyncio.sleep(poll_interval)
-            waited += poll_interval
-
-    async def _submit_prompt(self, workflow: dict) -> Optional[str]:
-        """提交任务到 ComfyUI，返回 prompt_id"""
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{self.server_url}/prompt",
-                                    json={"prompt": workflow, "client_id": self.client_id}) as resp:
-                if resp.status == 200:
-                    result = await resp.json()
-                    return result.get("prompt_id")
-                else:
-                    try:
-                        error_detail = await resp.text()
-                        from astrbot.api import logger
-                        logger.error(f"[ComfyUI] 提交任务失败，状态码: {resp.status}, 详情: {error_detail}")
-                    except:
-                        from astrbot.api import logger
-                        logger.error(f"[ComfyUI] 提交任务失败，状态码: {resp.status}")
-        return None
-
-    async def queue_prompt(self, workflow: dict) -> Optional[str]:
+        backend = await self._job_backend()
+        # 后端在当前上下文中先固定好，各上传任务只使用 backend，不读写 _pinned_backend
+        results = await asyncio.gather(*(backend.upload_input_image(data) for data in images),
+                                       return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                self._release_backend()
+                raise result
+        if not all(results):
+            self._release_backend()
+            return None
+        return list(results)
+
+    async def queue_prompt(self, workflow: Union[dict, bytes]) -> Optional[str]:
         """提交任务，返回 prompt_id（仅提交，不等待结果，不经过队列缓冲）"""
-        return await self._submit_prompt(workflow)
-
-    async def _queue_and_wait(self, workflow: dict, fetch_fn, label: str,
-                              max_wait: float = 300.0,
-                              on_wait_callback=None,
-                              on_submitted_callback=None):
-        """提交工作流并通过 fetch_fn 获取结果（带队列缓冲）
-
-        使用 asyncio.Lock 确保同一时刻只有一个任务在"等待队列空闲→提交"流程中，
-        避免 API 检查与提交之间的竞态条件。等待结果在锁外进行，允许后续任务排队。
-
-        Args:
-            workflow: 工作流字典
-            fetch_fn: async (prompt_id, extra_timeout) -> Optional[result] 的回调
-            label: 日志标识，例如 "图片"/"视频"/"文本"
-            max_wait: 队列最大等待秒数，超时后直接提交
-            on_wait_callback: 队列等待回调
-            on_submitted_callback: 提交成功后的回调
-        """
-        from astrbot.api import logger
-
-        async with self._submit_lock:
-            queue_waited = await self._wait_queue_idle(max_wait=max_wait, on_wait_callback=on_wait_callback)
-
-            extra_timeout = 0
-            if queue_waited >= max_wait:
-                info = await self.get_queue_info()
-                pending_count = len(info.get("queue_pending", []))
-                extra_timeout = max(120, pending_count * 60)
-                logger.info(f"[ComfyUI] 强制提交，额外增加结果等待超时 {extra_timeout}s（前方排队: {pending_count}）")
-
-            logger.info(f"[ComfyUI] 开始提交{label}任务")
-            prompt_id = await self._submit_prompt(workflow)
-            if not prompt_id:
-                logger.error("[ComfyUI] 提交任务失败")
-                return None
-
-            await asyncio.sleep(1)
-            queue_position, tasks_ahead, queue_extra = await self._calc_queue_timeout(prompt_id)
-            extra_timeout = max(extra_timeout, queue_extra)
+        backend = await self._job_backend()
+        try:
+            prompt_id = await backend.queue_prompt(workflow)
+        finally:
+            self._release_backend()
+        if prompt_id:
+            self._remember_prompt(prompt_id, backend)
+        return prompt_id
+
+    async def _run_job(self, method: str, workflow: Union[dict, bytes], *args, owner: Optional[tuple] = None,
+                       max_wait: float = 300.0, on_wait_callback=None, on_submitted_callback=None):
+        """经调度器排队后，在当前任务固定的后端上提交并等待结果，结束后归还名额并释放固定"""
+        try:
+            await self.scheduler.acquire(owner, max_wait=max_wait, on_wait_callback=on_wait_callback)
+        except BaseException:
+            self._release_backend()
+            raise
+        try:
+            backend = await self._job_backend()
 
-            if on_submitted_callback:
-                try:
+            async def on_submitted_wrapper(prompt_id: str, queue_position: int, tasks_ahead: int):
+                self._remember_prompt(prompt_id, backend)
+                self._release_backend()
+                if on_submitted_callback:
                     await on_submitted_callback(prompt_id, queue_position, tasks_ahead)
-                except Exception as e:
-                    logger.error(f"[ComfyUI] 提交回调异常: {e}")
 
-        logger.info(f"[ComfyUI] 任务 {prompt_id} 已提交，等待{label}结果...（总超时: {self.timeout + extra_timeout}s）")
-        result = await fetch_fn(prompt_id, extra_timeout)
-
-        if result:
-            logger.info(f"[ComfyUI] 任务 {prompt_id} 完成")
-        else:
-            logger.error(f"[ComfyUI] 任务 {prompt_id} 等待结果超时或失败")
-
-        return result
+            return await getattr(backend, method)(workflow, *args, on_submitted_callback=on_submitted_wrapper)
+        finally:
+            self._release_backend()
+            self.scheduler.release()
+
+    async def queue_and_wait_image(self, workflow: Union[dict, bytes], max_wait: float = 300.0,
+                                   on_wait_callback=None, on_submitted_callback=None,
+                                   owner: Optional[tuple] = None) -> Optional[bytes]:
+        """提交工作流并等待图片结果（经调度器排队）"""
+        return await self._run_job(
+            "queue_and_wait_image", workflow,
+            owner=owner,
+            max_wait=max_wait,
+            on_wait_callback=on_wait_callback,
+            on_submitted_callback=on_submitted_callback,
+        )
 
-    async def queue_and_wait_image(self, workflow: dict, max_wait: float = 300.0,
-                                   on_wait_callback=None, on_submitted_callback=None) -> Optional[bytes]:
-        """提交工作流并等待图片结果（带队列缓冲）"""
-        return await self._queue_and_wait(
-            workflow, self.wait_result, "图片",
+    async def queue_and_wait_video(self, workflow: Union[dict, bytes], max_wait: float = 300.0,
+                                   on_wait_callback=None, on_submitted_callback=None,
+                                   owner: Optional[tuple] = None) -> Optional[bytes]:
+        """提交工作流并等待视频结果（经调度器排队）"""
+        return await self._run_job(
+            "queue_and_wait_video", workflow,
+            owner=owner,
             max_wait=max_wait,
             on_wait_callback=on_wait_callback,
             on_submitted_callback=on_submitted_callback,
         )
 
-    async def queue_and_wait_video(self, workflow: dict, max_wait: float = 300.0,
-                                   on_wait_callback=None, on_submitted_callback=None) -> Optional[bytes]:
-        """提交工作流并等待视频结果（带队列缓冲）"""
-        return await self._queue_and_wait(
-            workflow, self.wait_video_result, "视频",
+    async def queue_and_wait_video_file(self, workflow: Union[dict, bytes], dest_dir, max_wait: float = 300.0,
+                                        on_wait_callback=None, on_submitted_callback=None,
+                                        owner: Optional[tuple] = None) -> Optional[Path]:
+        """提交工作流并把视频结果流式保存到 dest_dir，返回文件路径（经调度器排队）"""
+        return await self._run_job(
+            "queue_and_wait_video_file", workflow, dest_dir,
+            owner=owner,
             max_wait=max_wait,
             on_wait_callback=on_wait_callback,
             on_submitted_callback=on_submitted_callback,
         )
 
-    async def queue_and_wait_text(self, workflow: dict, output_node: str = "",
+    async def queue_and_wait_text(self, workflow: Union[dict, bytes], output_node: str = "",
                                   max_wait: float = 300.0,
-                                  on_wait_callback=None, on_submitted_callback=None) -> Optional[str]:
-        """提交工作流并等待文本结果（带队列缓冲）"""
-        async def fetch(prompt_id: str, extra_timeout: int):
-            return await self.wait_text_result(prompt_id, output_node, extra_timeout=extra_timeout)
-
-        return await self._queue_and_wait(
-            workflow, fetch, "文本",
+                                  on_wait_callback=None, on_submitted_callback=None,
+                                  owner: Optional[tuple] = None) -> Optional[str]:
+        """提交工作流并等待文本结果（经调度器排队）"""
+        return await self._run_job(
+            "queue_and_wait_text", workflow, output_node,
+            owner=owner,
             max_wait=max_wait,
             on_wait_callback=on_wait_callback,
             on_submitted_callback=on_submitted_callback,
         )
 
-    async def wait_video_result(self, prompt_id: str, extra_timeout: int = 0) -> Optional[bytes]:
-        """等待并下载视频结果
+    # ----- 按 prompt_id 取结果 / 查询 -----
 
-        SaveVideo 节点的输出格式类似图片，存储在 outputs[node]["videos"] 中，
-        每项包含 filename / subfolder / type 字段。
-        """
-        total_timeout = self.timeout + extra_timeout
-        loop = asyncio.get_event_loop()
-        deadline = loop.time() + total_timeout
-        async with aiohttp.ClientSession() as session:
-            while loop.time() < deadline:
-                await asyncio.sleep(1)
-                try:
-                    async with session.get(f"{self.server_url}/history/{prompt_id}") as resp:
-                        if resp.status == 200:
-                            history = await resp.json()
-                            if prompt_id in history:
-                                outputs = history[prompt_id].get("outputs", {})
-                                for node_output in outputs.values():
-                                    # 兼容多种字段：videos / gifs / images（部分视频节点输出沿用 images 字段）
-                                    for key in ("videos", "gifs", "images"):
-                                        items = node_output.get(key)
-                                        if not items:
-                                            continue
-                                        for item in items:
-                                            filename = item.get("filename", "")
-                                            # 跳过纯图片输出
-                                            if key == "images" and not self._is_video_filename(filename):
-                                                continue
-                                            url = (
-                                                f"{self.server_url}/view?"
-                                                f"filename={filename}"
-                                                f"&subfolder={item.get('subfolder', '')}"
-                                                f"&type={item.get('type', 'output')}"
-                                            )
-                                            async with session.get(url) as v_resp:
-                                                if v_resp.status == 200:
-                                                    return await v_resp.read()
-                except (aiohttp.ClientError, asyncio.TimeoutError, KeyError):
-                    continue
-        return None
+    async def wait_result(self, prompt_id: str, extra_timeout: int = 0) -> Optional[bytes]:
+        return await self._backend_for_prompt(prompt_id).wait_result(prompt_id, extra_timeout)
 
-    @staticmethod
-    def _is_video_filename(filename: str) -> bool:
-        if not filename:
-            return False
-        lower = filename.lower()
-        return any(lower.endswith(ext) for ext in (".mp4", ".webm", ".mov", ".mkv", ".avi", ".gif"))
+    async def wait_video_result(self, prompt_id: str, extra_timeout: int = 0) -> Optional[bytes]:
+        return await self._backend_for_prompt(prompt_id).wait_video_result(prompt_id, extra_timeout)
 
-    async def _calc_queue_timeout(self, prompt_id: str) -> tuple:
-        """根据任务在队列中的位置计算额外超时
+    async def wait_video_file(self, prompt_id: str, dest_dir, extra_timeout: int = 0) -> Optional[Path]:
+        return await self._backend_for_prompt(prompt_id).wait_video_file(prompt_id, dest_dir, extra_timeout)
 
-        检测提交的任务是否已在运行中：
-        - 如果已在运行，无需额外超时
-        - 如果在排队中，根据前方排队数量计算额外超时
+    async def wait_text_result(self, prompt_id: str, output_node: str = "", extra_timeout: int = 0) -> Optional[str]:
+        return await self._backend_for_prompt(prompt_id).wait_text_result(prompt_id, output_node, extra_timeout)
 
-        Returns:
-            (queue_position, tasks_ahead, extra_timeout)
-            queue_position: 0=已在运行, >0=排队位置(1-based), -1=不在队列
-            tasks_ahead: 前方任务数（运行中+排队前方）
-            extra_timeout: 额外超时秒数
-        """
-        from astrbot.api import logger
-        info = await self.get_queue_info()
-        running = info.get("queue_running", [])
-        pending = info.get("queue_pending", [])
-
-        # 检查任务是否已在运行中
-        for item in running:
-            if self._get_prompt_id_from_item(item) == str(prompt_id):
-                logger.info(f"[ComfyUI] 任务 {prompt_id} 已在运行中，无需额外超时")
-                return (0, 0, 0)
-
-        # 计算任务在排队中的位置（前方有多少个任务）
-        own_position = 0
-        found = False
-        for item in pending:
-            if self._get_prompt_id_from_item(item) == str(prompt_id):
-                found = True
-                break
-            own_position += 1
-
-        if found:
-            # 前方 own_position 个排队任务 + 运行中的任务
-            tasks_ahead = own_position + len(running)
-            extra = max(120, tasks_ahead * 60)
-            logger.info(f"[ComfyUI] 任务 {prompt_id} 在队列第 {own_position + 1} 位（前方 {tasks_ahead} 个任务），额外超时 {extra}s")
-            return (own_position + 1, tasks_ahead, extra)
-        else:
-            # 任务不在队列中（可能已执行完毕或提交失败），不增加超时
-            return (-1, 0, 0)
+    async def is_prompt_in_queue(self, prompt_id: str) -> bool:
+        return await self._backend_for_prompt(prompt_id).is_prompt_in_queue(prompt_id)
 
-    async def wait_result(self, prompt_id: str, extra_timeout: int = 0) -> Optional[bytes]:
-        """等待并下载图片结果
+    async def cancel_prompt(self, prompt_id: str) -> bool:
+        """取消本插件提交的任务（排队中删除、运行中中断），返回是否发出了取消请求
 
-        Args:
-            prompt_id: 任务ID
-            extra_timeout: 额外超时秒数，用于强制提交时补偿队列排队时间
+        queue_and_wait_* 在调用方被取消或等待超时时会自动取消，这里供按 prompt_id 手动取消。
         """
-        total_timeout = self.timeout + extra_timeout
-        loop = asyncio.get_event_loop()
-        deadline = loop.time() + total_timeout
-        async with aiohttp.ClientSession() as session:
-            while loop.time() < deadline:
-                await asyncio.sleep(1)
-                try:
-                    async with session.get(f"{self.server_url}/history/{prompt_id}") as resp:
-                        if resp.status == 200:
-                            history = await resp.json()
-                            if prompt_id in history:
-                                outputs = history[prompt_id].get("outputs", {})
-                                for node_output in outputs.values():
-                                    if "images" in node_output and node_output["images"]:
-                                        img = node_output["images"][0]
-                                        img_url = f"{self.server_url}/view?filename={img['filename']}&subfolder={img['subfolder']}&type={img['type']}"
-                                        async with session.get(img_url) as img_resp:
-                                            if img_resp.status == 200:
-                                                return await img_resp.read()
-                except (aiohttp.ClientError, asyncio.TimeoutError, KeyError):
-                    continue
-        return None
-
-    async def upload_image(self, filename: str, image_data: bytes) -> bool:
-        """上传图片到ComfyUI服务器"""
-        async with aiohttp.ClientSession() as session:
-            data = aiohttp.FormData()
-            data.add_field('image', image_data, filename=filename)
-            async with session.post(f"{self.server_url}/upload/image", data=data) as resp:
-                if resp.status == 200:
-                    return True
-                else:
-                    from astrbot.api import logger
-                    try:
-                        error_detail = await resp.text()
-                        logger.error(f"[ComfyUI] 上传图片失败，状态码: {resp.status}, 详情: {error_detail}")
-                    except:
-                        logger.error(f"[ComfyUI] 上传图片失败，状态码: {resp.status}")
-        return False
+        return await self._backend_for_prompt(prompt_id).cancel_prompt(prompt_id)
 
-    async def wait_text_result(self, prompt_id: str, output_node: str = "", extra_timeout: int = 0) -> Optional[str]:
-        """等待并获取文本结果
+    async def get_own_queue_status(self) -> dict:
+        """汇总所有后端上本插件任务与全部任务的数量"""
+        statuses = await asyncio.gather(*(b.get_own_queue_status() for b in self.backends))
+        total = {"own_running": 0, "own_pending": 0, "total_running": 0, "total_pending": 0}
+        for status in statuses:
+            for key in total:
+                total[key] += status.get(key, 0)
+        return total
 
-        Args:
-            prompt_id: 任务ID
-            output_node: 输出节点ID
-            extra_timeout: 额外超时秒数，用于强制提交时补偿队列排队时间
-        """
-        total_timeout = self.timeout + extra_timeout
-        loop = asyncio.get_event_loop()
-        deadline = loop.time() + total_timeout
-        async with aiohttp.ClientSession() as session:
-            while loop.time() < deadline:
-                await asyncio.sleep(1)
-                try:
-                    async with session.get(f"{self.server_url}/history/{prompt_id}") as resp:
-                        if resp.status == 200:
-                            history = await resp.json()
-                            if prompt_id in history:
-                                outputs = history[prompt_id].get("outputs", {})
-
-                                # 如果指定了输出节点，只查找该节点的输出
-                                if output_node and output_node in outputs:
-                                    node_output = outputs[output_node]
-
-                                    # 检查 string 字段（常见输出）
-                                    if "string" in node_output and node_output["string"]:
-                                        # 如果是数组，返回第一个元素；如果是字符串，直接返回
-                                        return node_output["string"][0] if isinstance(node_output["string"], list) and node_output["string"] else node_output["string"]
-
-                                    # 检查 tags 字段（WD14Tagger 输出）
-                                    if "tags" in node_output and node_output["tags"]:
-                                        # 如果是数组，返回第一个元素；如果是字符串，直接返回
-                                        return node_output["tags"][0] if isinstance(node_output["tags"], list) and node_output["tags"] else node_output["tags"]
-
-                                # 否则查找所有节点的文本输出
-                                for node_output in outputs.values():
-                                    # 检查 string 字段（常见输出）
-                                    if "string" in node_output and node_output["string"]:
-                                        # 如果是数组，返回第一个元素；如果是字符串，直接返回
-                                        return node_output["string"][0] if isinstance(node_output["string"], list) and node_output["string"] else node_output["string"]
-
-                                    # 检查 tags 字段（WD14Tagger 输出）
-                                    if "tags" in node_output and node_output["tags"]:
-                                        # 如果是数组，返回第一个元素；如果是字符串，直接返回
-                                        return node_output["tags"][0] if isinstance(node_output["tags"], list) and node_output["tags"] else node_output["tags"]
-                except (aiohttp.ClientError, asyncio.TimeoutError, KeyError):
-                    continue
-        return None
+    async def is_queue_busy(self) -> bool:
+        status = await self.get_own_queue_status()
+        return status["total_running"] > 0 or status["total_pending"] > 0
@@ -0,0 +1,1030 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Union
+
+import aiohttp
+
+from . import json_codec
+
+
+class ComfyUIJobError(Exception):
+    """ComfyUI 任务失败：节点执行出错、被中断，或任务从队列和 history 中消失
+
+    str(e) 为可直接展示给用户的简短说明，其余字段供日志与调用方判断。
+    kind: "error" / "interrupted" / "vanished"
+    """
+
+    def __init__(self, prompt_id: str, kind: str, message: str, node_id: Optional[str] = None,
+                 node_type: Optional[str] = None, exception_type: Optional[str] = None):
+        super().__init__(message)
+        self.prompt_id = prompt_id
+        self.kind = kind
+        self.node_id = node_id
+        self.node_type = node_type
+        self.exception_type = exception_type
+
+    @classmethod
+    def from_error_data(cls, prompt_id: str, data: dict) -> "ComfyUIJobError":
+        """由 execution_error 的数据（WebSocket 事件或 history 的 status.messages）构造"""
+        data = data if isinstance(data, dict) else {}
+        node_id = data.get("node_id")
+        node_type = data.get("node_type")
+        exception_type = data.get("exception_type")
+        detail = str(data.get("exception_message") or "").strip() or exception_type or "未知错误"
+        where = ""
+        if node_id:
+            where = f"（节点 {node_id} {node_type}）" if node_type else f"（节点 {node_id}）"
+        return cls(prompt_id, "error", f"ComfyUI 执行出错{where}：{detail}",
+                   node_id=node_id, node_type=node_type, exception_type=exception_type)
+
+
+class ComfyUIBackend:
+    """单个 ComfyUI 服务器的客户端：连接池、WebSocket 事件、队列快照与结果获取
+
+    多后端调度由 ComfyUIAPI 负责，一个任务的上传、提交、取结果始终在同一个后端上完成。
+    """
+
+    # 各类请求的单次超时，避免某个卡死的连接长期占用连接池
+    QUEUE_TIMEOUT = aiohttp.ClientTimeout(total=10)
+    HISTORY_TIMEOUT = aiohttp.ClientTimeout(total=10)
+    SUBMIT_TIMEOUT = aiohttp.ClientTimeout(total=30)
+    UPLOAD_TIMEOUT = aiohttp.ClientTimeout(total=120, sock_connect=10)
+    DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=300, sock_connect=10, sock_read=60)
+    KEEPALIVE_TIMEOUT = 60
+
+    # 流式下载输出文件时每次读取的块大小，以及单个输出文件的大小上限
+    DOWNLOAD_CHUNK_SIZE = 256 * 1024
+    MAX_OUTPUT_FILE_BYTES = 512 * 1024 * 1024
+
+    # WebSocket 相关参数
+    WS_HEARTBEAT = 30
+    WS_RECONNECT_MIN_DELAY = 1.0
+    WS_RECONNECT_MAX_DELAY = 30.0
+    # WebSocket 在线时，等待者多久醒来确认一次连接仍然在线（不产生任何请求）
+    WS_RECHECK_INTERVAL = 5.0
+    # WebSocket 离线时退化为 /history 轮询的间隔
+    HISTORY_POLL_INTERVAL = 1.0
+    # 收到完成事件后 history 可能尚未落盘，短间隔重试
+    HISTORY_SETTLE_INTERVAL = 0.25
+    # 已完成但尚无等待者认领的 prompt 记录上限
+    FINISHED_PROMPTS_LIMIT = 256
+    # 收到 execution_error 事件后，history 迟迟查不到时最多再重试的次数，之后直接按事件内容报错
+    ERROR_SETTLE_ATTEMPTS = 8
+    # 任务连续多少次既不在队列也不在 history 中才判定为丢失（避免快照与提交之间的竞态误判）
+    VANISHED_CONFIRMATIONS = 2
+
+    # 记录已上传到该后端的输入图片文件名的上限（LRU 淘汰）
+    UPLOADED_INDEX_LIMIT = 512
+    # 按内容哈希命名的输入图片文件名前缀
+    UPLOAD_NAME_PREFIX = "comfyui_hub"
+
+    # 请求失败后暂时移出调度的秒数，冷却结束后由下一次调度重新探测
+    UNHEALTHY_COOLDOWN = 30.0
+
+    # 队列快照在该秒数内视为新鲜，期间所有调用方共享同一份 /queue 结果
+    QUEUE_SNAPSHOT_MAX_AGE = 1.0
+    # 有订阅者时后台刷新队列快照的间隔（WebSocket 在线时主要由 status 事件触发刷新）
+    QUEUE_MONITOR_INTERVAL = 2.0
+    QUEUE_MONITOR_INTERVAL_WS = 10.0
+
+    def __init__(self, server_url: str = "http://127.0.0.1:8188", timeout: int = 300, pool_size: int = 16,
+                 client_id: Optional[str] = None):
+        self.server_url = server_url.rstrip("/")
+        self.timeout = timeout
+        self.pool_size = max(1, int(pool_size))
+        # 用 UUID 避免多 AstrBot 实例共享同一 ComfyUI 时 client_id 撞号导致的归属判错
+        self.client_id = client_id or uuid.uuid4().hex
+        # 健康状态：请求失败时置为不健康并进入冷却，成功时恢复
+        self.healthy = True
+        self.unhealthy_until = 0.0
+        # 共享的 HTTP 会话，首次使用时创建，插件卸载时由 close() 关闭
+        self._session: Optional[aiohttp.ClientSession] = None
+        # WebSocket 监听任务及连接状态
+        self._ws_task: Optional[asyncio.Task] = None
+        self._ws_connected = asyncio.Event()
+        # 重连后补查等待中任务的后台任务
+        self._resync_task: Optional[asyncio.Task] = None
+        # prompt_id -> 完成事件 future，由 WebSocket 事件唤醒
+        self._prompt_waiters: dict = {}
+        # 事件先于等待者注册到达时暂存，prompt_id -> (事件类型, 事件数据)
+        self._finished_prompts: OrderedDict = OrderedDict()
+        # 队列快照：所有查询队列的调用方共享，由后台监视任务或按需刷新
+        self._queue_snapshot: dict = {"queue_running": [], "queue_pending": []}
+        self._queue_snapshot_at: Optional[float] = None
+        self._queue_refresh_task: Optional[asyncio.Task] = None
+        self._queue_monitor_task: Optional[asyncio.Task] = None
+        self._queue_subscribers = 0
+        # 已上传到该服务器 input 目录的图片（按内容哈希命名），重复输入直接复用
+        self._uploaded: OrderedDict = OrderedDict()
+        # 正在上传中的同名图片，并发的相同输入共享一次上传
+        self._uploading: dict = {}
+        # 正在进行的取消请求，保持引用直到完成
+        self._cancel_tasks: set = set()
+        # 队列可能发生变化（WebSocket status 等事件）时置位，提前唤醒监视任务
+        self._queue_dirty = asyncio.Event()
+        # 每次快照更新后 set 并替换为新的 Event，用于广播给所有订阅者
+        self._queue_updated = asyncio.Event()
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """获取共享的 HTTP 会话（懒加载）
+
+        所有请求复用同一个带 keep-alive 的连接池，避免每次调用都重新握手，
+        也避免大量短连接堆积在 TIME_WAIT 状态。
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                limit_per_host=self.pool_size,
+                keepalive_timeout=self.KEEPALIVE_TIMEOUT,
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self):
+        """停止后台任务（WebSocket 监听、队列监视）并关闭共享的 HTTP 会话，释放连接池"""
+        tasks = [self._ws_task, self._resync_task, self._queue_monitor_task, self._queue_refresh_task]
+        self._ws_task = self._resync_task = self._queue_monitor_task = self._queue_refresh_task = None
+        for task in tasks:
+            if task is not None and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except (asyncio.CancelledError, Exception):
+                    pass
+        session, self._session = self._session, None
+        if session is not None and not session.closed:
+            await session.close()
+
+    # ----- 健康状态 -----
+
+    def _mark_healthy(self):
+        if not self.healthy:
+            from astrbot.api import logger
+            logger.info(f"[ComfyUI] 后端 {self.server_url} 已恢复")
+        self.healthy = True
+
+    def _mark_unhealthy(self, reason):
+        from astrbot.api import logger
+        if self.healthy:
+            logger.warning(f"[ComfyUI] 后端 {self.server_url} 请求失败，暂时移出调度: {reason}")
+        self.healthy = False
+        self.unhealthy_until = asyncio.get_running_loop().time() + self.UNHEALTHY_COOLDOWN
+
+    def is_available(self) -> bool:
+        """健康或冷却已结束（可以重新探测）的后端可参与调度"""
+        return self.healthy or asyncio.get_running_loop().time() >= self.unhealthy_until
+
+    # ----- WebSocket 完成事件 -----
+
+    def _ensure_ws(self):
+        """确保 WebSocket 监听任务在运行（懒启动，断线后由任务自身重连）"""
+        if self._ws_task is None or self._ws_task.done():
+            self._ws_task = asyncio.create_task(self._ws_loop())
+
+    async def _ws_loop(self):
+        """监听 ComfyUI 的 /ws 推送，断线后指数退避重连"""
+        from astrbot.api import logger
+        url = f"{self.server_url}/ws?clientId={self.client_id}"
+        delay = self.WS_RECONNECT_MIN_DELAY
+        while True:
+            try:
+                session = self._get_session()
+                async with session.ws_connect(url, heartbeat=self.WS_HEARTBEAT) as ws:
+                    self._ws_connected.set()
+                    delay = self.WS_RECONNECT_MIN_DELAY
+                    logger.info("[ComfyUI] WebSocket 已连接，使用事件推送跟踪任务完成")
+                    # 断线期间可能漏掉完成事件，重连后对仍在等待的任务各补查一次 history
+                    if self._prompt_waiters and (self._resync_task is None or self._resync_task.done()):
+                        self._resync_task = asyncio.create_task(self._resync_waiters())
+                    async for msg in ws:
+                        if msg.type == aiohttp.WSMsgType.TEXT:
+                            self._handle_ws_message(msg.data)
+                        elif msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                            break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if delay == self.WS_RECONNECT_MIN_DELAY:
+                    logger.warning(f"[ComfyUI] WebSocket 连接失败，回退到 /history 轮询: {e}")
+            finally:
+                self._ws_connected.clear()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.WS_RECONNECT_MAX_DELAY)
+
+    def _handle_ws_message(self, raw: str):
+        """解析 WebSocket 文本消息，在任务结束时唤醒对应的等待者
+
+        - execution_success / execution_error / execution_interrupted：任务结束
+        - executing 且 node 为 None：旧版 ComfyUI 的任务结束信号
+        二进制消息（预览图）不在这里处理。
+        """
+        try:
+            message = json_codec.loads(raw)
+        except (TypeError, ValueError):
+            return
+        if not isinstance(message, dict):
+            return
+        msg_type = message.get("type")
+        data = message.get("data") or {}
+        # 队列长度变化或任务开始/结束都会影响队列快照
+        if msg_type in ("status", "execution_start", "execution_success",
+                        "execution_error", "execution_interrupted"):
+            self._queue_dirty.set()
+        prompt_id = data.get("prompt_id") if isinstance(data, dict) else None
+        if not prompt_id:
+            return
+        if msg_type in ("execution_success", "execution_error", "execution_interrupted"):
+            self._finish_prompt(str(prompt_id), msg_type, data)
+        elif msg_type == "executing" and data.get("node") is None:
+            self._finish_prompt(str(prompt_id), "execution_success")
+
+    def _finish_prompt(self, prompt_id: str, event_type: str, data: Optional[dict] = None):
+        """标记任务结束；等待者尚未注册时先暂存，避免提交后立刻完成的任务漏掉事件"""
+        result = (event_type, data or {})
+        future = self._prompt_waiters.get(prompt_id)
+        if future is not None:
+            if not future.done():
+                future.set_result(result)
+            return
+        self._finished_prompts[prompt_id] = result
+        self._finished_prompts.move_to_end(prompt_id)
+        while len(self._finished_prompts) > self.FINISHED_PROMPTS_LIMIT:
+            self._finished_prompts.popitem(last=False)
+
+    async def _resync_waiters(self):
+        """对仍在等待的任务逐个补查 history，已完成的直接唤醒"""
+        try:
+            for prompt_id in list(self._prompt_waiters.keys()):
+                entry = await self._fetch_history_entry(prompt_id)
+                if entry is not None:
+                    self._finish_prompt(prompt_id, "history")
+        except Exception as e:
+            from astrbot.api import logger
+            logger.warning(f"[ComfyUI] 重连后补查任务状态失败: {e}")
+
+    async def _request_history(self, prompt_id: str) -> Optional[dict]:
+        """请求一次 /history/{prompt_id}，返回整个响应字典；请求失败返回 None
+
+        任务尚未结束（或不存在）时 ComfyUI 返回空字典，与请求失败区分开。
+        """
+        try:
+            session = self._get_session()
+            async with session.get(f"{self.server_url}/history/{prompt_id}", timeout=self.HISTORY_TIMEOUT) as resp:
+                if resp.status == 200:
+                    history = await resp.json()
+                    return history if isinstance(history, dict) else None
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            pass
+        return None
+
+    async def _fetch_history_entry(self, prompt_id: str) -> Optional[dict]:
+        """查询一次 /history/{prompt_id}，任务尚未结束时返回 None"""
+        history = await self._request_history(prompt_id)
+        return history.get(prompt_id) if history else None
+
+    @staticmethod
+    def _raise_for_history_status(prompt_id: str, entry: dict):
+        """检查 history 记录中的执行状态，出错或被中断时抛出 ComfyUIJobError
+
+        status 格式: {"status_str": "success"/"error", "completed": bool,
+                      "messages": [[事件类型, 事件数据], ...]}
+        """
+        status = entry.get("status") or {}
+        if not isinstance(status, dict):
+            return
+        for message in status.get("messages") or []:
+            if not isinstance(message, (list, tuple)) or len(message) < 2:
+                continue
+            event_type, data = message[0], message[1]
+            if event_type == "execution_error":
+                raise ComfyUIJobError.from_error_data(prompt_id, data)
+            if event_type == "execution_interrupted":
+                node_id = data.get("node_id") if isinstance(data, dict) else None
+                node_type = data.get("node_type") if isinstance(data, dict) else None
+                raise ComfyUIJobError(prompt_id, "interrupted", "任务已被 ComfyUI 中断",
+                                      node_id=node_id, node_type=node_type)
+        if status.get("status_str") == "error":
+            raise ComfyUIJobError(prompt_id, "error", "ComfyUI 执行出错")
+
+    async def _is_prompt_queued(self, prompt_id: str) -> Optional[bool]:
+        """任务是否在队列中（运行中或等待中）；/queue 请求失败时返回 None（无法判断）"""
+        info = await self.get_queue_info()
+        if not self.healthy:
+            return None
+        return self._find_in_queue(info, prompt_id)
+
+    def _find_in_queue(self, info: dict, prompt_id: str) -> bool:
+        for key in ("queue_running", "queue_pending"):
+            for item in info.get(key, []):
+                if self._get_prompt_id_from_item(item) == str(prompt_id):
+                    return True
+        return False
+
+    async def _wait_history(self, prompt_id: str, extra_timeout: int = 0) -> Optional[dict]:
+        """等待任务结束并返回其 history 记录，超时返回 None
+
+        WebSocket 在线时只等待完成事件，任务结束后才查询一次 /history；
+        WebSocket 离线时退化为每秒轮询 /history。
+        任务执行出错、被中断，或既不在队列也不在 history 中（例如 ComfyUI 重启）时
+        立即抛出 ComfyUIJobError，不再等到超时。
+        """
+        total_timeout = self.timeout + extra_timeout
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + total_timeout
+        self._ensure_ws()
+
+        future = loop.create_future()
+        if prompt_id in self._finished_prompts:
+            future.set_result(self._finished_prompts.pop(prompt_id))
+        self._prompt_waiters[prompt_id] = future
+        misses = 0
+        settle_attempts = 0
+        try:
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return None
+                if not future.done() and self._ws_connected.is_set():
+                    try:
+                        await asyncio.wait_for(asyncio.shield(future),
+                                               timeout=min(remaining, self.WS_RECHECK_INTERVAL))
+                    except asyncio.TimeoutError:
+                        # 没有事件时顺带确认任务仍在队列中：队列快照是共享的，只有不在队列时才查 history
+                        if await self._is_prompt_queued(prompt_id) is False:
+                            misses = self._count_vanished(prompt_id, misses, await self._request_history(prompt_id))
+                        else:
+                            misses = 0
+                        continue
+
+                history = await self._request_history(prompt_id)
+                entry = history.get(prompt_id) if history else None
+                if entry is not None:
+                    self._raise_for_history_status(prompt_id, entry)
+                    return entry
+
+                if future.done():
+                    # 已收到结束事件，history 可能尚未落盘；错误事件等不到 history 时直接按事件报错
+                    settle_attempts += 1
+                    event_type, data = future.result()
+                    if event_type == "execution_error" and settle_attempts >= self.ERROR_SETTLE_ATTEMPTS:
+                        raise ComfyUIJobError.from_error_data(prompt_id, data)
+                    if event_type == "execution_interrupted" and settle_attempts >= self.ERROR_SETTLE_ATTEMPTS:
+                        raise ComfyUIJobError(prompt_id, "interrupted", "任务已被 ComfyUI 中断")
+                    interval = self.HISTORY_SETTLE_INTERVAL
+                else:
+                    if history is not None and await self._is_prompt_queued(prompt_id) is False:
+                        misses = self._count_vanished(prompt_id, misses, history)
+                    else:
+                        misses = 0
+                    interval = self.HISTORY_POLL_INTERVAL
+                await asyncio.sleep(min(interval, max(0.0, deadline - loop.time())))
+        finally:
+            self._prompt_waiters.pop(prompt_id, None)
+
+    def _count_vanished(self, prompt_id: str, misses: int, history: Optional[dict]) -> int:
+        """累计任务既不在队列也不在 history 中的次数，达到阈值时抛出 ComfyUIJobError
+
+        history 为 None 表示请求失败，无法判断，计数清零。
+        """
+        if history is None:
+            return 0
+        if prompt_id in history:
+            # 恰好在两次查询之间完成，交给下一轮正常读取
+            return misses
+        misses += 1
+        if misses >= self.VANISHED_CONFIRMATIONS:
+            raise ComfyUIJobError(prompt_id, "vanished", "任务已从 ComfyUI 队列中消失（服务器可能已重启）")
+        return misses
+
+    async def _download_output(self, item: dict) -> Optional[bytes]:
+        """通过 /view 下载一个输出文件，失败返回 None"""
+        params = {
+            "filename": item.get("filename", ""),
+            "subfolder": item.get("subfolder", ""),
+            "type": item.get("type", "output"),
+        }
+        try:
+            session = self._get_session()
+            async with session.get(f"{self.server_url}/view", params=params,
+                                   timeout=self.DOWNLOAD_TIMEOUT) as resp:
+                if resp.status == 200:
+                    return await resp.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pass
+        return None
+
+    async def _download_output_to_file(self, item: dict, dest_dir) -> Optional[Path]:
+        """通过 /view 把一个输出文件分块流式写入 dest_dir 下的临时文件，返回路径，失败返回 None
+
+        文件内容不会整体进入内存；超过 MAX_OUTPUT_FILE_BYTES 时放弃并删除临时文件。
+        各块通过 asyncio.to_thread 写入，磁盘写入不阻塞事件循环。
+        """
+        from astrbot.api import logger
+        params = {
+            "filename": item.get("filename", ""),
+            "subfolder": item.get("subfolder", ""),
+            "type": item.get("type", "output"),
+        }
+        suffix = Path(params["filename"]).suffix or ".bin"
+        fd, path = tempfile.mkstemp(prefix="comfyui_", suffix=suffix, dir=str(dest_dir))
+        written = 0
+        ok = False
+        try:
+            with os.fdopen(fd, "wb") as f:
+                session = self._get_session()
+                async with session.get(f"{self.server_url}/view", params=params,
+                                       timeout=self.DOWNLOAD_TIMEOUT) as resp:
+                    if resp.status != 200:
+                        return None
+                    if (resp.content_length or 0) > self.MAX_OUTPUT_FILE_BYTES:
+                        logger.error(f"[ComfyUI] 输出文件过大（{resp.content_length} 字节），放弃下载")
+                        return None
+                    async for chunk in resp.content.iter_chunked(self.DOWNLOAD_CHUNK_SIZE):
+                        written += len(chunk)
+                        if written > self.MAX_OUTPUT_FILE_BYTES:
+                            logger.error(f"[ComfyUI] 输出文件超过 {self.MAX_OUTPUT_FILE_BYTES} 字节，放弃下载")
+                            return None
+                        await asyncio.to_thread(f.write, chunk)
+            ok = True
+            return Path(path)
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            logger.error(f"[ComfyUI] 下载输出文件失败: {e}")
+            return None
+        finally:
+            if not ok:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+    async def get_queue_info(self, max_age: Optional[float] = None) -> dict:
+        """获取 ComfyUI 队列状态（运行中和等待中的任务）
+
+        返回格式: {"queue_running": [[prompt_id, workflow, client_id], ...], "queue_pending": [...]}
+        每个队列项为 [prompt_id, prompt_workflow_dict, client_id]
+
+        读取共享的队列快照；快照超过 max_age 秒（默认 QUEUE_SNAPSHOT_MAX_AGE）才会刷新，
+        并发的刷新请求会合并为一次 /queue 调用。
+        """
+        if max_age is None:
+            max_age = self.QUEUE_SNAPSHOT_MAX_AGE
+        if self._queue_snapshot_at is not None:
+            age = asyncio.get_running_loop().time() - self._queue_snapshot_at
+            if age <= max_age:
+                return self._queue_snapshot
+        return await self._refresh_queue()
+
+    async def _refresh_queue(self) -> dict:
+        """刷新队列快照；已有刷新在进行时直接等待其结果"""
+        task = self._queue_refresh_task
+        if task is None or task.done():
+            task = asyncio.create_task(self._fetch_queue())
+            self._queue_refresh_task = task
+        return await asyncio.shield(task)
+
+    async def _fetch_queue(self) -> dict:
+        """请求一次 /queue 并广播新的快照，失败时视为空队列"""
+        info = {"queue_running": [], "queue_pending": []}
+        try:
+            session = self._get_session()
+            async with session.get(f"{self.server_url}/queue", timeout=self.QUEUE_TIMEOUT) as resp:
+                if resp.status == 200:
+                    info = await resp.json()
+                    self._mark_healthy()
+                else:
+                    self._mark_unhealthy(f"/queue 状态码 {resp.status}")
+        except Exception as e:
+            self._mark_unhealthy(e)
+        self._queue_snapshot = info
+        self._queue_snapshot_at = asyncio.get_running_loop().time()
+        updated, self._queue_updated = self._queue_updated, asyncio.Event()
+        updated.set()
+        return info
+
+    def _ensure_queue_monitor(self):
+        if self._queue_monitor_task is None or self._queue_monitor_task.done():
+            self._queue_monitor_task = asyncio.create_task(self._queue_monitor_loop())
+
+    async def _queue_monitor_loop(self):
+        """后台队列监视：有订阅者时定时（或被 WebSocket 事件提前唤醒）刷新快照，无订阅者时退出"""
+        while self._queue_subscribers > 0:
+            interval = (self.QUEUE_MONITOR_INTERVAL_WS if self._ws_connected.is_set()
+                        else self.QUEUE_MONITOR_INTERVAL)
+            try:
+                await asyncio.wait_for(self._queue_dirty.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+            self._queue_dirty.clear()
+            if self._queue_subscribers > 0:
+                await self._refresh_queue()
+
+    async def wait_queue_update(self, timeout: float) -> dict:
+        """订阅队列变化：等待下一次快照更新（最多 timeout 秒）后返回最新快照"""
+        updated = self._queue_updated
+        self._queue_subscribers += 1
+        self._ensure_ws()
+        self._ensure_queue_monitor()
+        try:
+            await asyncio.wait_for(updated.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self._queue_subscribers -= 1
+        return self._queue_snapshot
+
+    async def is_queue_busy(self) -> bool:
+        """通过 ComfyUI 接口检测队列中是否有未完成的任务"""
+        info = await self.get_queue_info()
+        return len(info.get("queue_running", [])) > 0 or len(info.get("queue_pending", [])) > 0
+
+    def _is_own_task(self, queue_item) -> bool:
+        """判断队列项是否为本插件提交的任务
+
+        ComfyUI 队列项格式为 (number, prompt_id, prompt_workflow_dict, client_id)
+        也可能为 (prompt_id, prompt_workflow_dict, client_id) 旧格式
+        client_id 可能在索引 3 或 2，需要兼容两种格式
+        """
+        try:
+            if isinstance(queue_item, (list, tuple)):
+                # 4元素格式: (number, prompt_id, workflow, client_id)
+                if len(queue_item) >= 4:
+                    return self._client_id_of(queue_item[3]) == self.client_id
+                # 3元素格式: (prompt_id, workflow, client_id)
+                if len(queue_item) >= 3:
+                    return self._client_id_of(queue_item[2]) == self.client_id
+        except Exception:
+            pass
+        return False
+
+    @staticmethod
+    def _client_id_of(value) -> str:
+        """client_id 字段可能是字符串，也可能是 extra_data 字典 {"client_id": ...}"""
+        if isinstance(value, dict):
+            return str(value.get("client_id", ""))
+        return str(value)
+
+    async def get_own_queue_status(self) -> dict:
+        """获取本插件提交的任务在队列中的状态
+
+        Returns:
+            {"own_running": int, "own_pending": int, "total_running": int, "total_pending": int}
+        """
+        return self._summarize_queue(await self.get_queue_info())
+
+    def _summarize_queue(self, info: dict) -> dict:
+        """根据队列快照统计本插件与全部任务的运行/排队数量"""
+        running = info.get("queue_running", [])
+        pending = info.get("queue_pending", [])
+        return {
+            "own_running": sum(1 for item in running if self._is_own_task(item)),
+            "own_pending": sum(1 for item in pending if self._is_own_task(item)),
+            "total_running": len(running),
+            "total_pending": len(pending),
+        }
+
+    def _get_prompt_id_from_item(self, queue_item) -> Optional[str]:
+        """从队列项中提取 prompt_id
+
+        ComfyUI 队列项格式为 (number, prompt_id, prompt_workflow_dict, client_id)
+        也可能为 (prompt_id, prompt_workflow_dict, client_id) 旧格式
+        prompt_id 可能在索引 1 或 0，需要兼容两种格式
+        """
+        try:
+            if isinstance(queue_item, (list, tuple)):
+                if len(queue_item) >= 4:
+                    return str(queue_item[1])
+                if len(queue_item) >= 1:
+                    return str(queue_item[0])
+        except Exception:
+            pass
+        return None
+
+    async def is_prompt_in_queue(self, prompt_id: str) -> bool:
+        """检测指定 prompt_id 是否仍在 ComfyUI 队列中（运行中或等待中）"""
+        return self._find_in_queue(await self.get_queue_info(), prompt_id)
+
+    async def cancel_prompt(self, prompt_id: str) -> bool:
+        """取消本插件提交的任务：排队中的从队列删除，运行中的发送中断
+
+        只处理 client_id 属于本插件的任务，不会误伤其他客户端的任务。
+        /interrupt 会同时带上 prompt_id：新版 ComfyUI 只中断该任务，
+        旧版忽略参数中断当前任务（此前已确认当前运行的正是它）。
+
+        Returns:
+            是否成功发出了取消请求（任务已结束或不在队列中时返回 False）
+        """
+        from astrbot.api import logger
+        info = await self.get_queue_info(max_age=0)
+        targets = (
+            ("queue_pending", "/queue", {"delete": [prompt_id]}, "从队列删除"),
+            ("queue_running", "/interrupt", {"prompt_id": prompt_id}, "中断"),
+        )
+        for key, path, payload, action in targets:
+            for item in info.get(key, []):
+                if self._get_prompt_id_from_item(item) != str(prompt_id):
+                    continue
+                if not self._is_own_task(item):
+                    logger.warning(f"[ComfyUI] 任务 {prompt_id} 不属于本插件，不取消")
+                    return False
+                try:
+                    session = self._get_session()
+                    async with session.post(f"{self.server_url}{path}", json=payload,
+                                            timeout=self.QUEUE_TIMEOUT) as resp:
+                        ok = resp.status == 200
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    logger.warning(f"[ComfyUI] 取消任务 {prompt_id} 失败: {e}")
+                    return False
+                self._queue_dirty.set()
+                if ok:
+                    logger.info(f"[ComfyUI] 已{action}任务 {prompt_id}")
+                else:
+                    logger.warning(f"[ComfyUI] {action}任务 {prompt_id} 失败，状态码: {resp.status}")
+                return ok
+        return False
+
+    async def _cancel_abandoned(self, prompt_id: str):
+        """请求被放弃（取消或超时）后取消对应任务
+
+        取消请求放在独立任务中并 shield，调用方再次被取消也不会打断它。
+        """
+        task = asyncio.create_task(self.cancel_prompt(prompt_id))
+        self._cancel_tasks.add(task)
+        task.add_done_callback(self._cancel_tasks.discard)
+        try:
+            await asyncio.shield(task)
+        except (asyncio.CancelledError, Exception):
+            pass
+
+    def _cancel_after_submit(self, submit: asyncio.Future):
+        """提交过程中被放弃的请求：提交成功后取消得到的任务"""
+        if submit.cancelled() or submit.exception() is not None or not submit.result():
+            return
+        task = asyncio.ensure_future(self.cancel_prompt(submit.result()))
+        self._cancel_tasks.add(task)
+        task.add_done_callback(self._cancel_tasks.discard)
+
+    def _encode_submit_body(self, workflow: Union[dict, bytes]) -> bytes:
+        """构造 /prompt 请求体；workflow 可以是字典，也可以是已编码好的工作流 JSON bytes"""
+        if isinstance(workflow, (bytes, bytearray)):
+            return (b'{"prompt":' + bytes(workflow)
+                    + b',"client_id":' + json_codec.dumps(self.client_id) + b'}')
+        return json_codec.dumps({"prompt": workflow, "client_id": self.client_id})
+
+    async def _submit_prompt(self, workflow: Union[dict, bytes]) -> Optional[str]:
+        """提交任务到 ComfyUI，返回 prompt_id"""
+        session = self._get_session()
+        try:
+            resp = await session.post(f"{self.server_url}/prompt",
+                                      data=self._encode_submit_body(workflow),
+                                      headers={"Content-Type": "application/json"},
+                                      timeout=self.SUBMIT_TIMEOUT)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            self._mark_unhealthy(e)
+            raise
+        async with resp:
+            if resp.status == 200:
+                result = await resp.json()
+                return result.get("prompt_id")
+            else:
+                # 校验失败可能是已上传的输入图片被清理，清空索引让之后的请求重新上传
+                self._uploaded.clear()
+                try:
+                    error_detail = await resp.text()
+                    from astrbot.api import logger
+                    logger.error(f"[ComfyUI] 提交任务失败，状态码: {resp.status}, 详情: {error_detail}")
+                except:
+                    from astrbot.api import logger
+                    logger.error(f"[ComfyUI] 提交任务失败，状态码: {resp.status}")
+        return None
+
+    async def queue_prompt(self, workflow: Union[dict, bytes]) -> Optional[str]:
+        """提交任务，返回 prompt_id（仅提交，不等待结果，不经过队列缓冲）"""
+        return await self._submit_prompt(workflow)
+
+    async def _queue_and_wait(self, workflow: Union[dict, bytes], fetch_fn, label: str,
+                              extra_timeout: int = 0,
+                              on_submitted_callback=None):
+        """提交工作流并通过 fetch_fn 获取结果
+
+        并发数量与排队顺序由 ComfyUIAPI 的调度器控制，这里只负责提交、
+        根据队列位置补偿超时并等待结果。请求被取消（asyncio 任务取消）或等待超时时，
+        会把任务从 ComfyUI 队列删除或中断，不再占用 GPU。
+
+        Args:
+            workflow: 工作流字典，或 WorkflowPatch.encode() 得到的工作流 JSON bytes
+            fetch_fn: async (prompt_id, extra_timeout) -> Optional[result] 的回调
+            label: 日志标识，例如 "图片"/"视频"/"文本"
+            extra_timeout: 额外的结果等待超时（例如调度排队超时后强制提交）
+            on_submitted_callback: 提交成功后的回调
+        """
+        from astrbot.api import logger
+
+        logger.info(f"[ComfyUI] 开始提交{label}任务")
+        submit = asyncio.ensure_future(self._submit_prompt(workflow))
+        try:
+            prompt_id = await asyncio.shield(submit)
+        except asyncio.CancelledError:
+            # 提交请求已发出，ComfyUI 仍可能接收该任务：等提交完成后再取消，不留下无人认领的任务
+            submit.add_done_callback(self._cancel_after_submit)
+            raise
+        if not prompt_id:
+            logger.error("[ComfyUI] 提交任务失败")
+            return None
+
+        try:
+            # 给 ComfyUI 一点时间把任务调度起来，队列变化会提前唤醒
+            await self.wait_queue_update(timeout=1.0)
+            queue_position, tasks_ahead, queue_extra = await self._calc_queue_timeout(prompt_id)
+            extra_timeout = max(extra_timeout, queue_extra)
+
+            if on_submitted_callback:
+                try:
+                    await on_submitted_callback(prompt_id, queue_position, tasks_ahead)
+                except Exception as e:
+                    logger.error(f"[ComfyUI] 提交回调异常: {e}")
+
+            logger.info(f"[ComfyUI] 任务 {prompt_id} 已提交，等待{label}结果...（总超时: {self.timeout + extra_timeout}s）")
+            try:
+                result = await fetch_fn(prompt_id, extra_timeout)
+            except ComfyUIJobError as e:
+                logger.error(f"[ComfyUI] 任务 {prompt_id} 失败: {e}"
+                             + (f" [{e.exception_type}]" if e.exception_type else ""))
+                raise
+        except asyncio.CancelledError:
+            logger.info(f"[ComfyUI] 请求已放弃，取消任务 {prompt_id}")
+            await self._cancel_abandoned(prompt_id)
+            raise
+
+        if result:
+            logger.info(f"[ComfyUI] 任务 {prompt_id} 完成")
+        else:
+            logger.error(f"[ComfyUI] 任务 {prompt_id} 等待结果超时或失败")
+            # 超时后任务可能仍在排队或运行，没人会再取结果，释放 GPU
+            await self._cancel_abandoned(prompt_id)
+
+        return result
+
+    async def queue_and_wait_image(self, workflow: Union[dict, bytes], extra_timeout: int = 0,
+                                   on_submitted_callback=None) -> Optional[bytes]:
+        """提交工作流并等待图片结果"""
+        return await self._queue_and_wait(
+            workflow, self.wait_result, "图片",
+            extra_timeout=extra_timeout,
+            on_submitted_callback=on_submitted_callback,
+        )
+
+    async def queue_and_wait_video(self, workflow: Union[dict, bytes], extra_timeout: int = 0,
+                                   on_submitted_callback=None) -> Optional[bytes]:
+        """提交工作流并等待视频结果"""
+        return await self._queue_and_wait(
+            workflow, self.wait_video_result, "视频",
+            extra_timeout=extra_timeout,
+            on_submitted_callback=on_submitted_callback,
+        )
+
+    async def queue_and_wait_video_file(self, workflow: Union[dict, bytes], dest_dir, extra_timeout: int = 0,
+                                        on_submitted_callback=None) -> Optional[Path]:
+        """提交工作流并把视频结果流式保存到 dest_dir，返回文件路径"""
+        async def fetch(prompt_id: str, extra: int):
+            return await self.wait_video_file(prompt_id, dest_dir, extra_timeout=extra)
+
+        return await self._queue_and_wait(
+            workflow, fetch, "视频",
+            extra_timeout=extra_timeout,
+            on_submitted_callback=on_submitted_callback,
+        )
+
+    async def queue_and_wait_text(self, workflow: Union[dict, bytes], output_node: str = "",
+                                  extra_timeout: int = 0,
+                                  on_submitted_callback=None) -> Optional[str]:
+        """提交工作流并等待文本结果"""
+        async def fetch(prompt_id: str, extra: int):
+            return await self.wait_text_result(prompt_id, output_node, extra_timeout=extra)
+
+        return await self._queue_and_wait(
+            workflow, fetch, "文本",
+            extra_timeout=extra_timeout,
+            on_submitted_callback=on_submitted_callback,
+        )
+
+    async def wait_video_result(self, prompt_id: str, extra_timeout: int = 0) -> Optional[bytes]:
+        """等待并下载视频结果
+
+        SaveVideo 节点的输出格式类似图片，存储在 outputs[node]["videos"] 中，
+        每项包含 filename / subfolder / type 字段。
+        """
+        entry = await self._wait_history(prompt_id, extra_timeout)
+        if not entry:
+            return None
+        for item in self._video_items(entry):
+            data = await self._download_output(item)
+            if data is not None:
+                return data
+        return None
+
+    async def wait_video_file(self, prompt_id: str, dest_dir, extra_timeout: int = 0) -> Optional[Path]:
+        """等待视频结果并流式保存到 dest_dir，返回文件路径"""
+        entry = await self._wait_history(prompt_id, extra_timeout)
+        if not entry:
+            return None
+        for item in self._video_items(entry):
+            path = await self._download_output_to_file(item, dest_dir)
+            if path is not None:
+                return path
+        return None
+
+    def _video_items(self, entry: dict):
+        """按顺序列出 history 记录中的视频输出项"""
+        for node_output in entry.get("outputs", {}).values():
+            # 兼容多种字段：videos / gifs / images（部分视频节点输出沿用 images 字段）
+            for key in ("videos", "gifs", "images"):
+                items = node_output.get(key)
+                if not items:
+                    continue
+                for item in items:
+                    # 跳过纯图片输出
+                    if key == "images" and not self._is_video_filename(item.get("filename", "")):
+                        continue
+                    yield item
+
+    @staticmethod
+    def _is_video_filename(filename: str) -> bool:
+        if not filename:
+            return False
+        lower = filename.lower()
+        return any(lower.endswith(ext) for ext in (".mp4", ".webm", ".mov", ".mkv", ".avi", ".gif"))
+
+    async def _calc_queue_timeout(self, prompt_id: str) -> tuple:
+        """根据任务在队列中的位置计算额外超时
+
+        检测提交的任务是否已在运行中：
+        - 如果已在运行，无需额外超时
+        - 如果在排队中，根据前方排队数量计算额外超时
+
+        Returns:
+            (queue_position, tasks_ahead, extra_timeout)
+            queue_position: 0=已在运行, >0=排队位置(1-based), -1=不在队列
+            tasks_ahead: 前方任务数（运行中+排队前方）
+            extra_timeout: 额外超时秒数
+        """
+        from astrbot.api import logger
+        info = await self.get_queue_info(max_age=0)
+        running = info.get("queue_running", [])
+        pending = info.get("queue_pending", [])
+
+        # 检查任务是否已在运行中
+        for item in running:
+            if self._get_prompt_id_from_item(item) == str(prompt_id):
+                logger.info(f"[ComfyUI] 任务 {prompt_id} 已在运行中，无需额外超时")
+                return (0, 0, 0)
+
+        # 计算任务在排队中的位置（前方有多少个任务）
+        own_position = 0
+        found = False
+        for item in pending:
+            if self._get_prompt_id_from_item(item) == str(prompt_id):
+                found = True
+                break
+            own_position += 1
+
+        if found:
+            # 前方 own_position 个排队任务 + 运行中的任务
+            tasks_ahead = own_position + len(running)
+            extra = max(120, tasks_ahead * 60)
+            logger.info(f"[ComfyUI] 任务 {prompt_id} 在队列第 {own_position + 1} 位（前方 {tasks_ahead} 个任务），额外超时 {extra}s")
+            return (own_position + 1, tasks_ahead, extra)
+        else:
+            # 任务不在队列中（可能已执行完毕或提交失败），不增加超时
+            return (-1, 0, 0)
+
+    async def wait_result(self, prompt_id: str, extra_timeout: int = 0) -> Optional[bytes]:
+        """等待并下载图片结果
+
+        Args:
+            prompt_id: 任务ID
+            extra_timeout: 额外超时秒数，用于强制提交时补偿队列排队时间
+        """
+        entry = await self._wait_history(prompt_id, extra_timeout)
+        if not entry:
+            return None
+        for item in self._image_items(entry):
+            data = await self._download_output(item)
+            if data is not None:
+                return data
+        return None
+
+    @staticmethod
+    def _image_items(entry: dict):
+        """列出 history 记录中每个节点的第一张图片输出"""
+        for node_output in entry.get("outputs", {}).values():
+            if "images" in node_output and node_output["images"]:
+                yield node_output["images"][0]
+
+    async def upload_image(self, filename: str, image_data: bytes) -> bool:
+        """上传图片到ComfyUI服务器"""
+        return await self._upload(filename, image_data) is not None
+
+    async def _upload(self, filename: str, image_data: bytes, overwrite: bool = False) -> Optional[str]:
+        """上传图片，返回服务器实际保存的文件名，失败返回 None
+
+        overwrite=False 时同名文件已存在，ComfyUI 会自动改名，所以以响应中的 name 为准。
+        """
+        session = self._get_session()
+        data = aiohttp.FormData()
+        data.add_field('image', image_data, filename=filename)
+        if overwrite:
+            data.add_field('overwrite', 'true')
+        try:
+            resp = await session.post(f"{self.server_url}/upload/image", data=data,
+                                      timeout=self.UPLOAD_TIMEOUT)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            self._mark_unhealthy(e)
+            raise
+        async with resp:
+            if resp.status == 200:
+                try:
+                    result = await resp.json()
+                except (aiohttp.ContentTypeError, ValueError):
+                    result = {}
+                name = result.get("name") if isinstance(result, dict) else None
+                subfolder = result.get("subfolder") if isinstance(result, dict) else None
+                if name and subfolder:
+                    name = f"{subfolder}/{name}"
+                return name or filename
+            else:
+                from astrbot.api import logger
+                try:
+                    error_detail = await resp.text()
+                    logger.error(f"[ComfyUI] 上传图片失败，状态码: {resp.status}, 详情: {error_detail}")
+                except:
+                    logger.error(f"[ComfyUI] 上传图片失败，状态码: {resp.status}")
+        return None
+
+    async def upload_input_image(self, image_data: bytes) -> Optional[str]:
+        """按内容哈希上传输入图片，返回可填入 LoadImage 的文件名，失败返回 None
+
+        文件名由图片内容的 SHA-256 决定，同一张图片在该服务器上只上传一次：
+        已记录在索引中的直接复用，不再发请求；索引按 LRU 淘汰。
+        上传时使用 overwrite，插件重启后索引为空时也不会产生 "xxx (1).png" 这样的重复文件。
+        """
+        filename = f"{self.UPLOAD_NAME_PREFIX}_{hashlib.sha256(image_data).hexdigest()}.png"
+        stored = self._uploaded.get(filename)
+        if stored is not None:
+            self._uploaded.move_to_end(filename)
+            return stored
+
+        task = self._uploading.get(filename)
+        if task is None:
+            task = asyncio.create_task(self._upload(filename, image_data, overwrite=True))
+            self._uploading[filename] = task
+            task.add_done_callback(lambda _: self._uploading.pop(filename, None))
+        stored = await asyncio.shield(task)
+        if stored:
+            self._uploaded[filename] = stored
+            self._uploaded.move_to_end(filename)
+            while len(self._uploaded) > self.UPLOADED_INDEX_LIMIT:
+                self._uploaded.popitem(last=False)
+        return stored
+
+    async def wait_text_result(self, prompt_id: str, output_node: str = "", extra_timeout: int = 0) -> Optional[str]:
+        """等待并获取文本结果
+
+        Args:
+            prompt_id: 任务ID
+            output_node: 输出节点ID
+            extra_timeout: 额外超时秒数，用于强制提交时补偿队列排队时间
+        """
+        entry = await self._wait_history(prompt_id, extra_timeout)
+        if not entry:
+            return None
+        outputs = entry.get("outputs", {})
+
+        # 如果指定了输出节点，只查找该节点的输出
+        if output_node and output_node in outputs:
+            text = self._extract_text_output(outputs[output_node])
+            if text:
+                return text
+
+        # 否则查找所有节点的文本输出
+        for node_output in outputs.values():
+            text = self._extract_text_output(node_output)
+            if text:
+                return text
+        return None
+
+    @staticmethod
+    def _extract_text_output(node_output: dict) -> Optional[str]:
+        """从单个节点输出中提取文本（string 为常见输出，tags 为 WD14Tagger 输出）
+
+        字段值如果是数组，返回第一个元素；如果是字符串，直接返回
+        """
+        for key in ("string", "tags"):
+            value = node_output.get(key)
+            if value:
+                return value[0] if isinstance(value, list) else value
+        return None
@@ -0,0 +1,267 @@
+import asyncio
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Awaitable, Callable, Optional
+
+
+class InputImageCache:
+    """用户输入图片缓存：URL -> 内容哈希 -> 图片数据，内存 + 磁盘两级
+
+    同一张图片经常被反复引用（先识别标签，再图生图、图生视频），命中缓存时不再下载。
+    - URL 索引记录 URL 对应的内容哈希，超过 ttl 秒后失效，需要重新下载；
+    - 内存层按 LRU 保存最近的图片，总大小不超过 memory_bytes；
+    - 磁盘层以内容哈希为文件名保存在 cache_dir，总大小不超过 disk_bytes，按最近使用淘汰，
+      文件修改时间超过 ttl 的视为过期；插件重启后磁盘层仍然有效（URL 索引需要重新建立）。
+    不同 URL 指向相同内容时只保存一份。大小为 0 的层不启用。
+
+    索引只在事件循环中读写；文件读写、启动时的目录扫描与内容哈希（单张最大 20MB）
+    都通过 asyncio.to_thread 在线程中进行，不阻塞事件循环。
+    """
+
+    # URL 索引条目上限
+    URL_INDEX_LIMIT = 4096
+
+    def __init__(self, cache_dir: Path, memory_bytes: int, disk_bytes: int, ttl: float,
+                 max_item_bytes: int):
+        self.cache_dir = Path(cache_dir)
+        self.memory_bytes = max(0, int(memory_bytes))
+        self.disk_bytes = max(0, int(disk_bytes))
+        self.ttl = max(0.0, float(ttl))
+        self.max_item_bytes = max_item_bytes
+        # url -> (内容哈希, 过期时间)
+        self._urls: OrderedDict = OrderedDict()
+        # 内容哈希 -> 图片数据
+        self._memory: OrderedDict = OrderedDict()
+        self._memory_size = 0
+        # 内容哈希 -> 文件大小，按最近使用排序
+        self._disk: OrderedDict = OrderedDict()
+        self._disk_size = 0
+        # url -> 进行中的下载任务，同一 URL 的并发请求共享一次下载
+        self._fetching: dict = {}
+        # 磁盘层索引在首次使用时于线程中扫描建立，并发调用共享同一次扫描
+        self._scan_task: Optional[asyncio.Future] = None
+        self._disk_indexed = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and (self.memory_bytes > 0 or self.disk_bytes > 0)
+
+    @property
+    def _disk_enabled(self) -> bool:
+        return self.disk_bytes > 0 and self.ttl > 0
+
+    async def _ensure_disk_index(self):
+        if not self._disk_enabled:
+            return
+        if self._scan_task is None:
+            self._scan_task = asyncio.ensure_future(asyncio.to_thread(self._scan_disk))
+        entries = await asyncio.shield(self._scan_task)
+        if self._disk_indexed:
+            return
+        self._disk_indexed = True
+        for _, digest, size in sorted(entries):
+            self._disk[digest] = size
+            self._disk_size += size
+        await self._trim_disk()
+
+    def _scan_disk(self) -> list:
+        """（线程中）扫描磁盘层，删除过期文件与写入中断留下的临时文件，返回 [(访问时间, 哈希, 大小)]"""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        now = time.time()
+        entries = []
+        for path in self.cache_dir.iterdir():
+            try:
+                stat = path.stat()
+                if path.suffix == ".tmp" or now - stat.st_mtime > self.ttl:
+                    path.unlink()
+                    continue
+            except OSError:
+                continue
+            entries.append((stat.st_atime, path.name, stat.st_size))
+        return entries
+
+    async def fetch(self, url: str, loader: Callable[[], Awaitable[Optional[bytes]]]) -> Optional[bytes]:
+        """返回 URL 对应的图片数据：命中缓存时直接返回，否则调用 loader 下载并写入缓存"""
+        if not self.enabled:
+            return await loader()
+        data = await self.get(url)
+        if data is not None:
+            return data
+
+        task = self._fetching.get(url)
+        if task is None:
+            task = asyncio.create_task(self._load(url, loader))
+            self._fetching[url] = task
+            task.add_done_callback(lambda _: self._fetching.pop(url, None))
+        return await asyncio.shield(task)
+
+    async def _load(self, url: str, loader) -> Optional[bytes]:
+        data = await loader()
+        if data:
+            await self.put(url, data)
+        return data
+
+    async def get(self, url: str) -> Optional[bytes]:
+        """按 URL 查找缓存，未命中或已过期返回 None"""
+        entry = self._urls.get(url)
+        if entry is None:
+            return None
+        digest, expires = entry
+        if time.time() > expires:
+            del self._urls[url]
+            return None
+        self._urls.move_to_end(url)
+
+        data = self._memory.get(digest)
+        if data is not None:
+            self._memory.move_to_end(digest)
+            return data
+
+        data = await self._read_disk(digest)
+        if data is None:
+            self._urls.pop(url, None)
+            return None
+        self._remember(digest, data)
+        return data
+
+    async def put(self, url: str, data: bytes):
+        """写入缓存；超过单张大小限制的数据不缓存"""
+        if len(data) > self.max_item_bytes:
+            return
+        digest = await asyncio.to_thread(lambda: hashlib.sha256(data).hexdigest())
+        self._urls[url] = (digest, time.time() + self.ttl)
+        self._urls.move_to_end(url)
+        while len(self._urls) > self.URL_INDEX_LIMIT:
+            self._urls.popitem(last=False)
+        self._remember(digest, data)
+        await self._write_disk(digest, data)
+
+    async def clear(self):
+        """清空所有缓存（包括磁盘层文件）"""
+        await self._ensure_disk_index()
+        self._urls.clear()
+        self._memory.clear()
+        self._memory_size = 0
+        for digest in list(self._disk):
+            await self._remove_disk(digest)
+
+    def _remember(self, digest: str, data: bytes):
+        if self.memory_bytes <= 0 or len(data) > self.memory_bytes:
+            return
+        if digest not in self._memory:
+            self._memory[digest] = data
+            self._memory_size += len(data)
+        self._memory.move_to_end(digest)
+        while self._memory_size > self.memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    def _read_file(self, path: Path) -> Optional[bytes]:
+        """（线程中）读取未过期的缓存文件，过期返回 None"""
+        if time.time() - path.stat().st_mtime > self.ttl:
+            return None
+        with open(path, "rb") as f:
+            return f.read(self.max_item_bytes + 1)
+
+    async def _read_disk(self, digest: str) -> Optional[bytes]:
+        await self._ensure_disk_index()
+        if digest not in self._disk:
+            return None
+        try:
+            data = await asyncio.to_thread(self._read_file, self.cache_dir / digest)
+        except OSError:
+            data = None
+        if data is None or len(data) > self.max_item_bytes or len(data) != self._disk.get(digest):
+            await self._remove_disk(digest)
+            return None
+        self._disk.move_to_end(digest)
+        return data
+
+    @staticmethod
+    def _write_file(path: Path, data: bytes):
+        """（线程中）先写临时文件再替换，写入中断不会留下不完整的缓存文件"""
+        tmp = path.with_suffix(".tmp")
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    async def _write_disk(self, digest: str, data: bytes):
+        if self.disk_bytes <= 0 or len(data) > self.disk_bytes:
+            return
+        await self._ensure_disk_index()
+        path = self.cache_dir / digest
+        if digest in self._disk:
+            self._disk.move_to_end(digest)
+            # 内容相同，刷新修改时间以延长有效期
+            try:
+                await asyncio.to_thread(os.utime, path)
+                return
+            except OSError:
+                await self._remove_disk(digest)
+        try:
+            await asyncio.to_thread(self._write_file, path, data)
+        except OSError as e:
+            from astrbot.api import logger
+            logger.warning(f"[输入图片缓存] 写入磁盘失败: {e}")
+            return
+        if digest not in self._disk:
+            self._disk[digest] = len(data)
+            self._disk_size += len(data)
+        await self._trim_disk()
+
+    async def _trim_disk(self):
+        while self._disk_size > self.disk_bytes and self._disk:
+            await self._remove_disk(next(iter(self._disk)))
+
+    async def _remove_disk(self, digest: str):
+        size = self._disk.pop(digest, None)
+        if size is None:
+            return
+        self._disk_size -= size
+        try:
+            await asyncio.to_thread((self.cache_dir / digest).unlink)
+        except OSError:
+            pass
+
+
+class ThumbnailCache:
+    """审查用图片缓存：原图内容哈希 -> (缩略图数据或 None, dHash)，按 LRU 淘汰，总大小不超过 max_bytes
+
+    同一张图片被多次审查（输入与输出、重发的请求）时不再重复解码、缩放与编码。
+    """
+
+    # 每个条目除缩略图外的估计开销（键、哈希值等）
+    ENTRY_OVERHEAD = 256
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max(0, int(max_bytes))
+        self._entries: OrderedDict = OrderedDict()
+        self._size = 0
+
+    @classmethod
+    def _entry_size(cls, entry: tuple) -> int:
+        return len(entry[0] or b"") + cls.ENTRY_OVERHEAD
+
+    def get(self, key: str) -> Optional[tuple]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, thumbnail: Optional[bytes], image_hash: int):
+        entry = (thumbnail, image_hash)
+        size = self._entry_size(entry)
+        if size > self.max_bytes or key in self._entries:
+            return
+        self._entries[key] = entry
+        self._size += size
+        while self._size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= self._entry_size(evicted)
+
+    def clear(self):
+        self._entries.clear()
+        self._size = 0
@@ -0,0 +1,262 @@
+"""图片处理：PIL 解码/编码放到共享的执行器中运行，避免阻塞事件循环
+
+模块级函数只依赖 PIL，可以在线程池或进程池中执行（进程池要求函数和参数可 pickle），
+出错时直接抛出异常，由调用方在事件循环中记录日志。只读文件头的 probe_image 开销很小，
+直接在事件循环中调用，每个输入只探测一次，结果在审查与各引擎之间共享。
+"""
+import asyncio
+import concurrent.futures
+import concurrent.futures.process
+import multiprocessing
+from io import BytesIO
+from typing import NamedTuple, Optional
+
+from PIL import Image as PILImage
+
+
+class ImageInfo(NamedTuple):
+    """probe_image 的结果：只来自文件头，不解码像素"""
+    format: Optional[str]
+    width: int
+    height: int
+    mode: str
+    frames: int
+
+    @property
+    def size(self) -> tuple:
+        return self.width, self.height
+
+    @property
+    def animated(self) -> bool:
+        return self.frames > 1
+
+    @property
+    def mime_type(self) -> str:
+        return f"image/{self.format.lower()}" if self.format else "image/png"
+
+
+def probe_image(image_data: bytes) -> ImageInfo:
+    """读取图片的格式、尺寸、模式与帧数
+
+    PIL 打开图片时只解析文件头，不解码像素；GIF 的帧数需要跳过各帧的数据块，
+    同样不做解码，因此可以直接在事件循环中调用。无法识别时抛出异常。
+    """
+    with PILImage.open(BytesIO(image_data)) as img:
+        return ImageInfo(img.format, img.width, img.height, img.mode,
+                         getattr(img, 'n_frames', 1))
+
+
+def _dhash_image(img) -> int:
+    """64 位差异哈希（dHash）：缩小为 9x8 灰度图，比较每行相邻像素的亮度
+
+    重新编码、轻微缩放或压缩后的同一张图片哈希值几乎不变，用汉明距离判断是否相近。
+    """
+    small = img.convert('L').resize((9, 8), PILImage.BILINEAR, reducing_gap=2.0)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+class InputBudget(NamedTuple):
+    """上传到 ComfyUI 前的输入图片预算，超出时等比缩小并重新编码
+
+    max_pixels/max_bytes 为 0 表示不限制；缩小后的宽高对齐到 align 的倍数。
+    """
+    max_pixels: int = 0
+    max_bytes: int = 0
+    format: str = "PNG"
+    align: int = 8
+
+    def exceeded(self, info: ImageInfo, size: int) -> bool:
+        return ((self.max_pixels > 0 and info.width * info.height > self.max_pixels) or
+                (self.max_bytes > 0 and size > self.max_bytes))
+
+
+# 重新编码时使用的质量（PNG 为无损，忽略）
+_INPUT_QUALITY = 95
+
+
+def _fit_dimensions(width: int, height: int, max_pixels: int, align: int) -> tuple:
+    """等比缩小到 max_pixels 以内并对齐，不放大"""
+    if max_pixels <= 0 or width * height <= max_pixels:
+        return width, height
+    scale = (max_pixels / (width * height)) ** 0.5
+    w = max(align, int(width * scale) // align * align)
+    h = max(align, int(height * scale) // align * align)
+    return w, h
+
+
+def prepare_input(image_data: bytes, budget: InputBudget) -> bytes:
+    """按预算处理输入图片：动图取首帧，超出像素/体积预算时等比缩小，并按 budget.format 编码"""
+    with PILImage.open(BytesIO(image_data)) as img:
+        img.seek(0)
+        has_alpha = img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info
+        mode = 'RGBA' if has_alpha and budget.format != 'JPEG' else 'RGB'
+        frame = img.convert(mode) if img.mode != mode else img
+        width, height = _fit_dimensions(frame.width, frame.height, budget.max_pixels, budget.align)
+
+        # 体积仍超出预算时按比例再缩小，最多重试 3 次
+        for _ in range(4):
+            resized = frame if (width, height) == frame.size else frame.resize((width, height), PILImage.LANCZOS)
+            output = BytesIO()
+            resized.save(output, format=budget.format, quality=_INPUT_QUALITY)
+            if budget.max_bytes <= 0 or output.tell() <= budget.max_bytes:
+                break
+            pixels = int(width * height * budget.max_bytes / output.tell() * 0.9)
+            width, height = _fit_dimensions(width, height, pixels, budget.align)
+        return output.getvalue()
+
+
+def encode_image(image_data: bytes, fmt: str, quality: int, scale: float = 1.0) -> bytes:
+    """按指定格式与质量重新编码，scale < 1 时先等比缩小"""
+    with PILImage.open(BytesIO(image_data)) as img:
+        if scale < 1.0:
+            size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+            img = img.resize(size, PILImage.LANCZOS)
+        buffer = BytesIO()
+        img.save(buffer, format=fmt, quality=quality)
+        return buffer.getvalue()
+
+
+def censor_rendition(image_data: bytes, max_edge: int, fmt: str, quality: int) -> tuple:
+    """审查用的图片与 dHash，只解码一次
+
+    长边超过 max_edge 或为动图时取首帧，缩小到 max_edge 以内（不放大），按 fmt/quality 编码，
+    dHash 由缩小后的图片计算；否则不生成缩略图（返回 None，发送原图），只为 dHash 解码。
+    JPEG 在解码时直接缩小，大图不需要完整解码；JPEG 不支持透明通道，转为 RGB。
+
+    Returns:
+        (缩略图数据或 None, dHash)
+    """
+    with PILImage.open(BytesIO(image_data)) as img:
+        if max_edge <= 0 or (getattr(img, 'n_frames', 1) <= 1 and max(img.size) <= max_edge):
+            img.draft('L', (64, 64))
+            return None, _dhash_image(img)
+        img.seek(0)
+        has_alpha = img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info
+        mode = 'RGBA' if has_alpha and fmt != 'JPEG' else 'RGB'
+        img.draft(mode, (max_edge, max_edge))
+        frame = img.convert(mode) if img.mode != mode else img
+        frame.thumbnail((max_edge, max_edge), PILImage.LANCZOS, reducing_gap=3.0)
+        buffer = BytesIO()
+        frame.save(buffer, format=fmt, quality=quality)
+        return buffer.getvalue(), _dhash_image(frame)
+
+
+class Compressed(NamedTuple):
+    """fit_to_size 的结果"""
+    format: str
+    quality: int
+    scale: float
+    ext: str
+    data: bytes
+    encodes: int
+
+
+class ImageProcessor:
+    """共享的图片处理执行器
+
+    worker_type 为 "thread"（默认，PIL 编解码大部分会释放 GIL）或 "process"（CPU 密集的
+    编码完全不占用主进程，但图片数据需要在进程间复制）。同时提交到执行器的任务数
+    不超过 queue_size，更多的调用在事件循环中异步等待，不会无限堆积内存。
+    """
+
+    def __init__(self, worker_count: int = 2, worker_type: str = "thread", queue_size: int = 16):
+        self.worker_count = max(1, int(worker_count))
+        self.worker_type = "process" if str(worker_type).lower() == "process" else "thread"
+        self.queue_size = max(self.worker_count, int(queue_size))
+        self._executor: Optional[concurrent.futures.Executor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    def _get_executor(self) -> concurrent.futures.Executor:
+        if self._executor is None:
+            if self.worker_type == "process":
+                try:
+                    # spawn 避免 fork 复制整个机器人进程的状态
+                    self._executor = concurrent.futures.ProcessPoolExecutor(
+                        max_workers=self.worker_count,
+                        mp_context=multiprocessing.get_context("spawn"),
+                    )
+                except (OSError, ValueError, NotImplementedError) as e:
+                    from astrbot.api import logger
+                    logger.warning(f"[图片处理] 无法创建进程池，改用线程池: {e}")
+                    self.worker_type = "thread"
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.worker_count, thread_name_prefix="comfyui_hub_image")
+        return self._executor
+
+    async def run(self, func, *args):
+        """在执行器中运行 func(*args) 并返回结果，异常原样抛出"""
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.queue_size)
+        async with self._slots:
+            loop = asyncio.get_running_loop()
+            try:
+                return await loop.run_in_executor(self._get_executor(), func, *args)
+            except concurrent.futures.process.BrokenProcessPool as e:
+                # 子进程异常退出（例如无法导入插件模块），之后改用线程池
+                from astrbot.api import logger
+                logger.warning(f"[图片处理] 进程池不可用，改用线程池: {e}")
+                self.shutdown()
+                self.worker_type = "thread"
+                return await loop.run_in_executor(self._get_executor(), func, *args)
+
+    # WebP 各质量相对 quality=90 的体积比（取多类图片中偏大的一侧，估计偏保守）
+    WEBP_SIZE_RATIO = ((85, 0.90), (80, 0.79), (75, 0.72), (70, 0.67), (60, 0.62), (50, 0.58))
+    # 缩小到 scale 倍并以 quality=80 编码时，体积约为 quality=90 原图的 0.9 * scale^1.3
+    # （平滑的图片缩小后单位像素的细节变多，体积下降慢于像素数，同样取偏保守的拟合）
+    SCALED_SIZE_RATIO = 0.9
+    SCALED_SIZE_EXPONENT = 1.3
+    MIN_SCALE = 0.25
+    # 估算原尺寸放不下时，激进候选在估算尺寸上再缩小的倍数
+    FALLBACK_SCALE = 0.75
+
+    async def fit_to_size(self, image_data: bytes, size_limit: int) -> Optional[Compressed]:
+        """在 size_limit 以内找尽量高质量的 WebP 编码，最多两轮、共三次编码
+
+        1. 先编码一次 quality=90，满足限制直接返回；
+        2. 否则按体积比估算，并行编码两个候选，按顺序取第一个满足限制的：
+           - 估算原尺寸能放下时：「原尺寸 + 估算质量」与「缩小到估算能放下的尺寸 + quality=80」；
+           - 估算原尺寸即使 quality=50 也放不下时：「缩小 + quality=80」与
+             更激进的「再缩小 FALLBACK_SCALE 倍 + quality=70」。
+
+        Returns:
+            Compressed，全部超限返回 None；编码出错时抛出异常
+        """
+        probe = await self.run(encode_image, image_data, 'WEBP', 90)
+        if len(probe) <= size_limit:
+            return Compressed('WEBP', 90, 1.0, '.webp', probe, 1)
+
+        # 留出 5% 余量，避免估算刚好卡在边界
+        target = size_limit * 0.95
+        quality = None
+        for q, ratio in self.WEBP_SIZE_RATIO:
+            if len(probe) * ratio <= target:
+                quality = q
+                break
+        scale = (target / (len(probe) * self.SCALED_SIZE_RATIO)) ** (1 / self.SCALED_SIZE_EXPONENT)
+        scale = min(1.0, max(self.MIN_SCALE, scale))
+        if quality is not None:
+            candidates = ((quality, 1.0), (80, scale))
+        else:
+            candidates = ((80, scale), (70, max(self.MIN_SCALE, scale * self.FALLBACK_SCALE)))
+
+        results = await asyncio.gather(*(
+            self.run(encode_image, image_data, 'WEBP', q, sc) for q, sc in candidates
+        ))
+        for (q, sc), data in zip(candidates, results):
+            if len(data) <= size_limit:
+                return Compressed('WEBP', q, sc, '.webp', data, 3)
+        return None
+
+    def shutdown(self):
+        """关闭执行器，不等待进行中的任务"""
+        executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
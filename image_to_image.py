@@ -1,76 +1,101 @@
-import json
-import random
-import time
-from io import BytesIO
+import asyncio
 from typing import Optional
 
-from PIL import Image as PILImage
 from astrbot.api import logger
 
-from .comfyui_api import ComfyUIAPI
+from . import image_processing
+from .comfyui_api import ComfyUIAPI, releases_job
+from .image_processing import ImageInfo, ImageProcessor, InputBudget
+from .workflow_template import WorkflowTemplate
 
 
 class ImageToImage:
     def __init__(self, api: ComfyUIAPI, workflow_path: str,
                  positive_node: str = "20", negative_node: str = "21",
-                 input_nodes: list = None):
+                 input_nodes: list = None, image_processor: Optional[ImageProcessor] = None,
+                 input_budget: Optional[InputBudget] = None):
         self.api = api
-        self.workflow = self._load_workflow(workflow_path)
+        self.images = image_processor or ImageProcessor()
+        self.input_budget = input_budget or InputBudget()
+        self.template = WorkflowTemplate.load(workflow_path)
+        self.workflow = self.template.workflow
         self.positive_node = positive_node
         self.negative_node = negative_node
         # 输入节点列表，按顺序分配图片
         self.input_nodes = input_nodes or []
+        # 图片分配顺序（LoadImage 节点ID），以及按输入图片数量预先裁剪好的模板
+        self._slots, self._variants = self._compile_variants()
 
-    @staticmethod
-    def _load_workflow(path: str) -> dict:
-        """加载工作流文件"""
-        with open(path, 'r', encoding='utf-8') as f:
-            return json.load(f)
-
-    @staticmethod
-    def _set_prompt(node: dict, prompt: str) -> bool:
-        """设置提示词到节点的第一个输入字段"""
-        if not node or "inputs" not in node:
-            return False
+    def _compile_variants(self) -> tuple:
+        """加载时按输入图片数量 1..N 各生成一个裁剪后的模板
 
-        inputs = node["inputs"]
-        if not inputs:
-            return False
+        分配顺序：先按配置的输入节点顺序，再按工作流中其余 LoadImage 节点的顺序。
+        给定图片数量后，哪些 LoadImage 节点未分配（且工作流中 image 为空）是确定的，
+        因此移除这些节点及其同伴节点、清理悬空引用的结果可以预先算好，请求时只需查表。
 
-        first_key = next(iter(inputs))
-        inputs[first_key] = prompt
-        return True
+        Returns:
+            (slots, {图片数量: (模板, 未分配的 LoadImage 节点, 一并移除的同伴节点)})
+        """
+        template = self.template
+        slots = [nid for nid in self.input_nodes if template.class_type(nid) == "LoadImage"]
+        slots += [nid for nid in template.load_image_nodes if nid not in self.input_nodes]
+
+        variants = {}
+        for count in range(1, len(slots) + 1):
+            assigned = set(slots[:count])
+            unassigned = set()
+            for nid in template.load_image_nodes:
+                if nid in assigned:
+                    continue
+                image_val = template.get_input(nid, "image") or ""
+                if not image_val or (isinstance(image_val, str) and not image_val.strip()):
+                    unassigned.add(nid)
+            if not unassigned:
+                variants[count] = (template, unassigned, set())
+                continue
+            all_to_remove = self._find_companion_nodes(template.workflow, unassigned)
+            variants[count] = (WorkflowTemplate(self._prune_workflow(template.workflow, all_to_remove)),
+                               unassigned, all_to_remove - unassigned)
+        return slots, variants
 
     @staticmethod
-    def _extract_first_frame_if_gif(image_data: bytes) -> Optional[bytes]:
+    def _prune_workflow(workflow: dict, to_remove: set) -> dict:
+        """返回移除 to_remove 节点后的工作流，并删除保留节点中指向已移除节点的链接输入
+
+        （如提示词节点中的 image2/image3 字段）。未改动的节点与原工作流共享。
+        """
+        pruned = {}
+        for nid, ndata in workflow.items():
+            if nid in to_remove:
+                continue
+            if isinstance(ndata, dict) and isinstance(ndata.get("inputs"), dict):
+                inputs = ndata["inputs"]
+                dangling = [key for key, value in inputs.items()
+                            if isinstance(value, list) and len(value) >= 2 and str(value[0]) in to_remove]
+                if dangling:
+                    ndata = dict(ndata)
+                    ndata["inputs"] = {k: v for k, v in inputs.items() if k not in dangling}
+            pruned[nid] = ndata
+        return pruned
+
+    async def _prepare_input(self, image_data: bytes, info: Optional[ImageInfo] = None) -> Optional[bytes]:
         """
-        如果输入是动图（GIF/WebP），提取第一帧
-        如果是动图且处理失败，返回 None 拒绝使用原图
+        动图（GIF/WebP）提取第一帧、超出输入预算时等比缩小（在图片处理执行器中运行），
+        无需处理时原样返回；处理失败返回 None，拒绝使用原图
 
-        Returns:
-            处理后的图片数据（首帧），如果是动图且处理失败则返回 None
+        Args:
+            info: 调用方已有的 probe_image 结果，None 时在此读取文件头
         """
         try:
-            with PILImage.open(BytesIO(image_data)) as img:
-                # 检查是否为动图
-                is_animated = getattr(img, 'is_animated', False)
-
-                if is_animated:
-                    logger.info("[ComfyUI] 检测到动图，将使用首帧")
-                    # 提取第一帧
-                    img.seek(0)
-                    # 转换为RGB模式（避免某些模式导致的错误）
-                    if img.mode != 'RGB':
-                        img = img.convert('RGB')
-                    # 保存为PNG格式
-                    output = BytesIO()
-                    img.save(output, format='PNG')
-                    return output.getvalue()
-
-                # 静态图片直接返回
+            if info is None:
+                info = image_processing.probe_image(image_data)
+            if not info.animated and not self.input_budget.exceeded(info, len(image_data)):
                 return image_data
+            if info.animated:
+                logger.info("[ComfyUI] 检测到动图，将使用首帧")
+            return await self.images.run(image_processing.prepare_input, image_data, self.input_budget)
         except Exception as e:
-            logger.error(f"[ComfyUI] 动图检测/处理失败: {e}")
+            logger.error(f"[ComfyUI] 输入图片处理失败: {e}")
             return None
 
     @staticmethod
@@ -108,7 +133,9 @@ class ImageToImage:
                     changed = True
         return all_to_remove
 
-    async def generate(self, image_data_list: list, prompt: str, negative: str = "", max_wait: float = 300.0, on_wait_callback=None, on_submitted_callback=None) -> Optional[bytes]:
+    @releases_job
+    async def generate(self, image_data_list: list, prompt: str, negative: str = "", max_wait: float = 300.0, on_wait_callback=None, on_submitted_callback=None,
+                       owner: Optional[tuple] = None, image_infos: Optional[list] = None) -> Optional[bytes]:
         """生成图片
         
         Args:
@@ -116,126 +143,67 @@ class ImageToImage:
                             后续图片对应额外输入节点。
             prompt: 正面提示词
             negative: 负面提示词
+            owner: (群标识, 用户标识)，供调度器做公平排队
+            image_infos: 与 image_data_list 一一对应的 probe_image 结果（元素可为 None），
+                         调用方已探测过时传入，避免重复解析同一张图片
         """
-        workflow = json.loads(json.dumps(self.workflow))
-
-        # 处理所有图片（动图提取首帧）并上传
-        uploaded_filenames = []
-        for i, img_data in enumerate(image_data_list):
-            processed = self._extract_first_frame_if_gif(img_data)
+        # 并发处理所有图片（动图提取首帧、输入预算），结果顺序与输入一致
+        infos = list(image_infos or [])
+        infos += [None] * (len(image_data_list) - len(infos))
+        processed_list = await asyncio.gather(*(
+            self._prepare_input(img_data, info) for img_data, info in zip(image_data_list, infos)
+        ))
+        for i, processed in enumerate(processed_list):
             if processed is None:
-                logger.error(f"[ComfyUI] 第 {i+1} 张图片不支持动图输入，请使用静态图片")
+                logger.error(f"[ComfyUI] 第 {i+1} 张图片处理失败")
                 return None
 
-            filename = f"img2img_input_{int(time.time() * 1000)}_{random.randint(1000, 9999)}.png"
-            try:
-                await self.api.upload_image(filename, processed)
-                uploaded_filenames.append(filename)
-            except Exception as e:
-                logger.error(f"[ComfyUI] 上传第 {i+1} 张图片失败: {e}")
-                return None
+        # 并发上传；按内容哈希命名，同一张图片重复使用时不再重新上传
+        try:
+            uploaded_filenames = await self.api.upload_input_images(processed_list)
+        except Exception as e:
+            logger.error(f"[ComfyUI] 上传图片失败: {e}")
+            return None
+        if not uploaded_filenames:
+            logger.error("[ComfyUI] 上传图片失败")
+            return None
 
-        # 收集所有 LoadImage 节点（按节点ID排序）
-        load_image_nodes = []
-        for node_id, node_data in workflow.items():
-            if isinstance(node_data, dict) and node_data.get("class_type") == "LoadImage":
-                load_image_nodes.append((node_id, node_data))
-
-        # 将上传的图片分配到对应的 LoadImage 节点
-        assigned_count = 0
-        # 优先按配置的输入节点顺序分配
-        for input_node_id in self.input_nodes:
-            if assigned_count >= len(uploaded_filenames):
-                break
-            if input_node_id in workflow:
-                node_data = workflow[input_node_id]
-                if isinstance(node_data, dict) and node_data.get("class_type") == "LoadImage":
-                    node_data["inputs"]["image"] = uploaded_filenames[assigned_count]
-                    assigned_count += 1
-
-        # 如果还有未分配的图片，按 LoadImage 节点顺序分配剩余节点
-        if assigned_count < len(uploaded_filenames):
-            remaining_nodes = [(nid, nd) for nid, nd in load_image_nodes
-                              if nid not in self.input_nodes]
-            for node_id, node_data in remaining_nodes:
-                if assigned_count >= len(uploaded_filenames):
-                    break
-                node_data["inputs"]["image"] = uploaded_filenames[assigned_count]
-                assigned_count += 1
-
-        # 如果没有通过配置节点分配成功，回退到旧逻辑
-        if assigned_count == 0 and load_image_nodes:
-            load_image_nodes[0][1]["inputs"]["image"] = uploaded_filenames[0]
-            assigned_count = 1
-
-        if assigned_count == 0:
+        if not self._slots:
             logger.error("[ComfyUI] 工作流中未找到 LoadImage 节点")
             return None
 
+        # 按图片数量取预先裁剪好的模板，再把上传的图片按分配顺序写入
+        assigned_count = min(len(uploaded_filenames), len(self._slots))
         if assigned_count < len(uploaded_filenames):
             logger.warning(f"[ComfyUI] 上传了 {len(uploaded_filenames)} 张图片，但只有 {assigned_count} 个 LoadImage 节点可用")
 
-        # 移除未分配图片的 LoadImage 节点及其依赖节点
-        unassigned_load_nodes = set()
-        for nid, ndata in load_image_nodes:
-            image_val = ndata.get("inputs", {}).get("image", "")
-            if not image_val or (isinstance(image_val, str) and not image_val.strip()):
-                unassigned_load_nodes.add(nid)
+        template, unassigned_load_nodes, companions = self._variants[assigned_count]
+        patch = template.new_request()
+        for node_id, filename in zip(self._slots, uploaded_filenames):
+            patch.set(node_id, "image", filename)
 
         if unassigned_load_nodes:
-            # 查找与未分配 LoadImage 节点"一体化"的同伴节点（如配套缩放节点）
-            all_to_remove = self._find_companion_nodes(workflow, unassigned_load_nodes)
-            # 清理保留节点中对已移除节点的引用（如提示词节点中的 image2/image3 字段）
-            for nid, ndata in list(workflow.items()):
-                if nid in all_to_remove:
-                    continue
-                if not isinstance(ndata, dict):
-                    continue
-                inputs = ndata.get("inputs", {})
-                keys_to_remove = []
-                for key, value in inputs.items():
-                    if isinstance(value, list) and len(value) >= 2:
-                        ref_id = str(value[0])
-                        if ref_id in all_to_remove:
-                            keys_to_remove.append(key)
-                for key in keys_to_remove:
-                    del inputs[key]
-            # 从工作流中移除这些节点
-            for nid in all_to_remove:
-                del workflow[nid]
-            logger.info(f"[ComfyUI] 移除未分配图片的节点: {unassigned_load_nodes}，及其同伴节点: {all_to_remove - unassigned_load_nodes}")
+            logger.info(f"[ComfyUI] 移除未分配图片的节点: {unassigned_load_nodes}，及其同伴节点: {companions}")
 
         # 设置正面提示词
-        pos_node = workflow.get(self.positive_node)
-        if not pos_node:
+        if not patch.has_node(self.positive_node):
             logger.error(f"[ComfyUI] 找不到正面提示词节点 {self.positive_node}")
             return None
 
-        if not self._set_prompt(pos_node, prompt):
+        if not patch.set_prompt(self.positive_node, prompt):
             logger.error(f"[ComfyUI] 节点 {self.positive_node} 没有输入字段")
             return None
 
         # 设置负面提示词
-        if self.negative_node and negative:
-            neg_node = workflow.get(self.negative_node)
-            if neg_node:
-                self._set_prompt(neg_node, negative)
+        if self.negative_node and negative and patch.has_node(self.negative_node):
+            patch.set_prompt(self.negative_node, negative)
 
         # 设置随机种子
-        base_seed = random.randint(1, 999999999999999)
-        offset = 0
-        for node_data in workflow.values():
-            if isinstance(node_data, dict):
-                inputs = node_data.get("inputs", {})
-                if "seed" in inputs:
-                    inputs["seed"] = base_seed + offset
-                    offset += 1
-                if "noise_seed" in inputs:
-                    inputs["noise_seed"] = base_seed + offset
-                    offset += 1
+        patch.randomize_seeds()
+        workflow = patch.encode()
 
         # 提交任务并等待结果
-        result = await self.api.queue_and_wait_image(workflow, max_wait=max_wait, on_wait_callback=on_wait_callback, on_submitted_callback=on_submitted_callback)
+        result = await self.api.queue_and_wait_image(workflow, max_wait=max_wait, on_wait_callback=on_wait_callback, on_submitted_callback=on_submitted_callback, owner=owner)
 
         if not result:
             logger.error("[ComfyUI] 图生图生成失败或等待结果超时")
@@ -1,61 +1,70 @@
-import json
-import random
-import time
 from typing import Optional
 
 from astrbot.api import logger
 
-from .comfyui_api import ComfyUIAPI
+from . import image_processing
+from .comfyui_api import ComfyUIAPI, releases_job
+from .image_processing import ImageInfo, ImageProcessor, InputBudget
+from .workflow_template import WorkflowTemplate
 
 
 class ImageToText:
-    def __init__(self, api: ComfyUIAPI, workflow_path: str, output_node: str = "", input_node: str = ""):
+    # tagger 模型通常在 448px 左右工作，默认输入预算留出余量
+    DEFAULT_INPUT_PIXELS = 1024 * 1024
+
+    def __init__(self, api: ComfyUIAPI, workflow_path: str, output_node: str = "", input_node: str = "",
+                 image_processor: Optional[ImageProcessor] = None, input_budget: Optional[InputBudget] = None):
         self.api = api
-        self.workflow = self._load_workflow(workflow_path)
+        self.images = image_processor or ImageProcessor()
+        self.input_budget = input_budget or InputBudget(self.DEFAULT_INPUT_PIXELS)
+        self.template = WorkflowTemplate.load(workflow_path)
+        self.workflow = self.template.workflow
         self.output_node = output_node
         self.input_node = input_node
 
-    @staticmethod
-    def _load_workflow(path: str) -> dict:
-        """加载工作流文件"""
-        with open(path, 'r', encoding='utf-8') as f:
-            return json.load(f)
+    @releases_job
+    async def generate(self, image_data: bytes, max_wait: float = 300.0, on_wait_callback=None, on_submitted_callback=None,
+                       owner: Optional[tuple] = None, image_info: Optional[ImageInfo] = None) -> Optional[str]:
+        """生成图片标签文本
 
-    async def generate(self, image_data: bytes, max_wait: float = 300.0, on_wait_callback=None, on_submitted_callback=None) -> Optional[str]:
-        """生成图片标签文本"""
-        workflow = json.loads(json.dumps(self.workflow))
+        owner 为 (群标识, 用户标识)，供调度器做公平排队；
+        image_info 为调用方已有的 probe_image 结果，避免重复解析同一张图片
+        """
+        patch = self.template.new_request()
 
-        # 上传图片到 ComfyUI（使用时间戳避免缓存）
-        filename = f"tagger_input_{int(time.time() * 1000)}_{random.randint(1000, 9999)}.png"
+        # 超出输入预算的图片先在图片处理执行器中缩小
         try:
-            await self.api.upload_image(filename, image_data)
+            if image_info is None:
+                image_info = image_processing.probe_image(image_data)
+            if self.input_budget.exceeded(image_info, len(image_data)):
+                image_data = await self.images.run(image_processing.prepare_input, image_data, self.input_budget)
+        except Exception as e:
+            logger.error(f"[ComfyUI] 输入图片处理失败: {e}")
+            return None
+
+        # 上传图片到 ComfyUI（按内容哈希命名，同一张图片重复识别时不再重新上传）
+        try:
+            filename = await self.api.upload_input_image(image_data)
         except Exception as e:
             logger.error(f"[ComfyUI] 上传图片失败: {e}")
             return None
+        if not filename:
+            logger.error("[ComfyUI] 上传图片失败")
+            return None
 
         # 更新工作流中的图片引用
-        # 方式1：使用配置的输入节点 ID
-        load_image_found = False
-        if self.input_node and self.input_node in workflow:
-            node_data = workflow[self.input_node]
-            if isinstance(node_data, dict):
-                node_data["inputs"]["image"] = filename
-                load_image_found = True
-
-        # 方式2：如果未指定输入节点，则查找 LoadImage 节点并更新其 image 字段
-        if not load_image_found:
-            for node_id, node_data in workflow.items():
-                if isinstance(node_data, dict) and node_data.get("class_type") == "LoadImage":
-                    node_data["inputs"]["image"] = filename
-                    load_image_found = True
-                    break
-
-        if not load_image_found:
+        # 方式1：使用配置的输入节点 ID；方式2：未指定输入节点时使用第一个 LoadImage 节点
+        input_node = self.input_node if patch.has_node(self.input_node) else None
+        if input_node is None and self.template.load_image_nodes:
+            input_node = self.template.load_image_nodes[0]
+
+        if input_node is None or not patch.set(input_node, "image", filename):
             logger.error("[ComfyUI] 未找到 LoadImage 节点")
             return None
+        workflow = patch.encode()
 
         # 提交任务并等待结果
-        result = await self.api.queue_and_wait_text(workflow, self.output_node, max_wait=max_wait, on_wait_callback=on_wait_callback, on_submitted_callback=on_submitted_callback)
+        result = await self.api.queue_and_wait_text(workflow, self.output_node, max_wait=max_wait, on_wait_callback=on_wait_callback, on_submitted_callback=on_submitted_callback, owner=owner)
 
         if not result:
             logger.error("[ComfyUI] tagger生成失败或等待结果超时")
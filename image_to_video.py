@@ -1,14 +1,13 @@
-import json
 import math
-import random
-import time
-from io import BytesIO
-from typing import Optional
+from pathlib import Path
+from typing import Optional, Union
 
-from PIL import Image as PILImage
 from astrbot.api import logger
 
-from .comfyui_api import ComfyUIAPI
+from . import image_processing
+from .comfyui_api import ComfyUIAPI, releases_job
+from .image_processing import ImageInfo, ImageProcessor, InputBudget
+from .workflow_template import WorkflowTemplate
 
 
 class ImageToVideo:
@@ -22,9 +21,14 @@ class ImageToVideo:
                  resolution_height_field: str = "height",
                  fps_node: str = "18", fps_field: str = "value",
                  length_node: str = "20", length_field: str = "value",
-                 max_frames: int = 240):
+                 max_frames: int = 240, image_processor: Optional[ImageProcessor] = None,
+                 input_budget: Optional[InputBudget] = None):
         self.api = api
-        self.workflow = self._load_workflow(workflow_path)
+        self.images = image_processor or ImageProcessor()
+        # 输入图片预算：输出最多 MAX_OUTPUT_PIXELS，更大的输入只会浪费上传与显存
+        self.input_budget = input_budget or InputBudget(self.MAX_OUTPUT_PIXELS)
+        self.template = WorkflowTemplate.load(workflow_path)
+        self.workflow = self.template.workflow
         self.positive_node = positive_node
         self.negative_node = negative_node
         self.input_node = input_node
@@ -37,43 +41,20 @@ class ImageToVideo:
         self.length_field = length_field
         self.max_frames = max_frames
 
-    @staticmethod
-    def _load_workflow(path: str) -> dict:
-        with open(path, 'r', encoding='utf-8') as f:
-            return json.load(f)
-
-    @staticmethod
-    def _set_prompt(node: dict, prompt: str) -> bool:
-        if not node or "inputs" not in node:
-            return False
-        inputs = node["inputs"]
-        if not inputs:
-            return False
-        first_key = next(iter(inputs))
-        inputs[first_key] = prompt
-        return True
-
-    @staticmethod
-    def _extract_first_frame_if_gif(image_data: bytes) -> Optional[bytes]:
-        """如果输入是动图（GIF/WebP），提取第一帧"""
+    async def _prepare_input(self, image_data: bytes, info: ImageInfo) -> Optional[bytes]:
+        """动图取首帧、超出输入预算时缩小（在图片处理执行器中运行），无需处理时原样返回"""
+        if not info.animated and not self.input_budget.exceeded(info, len(image_data)):
+            return image_data
+        if info.animated:
+            logger.info("[ComfyUI] 检测到动图，将使用首帧")
         try:
-            with PILImage.open(BytesIO(image_data)) as img:
-                is_animated = getattr(img, 'is_animated', False)
-                if is_animated:
-                    logger.info("[ComfyUI] 检测到动图，将使用首帧")
-                    img.seek(0)
-                    if img.mode != 'RGB':
-                        img = img.convert('RGB')
-                    output = BytesIO()
-                    img.save(output, format='PNG')
-                    return output.getvalue()
-                return image_data
+            return await self.images.run(image_processing.prepare_input, image_data, self.input_budget)
         except Exception as e:
-            logger.error(f"[ComfyUI] 动图检测/处理失败: {e}")
+            logger.error(f"[ComfyUI] 输入图片处理失败: {e}")
             return None
 
-    def _calc_output_size(self, image_data: bytes) -> Optional[tuple]:
-        """根据输入图像计算输出分辨率
+    def _calc_output_size(self, size: tuple) -> Optional[tuple]:
+        """根据输入图像尺寸计算输出分辨率
 
         - 输入图像像素 ≤ 1M：直接使用原始尺寸
         - 输入图像像素 > 1M：保持比例缩放至 1M 像素以内
@@ -82,15 +63,9 @@ class ImageToVideo:
         注意：仅计算并写入工作流的输出分辨率，不修改输入图像本身。
 
         Returns:
-            (width, height) 或 None（解析失败）
+            (width, height) 或 None（尺寸无效）
         """
-        try:
-            with PILImage.open(BytesIO(image_data)) as img:
-                w, h = img.size
-        except Exception as e:
-            logger.error(f"[ComfyUI] 读取图像尺寸失败: {e}")
-            return None
-
+        w, h = size
         if w <= 0 or h <= 0:
             return None
 
@@ -105,20 +80,12 @@ class ImageToVideo:
         h = max(align, (h // align) * align)
         return w, h
 
-    @staticmethod
-    def _read_node_value(workflow: dict, node_id: str, field: str):
-        """读取工作流节点上某个字段的当前值，找不到返回 None"""
-        if not node_id or node_id not in workflow:
-            return None
-        node = workflow[node_id]
-        if not isinstance(node, dict):
-            return None
-        return node.get("inputs", {}).get(field)
-
+    @releases_job
     async def generate(self, image_data: bytes, prompt: str, negative: str = "",
                        fps: Optional[float] = None, length: Optional[float] = None,
                        max_wait: float = 300.0, on_wait_callback=None,
-                       on_submitted_callback=None) -> Optional[bytes]:
+                       on_submitted_callback=None, owner: Optional[tuple] = None,
+                       dest_dir=None, image_info: Optional[ImageInfo] = None) -> Optional[Union[bytes, Path]]:
         """生成视频
 
         Args:
@@ -128,56 +95,60 @@ class ImageToVideo:
             fps: 帧率，None 表示沿用工作流默认值
             length: 视频长度（秒），None 表示沿用工作流默认值；
                     若 fps × length 超过 max_frames，会自动缩短 length 以满足上限
+            owner: (群标识, 用户标识)，供调度器做公平排队
+            dest_dir: 指定时把视频流式保存到该目录并返回文件路径，否则返回视频 bytes
+            image_info: 调用方已有的 probe_image 结果，避免重复解析同一张图片
         """
-        workflow = json.loads(json.dumps(self.workflow))
-
-        # 处理输入图片（动图首帧）
-        processed = self._extract_first_frame_if_gif(image_data)
+        patch = self.template.new_request()
+
+        # 只读取一次文件头：动图/预算判断与输出分辨率共用（首帧与画布尺寸相同，缩小时保持比例）
+        if image_info is None:
+            try:
+                image_info = image_processing.probe_image(image_data)
+            except Exception as e:
+                logger.error(f"[ComfyUI] 读取图片信息失败: {e}")
+                return None
+
+        # 处理输入图片（动图首帧、输入预算）
+        processed = await self._prepare_input(image_data, image_info)
         if processed is None:
             logger.error("[ComfyUI] 输入图片处理失败")
             return None
 
         # 根据输入图像计算输出分辨率
-        size = self._calc_output_size(processed)
+        size = self._calc_output_size(image_info.size)
 
-        filename = f"i2v_input_{int(time.time() * 1000)}_{random.randint(1000, 9999)}.png"
+        # 按内容哈希命名，同一张图片重复使用时不再重新上传
         try:
-            await self.api.upload_image(filename, processed)
+            filename = await self.api.upload_input_image(processed)
         except Exception as e:
             logger.error(f"[ComfyUI] 上传图片失败: {e}")
             return None
+        if not filename:
+            logger.error("[ComfyUI] 上传图片失败")
+            return None
+
+        # 写入 LoadImage 节点：优先使用配置的输入节点，否则使用第一个 LoadImage 节点
+        input_node = None
+        if patch.has_node(self.input_node) and self.template.class_type(self.input_node) == "LoadImage":
+            input_node = self.input_node
+        elif self.template.load_image_nodes:
+            input_node = self.template.load_image_nodes[0]
 
-        # 写入 LoadImage 节点
-        load_image_set = False
-        if self.input_node and self.input_node in workflow:
-            node_data = workflow[self.input_node]
-            if isinstance(node_data, dict) and node_data.get("class_type") == "LoadImage":
-                node_data["inputs"]["image"] = filename
-                load_image_set = True
-
-        if not load_image_set:
-            for node_id, node_data in workflow.items():
-                if isinstance(node_data, dict) and node_data.get("class_type") == "LoadImage":
-                    node_data["inputs"]["image"] = filename
-                    load_image_set = True
-                    break
-
-        if not load_image_set:
+        if input_node is None or not patch.set(input_node, "image", filename):
             logger.error("[ComfyUI] 工作流中未找到 LoadImage 节点")
             return None
 
         # 写入分辨率
-        if size and self.resolution_node and self.resolution_node in workflow:
-            res_node = workflow[self.resolution_node]
-            if isinstance(res_node, dict) and "inputs" in res_node:
-                res_node["inputs"][self.resolution_width_field] = size[0]
-                res_node["inputs"][self.resolution_height_field] = size[1]
+        if size and self.resolution_node and patch.has_node(self.resolution_node):
+            if patch.set(self.resolution_node, self.resolution_width_field, size[0]):
+                patch.set(self.resolution_node, self.resolution_height_field, size[1])
                 logger.info(f"[ComfyUI] 输出分辨率: {size[0]}x{size[1]}")
 
         # 计算最终 fps 与 length：未指定的字段沿用工作流默认值，
         # 然后按 max_frames 上限统一钳制 length
-        fps_default = self._read_node_value(workflow, self.fps_node, self.fps_field)
-        length_default = self._read_node_value(workflow, self.length_node, self.length_field)
+        fps_default = self.template.get_input(self.fps_node, self.fps_field)
+        length_default = self.template.get_input(self.length_node, self.length_field)
 
         final_fps = float(fps) if fps is not None else (float(fps_default) if fps_default is not None else None)
         final_length = float(length) if length is not None else (float(length_default) if length_default is not None else None)
@@ -196,57 +167,51 @@ class ImageToVideo:
                 final_length = max_length
 
         # 写入 fps
-        if fps is not None and self.fps_node and self.fps_node in workflow:
-            fps_node_data = workflow[self.fps_node]
-            if isinstance(fps_node_data, dict) and "inputs" in fps_node_data and final_fps is not None:
-                fps_node_data["inputs"][self.fps_field] = final_fps
+        if fps is not None and final_fps is not None and self.fps_node:
+            if patch.set(self.fps_node, self.fps_field, final_fps):
                 logger.info(f"[ComfyUI] 帧率: {final_fps}")
 
         # 写入视频长度（秒）；即使用户未显式指定 length，只要被 max_frames 钳制了也要写入
-        if final_length is not None and self.length_node and self.length_node in workflow:
-            len_node_data = workflow[self.length_node]
-            if isinstance(len_node_data, dict) and "inputs" in len_node_data:
-                # 只在用户主动设置或被钳制时写入，避免覆盖工作流默认值
-                user_set = length is not None
-                clamped = (length_default is not None and final_length < float(length_default))
-                if user_set or clamped:
-                    len_node_data["inputs"][self.length_field] = max(0.1, final_length)
+        if final_length is not None and self.length_node and patch.has_node(self.length_node):
+            # 只在用户主动设置或被钳制时写入，避免覆盖工作流默认值
+            user_set = length is not None
+            clamped = (length_default is not None and final_length < float(length_default))
+            if user_set or clamped:
+                if patch.set(self.length_node, self.length_field, max(0.1, final_length)):
                     logger.info(f"[ComfyUI] 视频长度: {max(0.1, final_length)}s")
 
         # 设置正面提示词
-        pos_node = workflow.get(self.positive_node)
-        if not pos_node:
+        if not patch.has_node(self.positive_node):
             logger.error(f"[ComfyUI] 找不到正面提示词节点 {self.positive_node}")
             return None
-        if not self._set_prompt(pos_node, prompt):
+        if not patch.set_prompt(self.positive_node, prompt):
             logger.error(f"[ComfyUI] 节点 {self.positive_node} 没有输入字段")
             return None
 
         # 设置负面提示词
-        if self.negative_node and negative:
-            neg_node = workflow.get(self.negative_node)
-            if neg_node:
-                self._set_prompt(neg_node, negative)
+        if self.negative_node and negative and patch.has_node(self.negative_node):
+            patch.set_prompt(self.negative_node, negative)
 
         # 随机化种子
-        base_seed = random.randint(1, 999999999999999)
-        offset = 0
-        for node_data in workflow.values():
-            if isinstance(node_data, dict):
-                inputs = node_data.get("inputs", {})
-                if "seed" in inputs:
-                    inputs["seed"] = base_seed + offset
-                    offset += 1
-                if "noise_seed" in inputs:
-                    inputs["noise_seed"] = base_seed + offset
-                    offset += 1
-
-        result = await self.api.queue_and_wait_video(
-            workflow,
-            max_wait=max_wait,
-            on_wait_callback=on_wait_callback,
-            on_submitted_callback=on_submitted_callback
-        )
+        patch.randomize_seeds()
+        workflow = patch.encode()
+
+        if dest_dir is not None:
+            result = await self.api.queue_and_wait_video_file(
+                workflow, dest_dir,
+                max_wait=max_wait,
+                on_wait_callback=on_wait_callback,
+                on_submitted_callback=on_submitted_callback,
+                owner=owner,
+            )
+        else:
+            result = await self.api.queue_and_wait_video(
+                workflow,
+                max_wait=max_wait,
+                on_wait_callback=on_wait_callback,
+                on_submitted_callback=on_submitted_callback,
+                owner=owner,
+            )
 
         if not result:
             logger.error("[ComfyUI] 图生视频生成失败或等待结果超时")
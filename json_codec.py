@@ -0,0 +1,28 @@
+"""JSON 编解码：安装了 orjson 时使用 orjson，否则回退到标准库 json
+
+dumps 统一返回紧凑的 UTF-8 bytes，可直接作为 HTTP 请求体。
+"""
+import json
+
+try:
+    import orjson
+except ImportError:  # orjson 为可选依赖
+    orjson = None
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+
+def dumps(obj) -> bytes:
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            # orjson 不支持的值（例如超出 64 位的整数），交给标准库处理
+            pass
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
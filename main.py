@@ -1,25 +1,32 @@
+import asyncio
 import base64
+import hashlib
 import json
+import os
 import re
 import shutil
+import tempfile
 import time
-from io import BytesIO
 from pathlib import Path
 from typing import Optional, Tuple
 
 import aiohttp
-from PIL import Image as PILImage
 from astrbot.api import AstrBotConfig, logger
 from astrbot.api.event import filter, AstrMessageEvent
 from astrbot.api.message_components import Reply
 from astrbot.api.star import Context, Star
 from astrbot.core.agent.message import UserMessageSegment, TextPart, ImageURLPart
 
-from .comfyui_api import ComfyUIAPI
+from . import image_processing
+from .comfyui_api import ComfyUIAPI, ComfyUIJobError
+from .image_cache import InputImageCache, ThumbnailCache
+from .image_processing import ImageInfo, ImageProcessor, InputBudget
 from .image_to_image import ImageToImage
 from .image_to_text import ImageToText
 from .image_to_video import ImageToVideo
+from .tag_matcher import SubstringMatcher, TokenMatcher
 from .text_to_image import TextToImage
+from .verdict_cache import ImageVerdictCache, VerdictCache, normalize_text, verdict_key
 
 DRAW_ALIASES = ('draw', '绘图', '文生图', '画图')
 IMG2IMG_ALIASES = ('img2img', '图生图', '图像编辑', 'i2i')
@@ -28,6 +35,12 @@ IMG2VIDEO_ALIASES = ('img2video', '图生视频', '生视频', 'i2v')
 # 用户输入图片下载限制
 MAX_INPUT_IMAGE_BYTES = 20 * 1024 * 1024
 INPUT_IMAGE_TIMEOUT = 30
+# 单个请求同时下载的图片数
+INPUT_DOWNLOAD_CONCURRENCY = 4
+# 单个请求同时进行的输入审查数（每张图片、提示词各一项）
+INPUT_CENSORSHIP_CONCURRENCY = 4
+# 多模态审查缩略图缓存上限
+CENSOR_THUMBNAIL_CACHE_BYTES = 16 * 1024 * 1024
 
 # Discord/Telegram 单文件上限
 PLATFORM_FILE_SIZE_LIMIT = 10 * 1024 * 1024
@@ -65,6 +78,16 @@ def _strip_command_prefix(text: str, aliases: tuple) -> str:
     return text
 
 
+def _input_budget(config, feature: str, default_pixels: int) -> InputBudget:
+    """读取某个功能的输入图片预算配置（{feature}_input_max_pixels / {feature}_input_max_mb）"""
+    fmt = str(config.get("input_resize_format", "png")).upper()
+    return InputBudget(
+        max_pixels=int(config.get(f"{feature}_input_max_pixels", default_pixels)),
+        max_bytes=int(float(config.get(f"{feature}_input_max_mb", 0)) * 1024 * 1024),
+        format="JPEG" if fmt in ("JPG", "JPEG") else ("WEBP" if fmt == "WEBP" else "PNG"),
+    )
+
+
 def _safe_workflow_filename(name: str, default: str) -> str:
     """对工作流文件名做 basename 截断，避免路径穿越"""
     if not name:
@@ -101,7 +124,27 @@ class ComfyUIHub(Star):
 
         server_url = config.get("server_url", "http://127.0.0.1:8188")
         timeout = config.get("timeout", 300)
-        self.api = ComfyUIAPI(server_url, timeout)
+        pool_size = int(config.get("http_pool_size", 16))
+        max_inflight = int(config.get("max_inflight_jobs", 2))
+        self.api = ComfyUIAPI(server_url, timeout, pool_size, max_inflight)
+
+        # 共享的图片处理执行器：PIL 解码/编码不在事件循环中进行
+        self.images = ImageProcessor(
+            int(config.get("image_worker_count", 2)),
+            config.get("image_worker_type", "thread"),
+            int(config.get("image_worker_queue_size", 16)),
+        )
+
+        # 下载用户输入图片的共享会话（首次使用时创建），复用连接
+        self._http: Optional[aiohttp.ClientSession] = None
+        # 输入图片缓存：反复引用同一张图片时不再重新下载
+        self.input_cache = InputImageCache(
+            data_dir / "input_cache",
+            int(float(config.get("input_cache_memory_mb", 64)) * 1024 * 1024),
+            int(float(config.get("input_cache_disk_mb", 256)) * 1024 * 1024),
+            float(config.get("input_cache_ttl", 3600)),
+            MAX_INPUT_IMAGE_BYTES,
+        )
 
         self.txt2img = self._init_txt2img(config, plugin_dir, workflow_dir)
         self.img2txt = self._init_img2txt(config, plugin_dir, workflow_dir)
@@ -115,6 +158,27 @@ class ComfyUIHub(Star):
         self.llm_provider_id = config.get("llm_provider_id", "")
         self.admin_bypass_censorship = config.get("admin_bypass_censorship", True)
         self.censorship_failure_mode = config.get("censorship_failure_mode", "fail_open")
+        # 审查期间预提交生成任务，审查拦截时撤回
+        self.speculative_submission = config.get("speculative_submission", False)
+        # LLM 输入审查结果缓存：重发/重 roll 相同提示词时不再调用 LLM
+        self.text_verdicts = VerdictCache(
+            data_dir / "censorship_verdicts.json",
+            int(config.get("censorship_cache_size", 2048)),
+            float(config.get("censorship_cache_ttl", 86400)),
+        )
+        # 多模态 LLM 图片审查结果缓存：按感知哈希匹配相同或几乎相同的图片
+        self.image_verdicts = ImageVerdictCache(
+            data_dir / "image_censorship_verdicts.json",
+            int(config.get("image_censorship_cache_size", 1024)),
+            float(config.get("image_censorship_cache_ttl", 86400)),
+            int(config.get("image_censorship_hash_distance", 4)),
+        )
+        # 多模态 LLM 审查发送缩略图而不是原图，减小请求体积与 token 消耗
+        self.censor_image_max_edge = int(config.get("censorship_image_max_edge", 768))
+        censor_fmt = str(config.get("censorship_image_format", "jpeg")).upper()
+        self.censor_image_format = "WEBP" if censor_fmt == "WEBP" else "JPEG"
+        self.censor_image_quality = int(config.get("censorship_image_quality", 85))
+        self.censor_thumbnails = ThumbnailCache(CENSOR_THUMBNAIL_CACHE_BYTES)
 
         # 输出图片审查
         self.enable_output_censorship = config.get("enable_output_censorship", False)
@@ -142,6 +206,16 @@ class ComfyUIHub(Star):
             "⚠️ 当前会话未在白名单内，绘图服务暂不可用。",
         )
 
+    async def terminate(self):
+        """插件卸载/停用时保存审查结果缓存，释放 ComfyUI 连接池、图片下载会话与图片处理执行器"""
+        await asyncio.gather(self.text_verdicts.flush(), self.image_verdicts.flush())
+        # 审查缩略图只在内存中；输入图片的磁盘缓存保留到下次启动继续使用
+        self.censor_thumbnails.clear()
+        await self.api.close()
+        if self._http is not None and not self._http.closed:
+            await self._http.close()
+        self.images.shutdown()
+
     def _init_txt2img(self, config, plugin_dir, workflow_dir):
         if not config.get("enable_txt2img", True):
             return None
@@ -187,6 +261,8 @@ class ComfyUIHub(Star):
             str(tagger_workflow_path),
             config.get("tagger_output_node", ""),
             config.get("tagger_input_node", ""),
+            image_processor=self.images,
+            input_budget=_input_budget(config, "tagger", ImageToText.DEFAULT_INPUT_PIXELS),
         )
 
     def _init_img2img(self, config, plugin_dir, workflow_dir):
@@ -213,6 +289,8 @@ class ComfyUIHub(Star):
             config.get("img2img_positive_node", "20"),
             config.get("img2img_negative_node", "21"),
             input_nodes_list,
+            image_processor=self.images,
+            input_budget=_input_budget(config, "img2img", 4 * 1024 * 1024),
         )
 
     def _init_img2video(self, config, plugin_dir, workflow_dir):
@@ -245,6 +323,8 @@ class ComfyUIHub(Star):
             config.get("img2video_length_node", "20"),
             config.get("img2video_length_field", "value"),
             int(config.get("img2video_max_frames", 240)),
+            image_processor=self.images,
+            input_budget=_input_budget(config, "img2video", ImageToVideo.MAX_OUTPUT_PIXELS),
         )
 
     # ----- 数据加载与持久化 -----
@@ -259,6 +339,8 @@ class ComfyUIHub(Star):
 
         self._load_json_set(self.output_block_tags_file, "output_block_tags")
         self._load_json_set(self.block_tags_file, "block_tags")
+        self._block_matcher = SubstringMatcher(self.block_tags)
+        self._output_block_matcher = TokenMatcher(self.output_block_tags)
 
         if self.blocked_users_file.exists():
             try:
@@ -316,10 +398,13 @@ class ComfyUIHub(Star):
         except Exception as e:
             logger.error(f"Error saving {path.name}: {e}")
 
+    # 违规词列表每次修改后都会保存，在此同时重新编译匹配器
     def _save_block_tags(self):
+        self._block_matcher = SubstringMatcher(self.block_tags)
         self._atomic_write_json(self.block_tags_file, list(self.block_tags))
 
     def _save_output_block_tags(self):
+        self._output_block_matcher = TokenMatcher(self.output_block_tags)
         self._atomic_write_json(self.output_block_tags_file, list(self.output_block_tags))
 
     def _save_blocked_users(self):
@@ -439,6 +524,13 @@ class ComfyUIHub(Star):
                 if not provider_id:
                     return True, "No Provider"
 
+            # 相同（规范化后）的提示词在同一审查提示词与模型下直接复用之前的判定
+            cache_key = verdict_key(provider_id, self.censorship_prompt, normalize_text(text))
+            cached = self.text_verdicts.get(cache_key)
+            if cached is not None:
+                logger.info(f"[输入审查] 命中审查缓存: {'通过' if cached else '违规'}")
+                return (True, "") if cached else (False, "AI审查拦截")
+
             llm_resp = await self.context.llm_generate(
                 chat_provider_id=provider_id,
                 prompt=text,
@@ -453,6 +545,7 @@ class ComfyUIHub(Star):
 
             violation = _is_violation(result)
             logger.info(f"[输入审查] 判定结果: {'违规' if violation else '通过'}")
+            self.text_verdicts.put(cache_key, not violation)
 
             if violation:
                 return False, "AI审查拦截"
@@ -462,8 +555,12 @@ class ComfyUIHub(Star):
             return self._on_censorship_error("输入审查", e)
 
     async def _check_image_safety_with_llm(self, event: AstrMessageEvent, image_data: bytes,
-                                           is_img2img_input: bool = False) -> Tuple[bool, str]:
-        """使用多模态 LLM 检查图片安全"""
+                                           is_img2img_input: bool = False,
+                                           image_info: Optional[ImageInfo] = None) -> Tuple[bool, str]:
+        """使用多模态 LLM 检查图片安全
+
+        image_info 为调用方已有的 probe_image 结果，用于确定 MIME 类型
+        """
         try:
             if is_img2img_input:
                 if not self.img2img_input_censorship_use_llm:
@@ -479,15 +576,22 @@ class ComfyUIHub(Star):
                 if not provider_id:
                     return True, "No Provider"
 
+            check_type = "图生图输入" if is_img2img_input else "输出"
+
+            # 输入与输出分开缓存；同一审查提示词与模型下，相同或几乎相同的图片复用之前的判定
+            scope = verdict_key("input" if is_img2img_input else "output",
+                                provider_id, self.output_censorship_prompt)[:16]
+            # 缩略图与感知哈希来自同一次解码
+            image_data, mime_type, image_hash = await self._censor_rendition(image_data, image_info, check_type)
+            if image_hash is not None:
+                cached = self.image_verdicts.find(scope, image_hash)
+                if cached is not None:
+                    logger.info(f"[{check_type}审查] 命中审查缓存: {'通过' if cached else '违规'}")
+                    return (True, "") if cached else (False, "AI审查拦截")
+
             image_base64 = base64.b64encode(image_data).decode('utf-8')
-            try:
-                img = PILImage.open(BytesIO(image_data))
-                mime_type = f"image/{img.format.lower()}"
-            except Exception:
-                mime_type = "image/png"
             image_url = f"data:{mime_type};base64,{image_base64}"
 
-            check_type = "图生图输入" if is_img2img_input else "输出"
             user_msg = UserMessageSegment(content=[
                 TextPart(text="请审查这张图片是否包含违规内容。"),
                 ImageURLPart(image_url=ImageURLPart.ImageURL(url=image_url)),
@@ -507,6 +611,8 @@ class ComfyUIHub(Star):
 
             violation = _is_violation(result)
             logger.info(f"[{check_type}审查] 判定结果: {'违规' if violation else '通过'}")
+            if image_hash is not None:
+                self.image_verdicts.add(scope, image_hash, not violation)
 
             if violation:
                 return False, "AI审查拦截"
@@ -515,6 +621,42 @@ class ComfyUIHub(Star):
         except Exception as e:
             return self._on_censorship_error("图片审查", e)
 
+    async def _censor_rendition(self, image_data: bytes, image_info: Optional[ImageInfo],
+                                check_type: str) -> Tuple[bytes, str, Optional[int]]:
+        """返回发送给多模态 LLM 的图片数据、MIME 类型与感知哈希（审查缓存未启用时为 None）
+
+        长边超过 censorship_image_max_edge 或为动图时发送缩略图；缩略图与感知哈希在执行器中
+        由同一次解码得到，按原图内容哈希缓存。max_edge 为 0 或处理失败时发送原图。
+        """
+        if image_info is None:
+            image_info = self._probe_image(image_data)
+        original_mime = image_info.mime_type if image_info else "image/png"
+        max_edge = self.censor_image_max_edge
+        needs_thumbnail = max_edge > 0 and not (
+            image_info and not image_info.animated and max(image_info.size) <= max_edge)
+        if not needs_thumbnail and not self.image_verdicts.enabled:
+            return image_data, original_mime, None
+
+        key = await asyncio.to_thread(lambda: hashlib.sha256(image_data).hexdigest())
+        entry = self.censor_thumbnails.get(key)
+        if entry is None:
+            try:
+                entry = await self.images.run(image_processing.censor_rendition, image_data, max_edge,
+                                              self.censor_image_format, self.censor_image_quality)
+            except Exception as e:
+                logger.warning(f"[{check_type}审查] 处理审查图片失败，发送原图: {e}")
+                return image_data, original_mime, None
+            self.censor_thumbnails.put(key, *entry)
+            if entry[0] is not None:
+                logger.info(f"[{check_type}审查] 审查缩略图 {len(image_data)} -> {len(entry[0])} 字节")
+
+        thumbnail, image_hash = entry
+        if not self.image_verdicts.enabled:
+            image_hash = None
+        if thumbnail is None:
+            return image_data, original_mime, image_hash
+        return thumbnail, f"image/{self.censor_image_format.lower()}", image_hash
+
     def _resolve_output_censor_options(self, check_type: str) -> tuple:
         """根据 check_type 选择对应的输出审查开关"""
         if check_type == "文生图":
@@ -544,30 +686,103 @@ class ComfyUIHub(Star):
             logger.info(f"[{check_type}] 未开启输出审查或已绕过")
             return True, ""
 
-        if use_tagger and self.img2txt:
-            tags_text = await self.img2txt.generate(image_data)
-            if tags_text:
-                logger.info(f"[{check_type}] 输出图片标签: {tags_text}")
-                is_safe_simple, reason_simple = self._check_simple_tags(tags_text)
-                if not is_safe_simple:
-                    logger.info(f"[{check_type}] 输出图片关键词审查拦截: {reason_simple}")
-                    return False, f"⚠️ 生成的图片{reason_simple}，已被审查系统拒绝。"
-            else:
+        # 文件头只读取一次，tagger 与多模态 LLM 审查共用
+        image_info = self._probe_image(image_data) if (use_tagger and self.img2txt) or use_llm else None
+
+        async def tagger_stage() -> Tuple[bool, str]:
+            try:
+                tags_text = await self.img2txt.generate(image_data, owner=self._job_owner(event),
+                                                        image_info=image_info)
+            except ComfyUIJobError as e:
+                logger.warning(f"[{check_type}] Tagger 任务失败: {e}")
+                tags_text = None
+            if not tags_text:
                 logger.info(f"[{check_type}] Tagger 未返回标签，跳过 tagger 审查")
-        elif use_tagger and not self.img2txt:
-            logger.info(f"[{check_type}] Tagger 不可用，跳过 tagger 审查")
+                return True, ""
+            logger.info(f"[{check_type}] 输出图片标签: {tags_text}")
+            is_safe_simple, reason_simple = self._check_simple_tags(tags_text)
+            if not is_safe_simple:
+                logger.info(f"[{check_type}] 输出图片关键词审查拦截: {reason_simple}")
+                return False, f"⚠️ 生成的图片{reason_simple}，已被审查系统拒绝。"
+            return True, ""
 
-        if use_llm:
-            is_safe, _ = await self._check_image_safety_with_llm(event, image_data, is_img2img_input=False)
+        async def llm_stage() -> Tuple[bool, str]:
+            is_safe, _ = await self._check_image_safety_with_llm(event, image_data, is_img2img_input=False,
+                                                                 image_info=image_info)
             if not is_safe:
                 logger.info(f"[{check_type}] 输出图片多模态LLM审查拦截")
                 return False, "⚠️ 生成的图片包含敏感内容，已被AI审查系统拒绝。"
+            return True, ""
+
+        stages = []
+        if use_tagger and self.img2txt:
+            stages.append(("Tagger", tagger_stage()))
+        elif use_tagger and not self.img2txt:
+            logger.info(f"[{check_type}] Tagger 不可用，跳过 tagger 审查")
+        if use_llm:
+            stages.append(("多模态LLM", llm_stage()))
+
+        is_safe, message = await self._run_censor_stages(check_type, stages)
+        if not is_safe:
+            return False, message
 
         logger.info(f"[{check_type}] 输出图片审查通过")
         return True, ""
 
-    async def _check_img2img_input_censorship(self, event: AstrMessageEvent,
-                                              image_data: bytes) -> Tuple[bool, str]:
+    @staticmethod
+    async def _run_censor_stages(scope: str, stages: list, limit: int = 0) -> Tuple[bool, str]:
+        """并发运行多个审查阶段，任一阶段拦截时取消其余阶段（tagger 任务会从 ComfyUI 队列中撤回）
+
+        Args:
+            stages: [(阶段名称, 协程)]，协程返回 (是否通过, 提示信息)
+            limit: 同时运行的阶段数上限，0 为不限制
+        Returns:
+            全部通过返回 (True, "")，否则返回第一个拦截阶段的结果；同时完成时按 stages 顺序取
+        """
+        if not stages:
+            return True, ""
+        if limit > 0:
+            slots = asyncio.Semaphore(limit)
+
+            async def limited(coro):
+                try:
+                    async with slots:
+                        return await coro
+                finally:
+                    # 排队时被取消的阶段从未开始，关闭协程避免未等待警告
+                    coro.close()
+
+            stages = [(name, limited(coro)) for name, coro in stages]
+        started = time.perf_counter()
+        order = {}
+        for index, (name, coro) in enumerate(stages):
+            order[asyncio.ensure_future(coro)] = (index, name)
+        pending = set(order)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in sorted(done, key=lambda t: order[t][0]):
+                    is_safe, message = task.result()
+                    name = order[task][1]
+                    logger.info(f"[{scope}] {name}审查{'通过' if is_safe else '拦截'}，"
+                                f"耗时 {time.perf_counter() - started:.2f}s")
+                    if not is_safe:
+                        return False, message
+            return True, ""
+        finally:
+            for task in pending:
+                task.cancel()
+            # 等待取消真正完成（例如 tagger 任务从 ComfyUI 队列撤回/中断），再返回结果
+            await asyncio.gather(*pending, return_exceptions=True)
+            for task in pending:
+                logger.info(f"[{scope}] 已取消{order[task][1]}审查")
+            # 同一批完成但未处理的阶段如有异常，标记为已读取
+            for task in order:
+                if task.done() and not task.cancelled():
+                    task.exception()
+
+    async def _check_img2img_input_censorship(self, event: AstrMessageEvent, image_data: bytes,
+                                              image_info: Optional[ImageInfo] = None) -> Tuple[bool, str]:
         """图生图输入图片审查（多模态LLM）"""
         group_id = event.get_group_id()
         is_censorship_enabled = group_id and group_id in self.censored_groups
@@ -579,7 +794,8 @@ class ComfyUIHub(Star):
             return True, ""
 
         if self.img2img_input_censorship_use_llm:
-            is_safe, _ = await self._check_image_safety_with_llm(event, image_data, is_img2img_input=True)
+            is_safe, _ = await self._check_image_safety_with_llm(event, image_data, is_img2img_input=True,
+                                                                 image_info=image_info)
             if not is_safe:
                 logger.info("[图生图] 输入图片多模态LLM审查拦截")
                 return False, "⚠️ 您输入的图片包含敏感内容，已被AI审查系统拒绝。"
@@ -587,6 +803,114 @@ class ComfyUIHub(Star):
         logger.info("[图生图] 输入图片审查通过")
         return True, ""
 
+    async def _run_input_censorship(self, event: AstrMessageEvent, scope: str, image_data_list: list,
+                                    image_infos: list, positive: str) -> Tuple[bool, str, Optional[str]]:
+        """图生图/图生视频的输入审查：每张图片与提示词各作为一个阶段并发审查
+
+        Returns:
+            (是否通过, 拦截提示, 通过时（可能附加 sfw 后缀的）正面提示词)
+        """
+        result = {}
+
+        async def text_stage() -> Tuple[bool, str]:
+            checked, censor_msg = await self._run_input_text_censorship(event, positive)
+            result["positive"] = checked
+            if checked is None:
+                return False, censor_msg or "⚠️ 已被审查系统拒绝。"
+            return True, ""
+
+        # 提示词审查（含本地违规词）最便宜也最常拦截，放在最前面，不排在多模态 LLM 审查之后
+        stages = [("提示词", text_stage())]
+        stages += [
+            (f"第 {i + 1} 张输入图片", self._check_img2img_input_censorship(event, data, info))
+            for i, (data, info) in enumerate(zip(image_data_list, image_infos))
+        ]
+        is_safe, message = await self._run_censor_stages(scope, stages, INPUT_CENSORSHIP_CONCURRENCY)
+        if not is_safe:
+            return False, message, None
+        return True, "", result["positive"]
+
+    def _should_speculate(self, event: AstrMessageEvent, has_images: bool) -> bool:
+        """是否在输入审查期间预提交：需开启配置，且本次请求确实要等待 LLM 审查"""
+        if not self.speculative_submission:
+            return False
+        group_id = event.get_group_id()
+        if not (group_id and group_id in self.censored_groups):
+            return False
+        if event.is_admin() and self.admin_bypass_censorship:
+            return False
+        # 封禁中的用户会被立即拒绝，不提交
+        expire_time = self.blocked_users.get(event.get_sender_id())
+        if expire_time and time.time() < expire_time:
+            return False
+        uses_llm = self.enable_input_censorship and self.input_censorship_use_llm
+        if has_images:
+            uses_llm = uses_llm or (self.enable_img2img_input_censorship and self.img2img_input_censorship_use_llm)
+        return uses_llm
+
+    async def _censor_and_generate(self, event: AstrMessageEvent, scope: str, generating_msg: str,
+                                   image_data_list: list, image_infos: list, positive: str, generate):
+        """输入审查通过后生成；开启 speculative_submission 时审查与生成任务同时进行
+
+        预提交的任务使用审查通过后应得的提示词（追加 sfw 后缀）提交，排队提示等审查通过后才发送；
+        审查拦截时取消任务（ComfyUI 上排队中的删除、运行中的中断），结果丢弃。
+
+        Args:
+            generate: (正面提示词, on_wait_callback, on_submitted_callback) -> 生成协程
+        Returns:
+            (拦截提示, 生成结果)：审查通过时拦截提示为 None
+        """
+        on_wait, on_submitted = self._make_queue_callbacks(event, generating_msg)
+        censor = self._run_input_censorship(event, scope, image_data_list, image_infos, positive)
+        if not self._should_speculate(event, bool(image_data_list)):
+            is_safe, message, positive = await censor
+            if not is_safe:
+                return message, None
+            return None, await generate(positive, on_wait, on_submitted)
+
+        predicted = self._with_sfw_suffix(positive) if self.enable_input_censorship else positive
+        approved = False
+        held = []
+
+        async def gated_wait(*args):
+            if approved:
+                await on_wait(*args)
+
+        async def gated_submitted(*args):
+            if approved:
+                await on_submitted(*args)
+            else:
+                held[:] = [args]
+
+        task = asyncio.ensure_future(generate(predicted, gated_wait, gated_submitted))
+        logger.info(f"[{scope}] 已预提交生成任务，与输入审查并行")
+        try:
+            is_safe, message, positive = await censor
+        except BaseException:
+            await self._discard_speculative(task)
+            raise
+        if not is_safe:
+            await self._discard_speculative(task)
+            logger.info(f"[{scope}] 输入审查拦截，已撤回预提交的任务")
+            return message, None
+        if positive != predicted:
+            await self._discard_speculative(task)
+            logger.info(f"[{scope}] 审查后的提示词与预提交的不一致，重新提交")
+            return None, await generate(positive, on_wait, on_submitted)
+
+        approved = True
+        if held and not task.done():
+            await on_submitted(*held[0])
+        return None, await task
+
+    @staticmethod
+    async def _discard_speculative(task: asyncio.Future):
+        """取消预提交的生成任务并丢弃结果（已写入磁盘的结果文件一并删除）"""
+        task.cancel()
+        result = (await asyncio.gather(task, return_exceptions=True))[0]
+        if isinstance(result, Path):
+            result.unlink(missing_ok=True)
+
     async def _run_input_text_censorship(self, event: AstrMessageEvent, positive: str) -> Tuple[Optional[str], Optional[str]]:
         """对正面提示词跑一遍（封禁检查 + block tag + LLM）输入审查
 
@@ -615,12 +939,12 @@ class ComfyUIHub(Star):
         if not (is_censorship_enabled and not should_bypass_censorship and self.enable_input_censorship):
             return positive, None
 
-        # 本地 block tag
-        for tag in self.block_tags:
-            if tag.lower() in positive.lower():
-                self.blocked_users[user_id] = current_time + 120
-                self._save_blocked_users()
-                return None, f"⚠️ 违规：检测到敏感词 '{tag}'。您将被禁服务 2 分钟。"
+        # 本地 block tag（预编译的多模式匹配，一次扫描）
+        tag = self._block_matcher.search(positive)
+        if tag is not None:
+            self.blocked_users[user_id] = current_time + 120
+            self._save_blocked_users()
+            return None, f"⚠️ 违规：检测到敏感词 '{tag}'。您将被禁服务 2 分钟。"
 
         # LLM 审查
         if self.input_censorship_use_llm:
@@ -631,28 +955,20 @@ class ComfyUIHub(Star):
                 logger.info("LLM 审查拦截")
                 return None, "⚠️ 您的请求包含敏感内容，已被AI审查系统拒绝。您将被禁服务 2 分钟。"
 
-        # 自动追加 sfw
+        return self._with_sfw_suffix(positive), None
+
+    @staticmethod
+    def _with_sfw_suffix(positive: str) -> str:
+        """通过输入审查的提示词自动追加 sfw"""
         if "sfw" not in positive.lower() and "safe" not in positive.lower():
             positive = (positive + ", sfw, safe for work").strip(", ")
-        return positive, None
+        return positive
 
     def _check_simple_tags(self, tags_text: str) -> tuple:
-        """精确匹配 tag token，避免子串误命中（man → woman/human）"""
-        tags = [tag.strip().lower() for tag in tags_text.split(',')]
-        block_lower = {kw.lower() for kw in self.output_block_tags}
-        for tag in tags:
-            tokens = re.split(r'[\s_]+', tag)
-            for keyword in block_lower:
-                # 允许 keyword 自身含空格/下划线，作为整体匹配
-                kw_tokens = re.split(r'[\s_]+', keyword) if (' ' in keyword or '_' in keyword) else None
-                if kw_tokens:
-                    # 子序列匹配
-                    n = len(kw_tokens)
-                    for i in range(len(tokens) - n + 1):
-                        if tokens[i:i + n] == kw_tokens:
-                            return False, f"检测到敏感内容 '{keyword}'"
-                elif keyword in tokens:
-                    return False, f"检测到敏感内容 '{keyword}'"
+        """精确匹配 tag token，避免子串误命中（man → woman/human），见 TokenMatcher"""
+        keyword = self._output_block_matcher.search(tags_text)
+        if keyword is not None:
+            return False, f"检测到敏感内容 '{keyword}'"
         return True, ""
 
     # ----- 参数解析 -----
@@ -722,6 +1038,14 @@ class ComfyUIHub(Star):
 
     # ----- 队列回调工厂 -----
 
+    @staticmethod
+    def _job_owner(event: AstrMessageEvent) -> tuple:
+        """调度器公平排队用的 (群标识, 用户标识)；私聊各自视为独立的群"""
+        user_id = str(event.get_sender_id() or "")
+        group_id = event.get_group_id()
+        group_key = f"group:{group_id}" if group_id else f"private:{user_id}"
+        return group_key, user_id
+
     def _make_queue_callbacks(self, event: AstrMessageEvent, generating_msg: str):
         async def on_queue_wait(running_count: int, pending_count: int, waited: float):
             await self._send_text_message(
@@ -743,32 +1067,49 @@ class ComfyUIHub(Star):
     # ----- 图片下载 / 压缩 -----
 
     @staticmethod
-    async def _get_image_data(image_component) -> Optional[bytes]:
-        """从 Image 组件获取图片数据，带超时和大小限制"""
+    def _probe_image(image_data: bytes) -> Optional[ImageInfo]:
+        """读取图片文件头（格式、尺寸、帧数），无法识别时返回 None"""
+        try:
+            return image_processing.probe_image(image_data)
+        except Exception as e:
+            logger.warning(f"读取图片信息失败: {e}")
+            return None
+
+    def _http_session(self) -> aiohttp.ClientSession:
+        if self._http is None or self._http.closed:
+            self._http = aiohttp.ClientSession()
+        return self._http
+
+    async def _download_image(self, url: str) -> Optional[bytes]:
+        """下载图片，带超时和大小限制"""
+        timeout = aiohttp.ClientTimeout(total=INPUT_IMAGE_TIMEOUT)
+        async with self._http_session().get(url, timeout=timeout) as resp:
+            if resp.status != 200:
+                return None
+            # 通过 Content-Length 提前拒绝
+            content_length = resp.headers.get("Content-Length")
+            if content_length and int(content_length) > MAX_INPUT_IMAGE_BYTES:
+                logger.error(
+                    f"图片过大 ({content_length} 字节)，拒绝下载"
+                )
+                return None
+            # 按 chunk 累加，超过限制中断
+            buffer = bytearray()
+            async for chunk in resp.content.iter_chunked(64 * 1024):
+                buffer.extend(chunk)
+                if len(buffer) > MAX_INPUT_IMAGE_BYTES:
+                    logger.error(
+                        f"图片下载超过 {MAX_INPUT_IMAGE_BYTES} 字节限制，已中断"
+                    )
+                    return None
+            return bytes(buffer)
+
+    async def _get_image_data(self, image_component) -> Optional[bytes]:
+        """从 Image 组件获取图片数据（URL 优先走输入图片缓存），带超时和大小限制"""
         try:
             if hasattr(image_component, 'url') and image_component.url:
-                timeout = aiohttp.ClientTimeout(total=INPUT_IMAGE_TIMEOUT)
-                async with aiohttp.ClientSession(timeout=timeout) as session:
-                    async with session.get(image_component.url) as resp:
-                        if resp.status != 200:
-                            return None
-                        # 通过 Content-Length 提前拒绝
-                        content_length = resp.headers.get("Content-Length")
-                        if content_length and int(content_length) > MAX_INPUT_IMAGE_BYTES:
-                            logger.error(
-                                f"图片过大 ({content_length} 字节)，拒绝下载"
-                            )
-                            return None
-                        # 按 chunk 累加，超过限制中断
-                        buffer = bytearray()
-                        async for chunk in resp.content.iter_chunked(64 * 1024):
-                            buffer.extend(chunk)
-                            if len(buffer) > MAX_INPUT_IMAGE_BYTES:
-                                logger.error(
-                                    f"图片下载超过 {MAX_INPUT_IMAGE_BYTES} 字节限制，已中断"
-                                )
-                                return None
-                        return bytes(buffer)
+                url = image_component.url
+                return await self.input_cache.fetch(url, lambda: self._download_image(url))
         except Exception as e:
             logger.error(f"通过URL获取图片失败: {e}")
 
@@ -786,11 +1127,20 @@ class ComfyUIHub(Star):
 
         return None
 
-    def _maybe_compress_for_platform(self, image_data: bytes, platform_name: str) -> Tuple[Path, Optional[str]]:
-        """对超大图片做平台限制下的压缩，返回 (临时文件路径, 警告信息或 None)"""
-        temp_file = self.temp_dir / f"{int(time.time())}.png"
-        with open(temp_file, "wb") as f:
-            f.write(image_data)
+    def _write_temp_file(self, data: bytes, suffix: str) -> Path:
+        """（线程中）写入 temp_dir 下唯一命名的临时文件，并发完成的任务不会互相覆盖"""
+        fd, path = tempfile.mkstemp(prefix="comfyui_", suffix=suffix, dir=str(self.temp_dir))
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        return Path(path)
+
+    async def _maybe_compress_for_platform(self, image_data: bytes, platform_name: str) -> Tuple[Path, Optional[str]]:
+        """对超大图片做平台限制下的压缩，返回 (临时文件路径, 警告信息或 None)
+
+        按目标体积搜索 WebP 质量与缩放（见 ImageProcessor.fit_to_size），
+        编码在图片处理执行器中进行，临时文件在线程中写入，均不阻塞事件循环。
+        """
+        temp_file = await asyncio.to_thread(self._write_temp_file, image_data, ".png")
 
         if platform_name not in SIZE_LIMITED_PLATFORMS:
             return temp_file, None
@@ -802,36 +1152,24 @@ class ComfyUIHub(Star):
         size_mb = file_size / (1024 * 1024)
         logger.info(f"图片大小 {size_mb:.1f}MB 超过限制，尝试压缩...")
 
+        started = time.perf_counter()
         try:
-            img = PILImage.open(BytesIO(image_data))
+            result = await self.images.fit_to_size(image_data, PLATFORM_FILE_SIZE_LIMIT)
         except Exception as e:
             logger.error(f"图片压缩失败: {e}")
             return temp_file, f"⚠️ 警告：生成的图片为 {size_mb:.1f}MB，超过平台默认 10MB 限制，压缩失败"
+        elapsed = time.perf_counter() - started
 
-        # 依次尝试 WebP90 → AVIF85 → WebP 80/70/60/50
-        attempts = [
-            ('WEBP', 90, '.webp'),
-            ('AVIF', 85, '.avif'),
-            ('WEBP', 80, '.webp'),
-            ('WEBP', 70, '.webp'),
-            ('WEBP', 60, '.webp'),
-            ('WEBP', 50, '.webp'),
-        ]
-        for fmt, quality, ext in attempts:
-            try:
-                buffer = BytesIO()
-                img.save(buffer, format=fmt, quality=quality)
-                if buffer.tell() <= PLATFORM_FILE_SIZE_LIMIT:
-                    new_temp = self.temp_dir / f"{int(time.time())}{ext}"
-                    with open(new_temp, "wb") as f:
-                        f.write(buffer.getvalue())
-                    final_mb = buffer.tell() / (1024 * 1024)
-                    logger.info(f"成功压缩为 {fmt}（quality={quality}），大小 {final_mb:.1f}MB")
-                    return new_temp, None
-            except Exception as e:
-                logger.error(f"{fmt}(quality={quality}) 压缩失败: {e}")
-                continue
+        if result:
+            new_temp = await asyncio.to_thread(self._write_temp_file, result.data, result.ext)
+            final_mb = len(result.data) / (1024 * 1024)
+            logger.info(
+                f"成功压缩为 {result.format}（quality={result.quality}，缩放 {result.scale:.2f}），"
+                f"大小 {final_mb:.1f}MB，编码 {result.encodes} 次，耗时 {elapsed:.2f}s"
+            )
+            return new_temp, None
 
+        logger.info(f"压缩后仍超过限制，耗时 {elapsed:.2f}s")
         return temp_file, f"⚠️ 警告：原图 {size_mb:.1f}MB，压缩后仍超过 10MB 限制，可能无法发送"
 
     # ----- 子命令分发（管理员） -----
@@ -860,6 +1198,16 @@ class ComfyUIHub(Star):
                 self._save_censorship()
             return True, "✅ 已在当前群组关闭审查功能。"
 
+        if text.startswith('$flush_censorship_cache'):
+            count = self.text_verdicts.clear()
+            image_count = self.image_verdicts.clear()
+            self.censor_thumbnails.clear()
+            return True, f"✅ 已清空审查结果缓存（文本 {count} 条，图片 {image_count} 条）。"
+
+        if text.startswith('$flush_input_cache'):
+            await self.input_cache.clear()
+            return True, "✅ 已清空输入图片缓存（内存与磁盘）。"
+
         if text.startswith('$add_block_tag'):
             tags_part = text[len('$add_block_tag'):].strip()
             new_tags = self._parse_tag_list(tags_part)
@@ -944,26 +1292,34 @@ class ComfyUIHub(Star):
     # ----- 提取消息中的图片 -----
 
     async def _collect_images_from_event(self, event: AstrMessageEvent, take_first_only: bool = False) -> list:
-        """从消息（含 Reply）中收集图片数据"""
+        """从消息（含 Reply）中收集图片数据
+
+        多张图片并发下载（每个请求最多 INPUT_DOWNLOAD_CONCURRENCY 个），结果保持消息中的顺序；
+        take_first_only 时按顺序逐个尝试，返回第一张成功获取的图片。
+        """
         from astrbot.api.message_components import Image as ImageComponent, Reply as ReplyComponent
-        chain = event.get_messages()
-        images = []
-        for msg in chain:
+        components = []
+        for msg in event.get_messages():
             if isinstance(msg, ReplyComponent) and msg.chain:
-                for chain_msg in msg.chain:
-                    if isinstance(chain_msg, ImageComponent):
-                        data = await self._get_image_data(chain_msg)
-                        if data:
-                            images.append(data)
-                            if take_first_only:
-                                return images
+                components.extend(m for m in msg.chain if isinstance(m, ImageComponent))
             elif isinstance(msg, ImageComponent):
-                data = await self._get_image_data(msg)
+                components.append(msg)
+
+        if take_first_only:
+            for component in components:
+                data = await self._get_image_data(component)
                 if data:
-                    images.append(data)
-                    if take_first_only:
-                        return images
-        return images
+                    return [data]
+            return []
+
+        slots = asyncio.Semaphore(INPUT_DOWNLOAD_CONCURRENCY)
+
+        async def fetch(component):
+            async with slots:
+                return await self._get_image_data(component)
+
+        results = await asyncio.gather(*(fetch(c) for c in components))
+        return [data for data in results if data]
     # ----- 命令：文生图 -----
 
     @filter.command("draw", alias=set(DRAW_ALIASES[1:]))
@@ -994,21 +1350,29 @@ class ComfyUIHub(Star):
 
         positive, negative, chain, width, height, scale = self._parse_params(text)
 
-        positive, censor_msg = await self._run_input_text_censorship(event, positive)
-        if positive is None:
-            yield event.plain_result(censor_msg or "⚠️ 已被审查系统拒绝。")
-            return
-
         if not positive:
             yield event.plain_result("请输入正面提示词")
             return
 
-        on_wait, on_submitted = self._make_queue_callbacks(event, "正在生成图片...")
-        image_data = await self.txt2img.generate(
-            positive, negative, width, height, scale,
-            on_wait_callback=on_wait,
-            on_submitted_callback=on_submitted,
-        )
+        def generate(checked_positive, on_wait, on_submitted):
+            return self.txt2img.generate(
+                checked_positive, negative, width, height, scale,
+                on_wait_callback=on_wait,
+                on_submitted_callback=on_submitted,
+                owner=self._job_owner(event),
+            )
+
+        try:
+            censor_msg, image_data = await self._censor_and_generate(
+                event, "文生图", "正在生成图片...", [], [], positive, generate)
+        except ComfyUIJobError as e:
+            logger.error(f"[文生图] {e}")
+            yield event.plain_result(f"生成失败：{e}")
+            return
+
+        if censor_msg:
+            yield event.plain_result(censor_msg)
+            return
 
         if not image_data:
             yield event.plain_result("生成失败")
@@ -1019,7 +1383,7 @@ class ComfyUIHub(Star):
             yield event.plain_result(message)
             return
 
-        temp_file, warn = self._maybe_compress_for_platform(image_data, event.get_platform_name())
+        temp_file, warn = await self._maybe_compress_for_platform(image_data, event.get_platform_name())
         if warn:
             yield event.plain_result(warn)
 
@@ -1112,13 +1476,21 @@ class ComfyUIHub(Star):
 
         image_data = images[0]
         logger.info(f"成功获取图片数据，大小: {len(image_data)} 字节")
+        image_info = self._probe_image(image_data)
 
         on_wait, on_submitted = self._make_queue_callbacks(event, "正在识别图片标签...")
-        result_text = await self.img2txt.generate(
-            image_data,
-            on_wait_callback=on_wait,
-            on_submitted_callback=on_submitted,
-        )
+        try:
+            result_text = await self.img2txt.generate(
+                image_data,
+                on_wait_callback=on_wait,
+                on_submitted_callback=on_submitted,
+                owner=self._job_owner(event),
+                image_info=image_info,
+            )
+        except ComfyUIJobError as e:
+            logger.error(f"[标签识别] {e}")
+            yield event.plain_result(f"识别失败：{e}")
+            return
         logger.info(f"标签识别结果: {result_text}")
 
         if not result_text:
@@ -1163,25 +1535,30 @@ class ComfyUIHub(Star):
             f"{', '.join(f'{len(d)} 字节' for d in image_data_list)}"
         )
 
-        # 输入图片审查
-        for img_data in image_data_list:
-            is_safe, message = await self._check_img2img_input_censorship(event, img_data)
-            if not is_safe:
-                yield event.plain_result(message)
-                return
+        # 每张图片只读取一次文件头，审查与生成共用
+        image_infos = [self._probe_image(d) for d in image_data_list]
+
+        def generate(checked_positive, on_wait, on_submitted):
+            return self._img2img_engine.generate(
+                image_data_list, checked_positive, negative,
+                on_wait_callback=on_wait,
+                on_submitted_callback=on_submitted,
+                owner=self._job_owner(event),
+                image_infos=image_infos,
+            )
 
-        # 输入文本审查
-        positive, censor_msg = await self._run_input_text_censorship(event, positive)
-        if positive is None:
-            yield event.plain_result(censor_msg or "⚠️ 已被审查系统拒绝。")
+        # 输入图片与文本审查并发进行，任一项拦截即取消其余
+        try:
+            censor_msg, result_image = await self._censor_and_generate(
+                event, "图生图", "正在生成图片...", image_data_list, image_infos, positive, generate)
+        except ComfyUIJobError as e:
+            logger.error(f"[图生图] {e}")
+            yield event.plain_result(f"生成失败：{e}")
             return
 
-        on_wait, on_submitted = self._make_queue_callbacks(event, "正在生成图片...")
-        result_image = await self._img2img_engine.generate(
-            image_data_list, positive, negative,
-            on_wait_callback=on_wait,
-            on_submitted_callback=on_submitted,
-        )
+        if censor_msg:
+            yield event.plain_result(censor_msg)
+            return
 
         if not result_image:
             yield event.plain_result("生成失败")
@@ -1192,7 +1569,7 @@ class ComfyUIHub(Star):
             yield event.plain_result(message)
             return
 
-        temp_file, warn = self._maybe_compress_for_platform(result_image, event.get_platform_name())
+        temp_file, warn = await self._maybe_compress_for_platform(result_image, event.get_platform_name())
         if warn:
             yield event.plain_result(warn)
 
@@ -1251,32 +1628,36 @@ class ComfyUIHub(Star):
             f"提示词: {positive or '(空)'}, fps={fps_value}, length={length_value}"
         )
 
-        is_safe, message = await self._check_img2img_input_censorship(event, image_data)
-        if not is_safe:
-            yield event.plain_result(message)
-            return
+        image_info = self._probe_image(image_data)
+
+        def generate(checked_positive, on_wait, on_submitted):
+            # 视频直接流式写入临时目录，不在内存中整体保存
+            return self._img2video_engine.generate(
+                image_data, checked_positive, negative,
+                fps=fps_value, length=length_value,
+                on_wait_callback=on_wait,
+                on_submitted_callback=on_submitted,
+                owner=self._job_owner(event),
+                dest_dir=self.temp_dir,
+                image_info=image_info,
+            )
 
-        positive, censor_msg = await self._run_input_text_censorship(event, positive)
-        if positive is None:
-            yield event.plain_result(censor_msg or "⚠️ 已被审查系统拒绝。")
+        try:
+            censor_msg, temp_file = await self._censor_and_generate(
+                event, "图生视频", "正在生成视频...", [image_data], [image_info], positive, generate)
+        except ComfyUIJobError as e:
+            logger.error(f"[图生视频] {e}")
+            yield event.plain_result(f"生成失败：{e}")
             return
 
-        on_wait, on_submitted = self._make_queue_callbacks(event, "正在生成视频...")
-        video_data = await self._img2video_engine.generate(
-            image_data, positive, negative,
-            fps=fps_value, length=length_value,
-            on_wait_callback=on_wait,
-            on_submitted_callback=on_submitted,
-        )
+        if censor_msg:
+            yield event.plain_result(censor_msg)
+            return
 
-        if not video_data:
+        if not temp_file:
             yield event.plain_result("生成失败")
             return
 
-        temp_file = self.temp_dir / f"{int(time.time())}.mp4"
-        with open(temp_file, "wb") as f:
-            f.write(video_data)
-
         if event.get_platform_name() == "aiocqhttp":
             try:
                 await self._call_send_api(event, f"[CQ:video,file=file://{temp_file}]")
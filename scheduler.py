@@ -0,0 +1,182 @@
+import asyncio
+from collections import OrderedDict, deque
+from typing import Callable, Optional
+
+
+class _Ticket:
+    __slots__ = ("group", "user", "future")
+
+    def __init__(self, group: str, user: str, future: asyncio.Future):
+        self.group = group
+        self.user = user
+        self.future = future
+
+
+class JobScheduler:
+    """本插件任务的并发调度器
+
+    同一时刻最多 capacity 个本插件任务在 ComfyUI 上（排队或运行），让 ComfyUI 自身队列
+    始终有下一个任务可接，GPU 不会在两个任务之间空等。超出的任务在本地排队：
+    先在群之间轮转，再在群内用户之间轮转，避免单个群/用户刷屏占满队列。
+    名额空出时直接唤醒下一个任务，不需要轮询 ComfyUI。
+    """
+
+    # 排队中每隔多久通知一次用户（秒）
+    NOTIFY_INTERVAL = 60.0
+    # 排队中重新检查容量的最长间隔（后端恢复会使容量变大）
+    RECHECK_INTERVAL = 10.0
+
+    def __init__(self, capacity_fn: Callable[[], int]):
+        self._capacity_fn = capacity_fn
+        self._inflight = 0
+        # group -> OrderedDict(user -> deque[_Ticket])，两层的插入顺序即轮转顺序
+        self._waiting: OrderedDict = OrderedDict()
+
+    @property
+    def inflight(self) -> int:
+        return self._inflight
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(q) for users in self._waiting.values() for q in users.values())
+
+    def _capacity(self) -> int:
+        try:
+            return max(1, int(self._capacity_fn()))
+        except Exception:
+            return 1
+
+    def _enqueue(self, ticket: _Ticket):
+        users = self._waiting.setdefault(ticket.group, OrderedDict())
+        users.setdefault(ticket.user, deque()).append(ticket)
+
+    def _remove(self, ticket: _Ticket):
+        users = self._waiting.get(ticket.group)
+        if not users:
+            return
+        queue = users.get(ticket.user)
+        if queue is None:
+            return
+        try:
+            queue.remove(ticket)
+        except ValueError:
+            pass
+        if not queue:
+            del users[ticket.user]
+        if not users:
+            del self._waiting[ticket.group]
+
+    def _pop_next(self) -> Optional[_Ticket]:
+        """按轮转顺序取出下一个票据：取队首群的队首用户，取完后两者都移到队尾"""
+        while self._waiting:
+            group, users = next(iter(self._waiting.items()))
+            user, queue = next(iter(users.items()))
+            ticket = queue.popleft()
+            if queue:
+                users.move_to_end(user)
+            else:
+                del users[user]
+            if users:
+                self._waiting.move_to_end(group)
+            else:
+                del self._waiting[group]
+            if not ticket.future.done():
+                return ticket
+        return None
+
+    def _grant_order(self) -> list:
+        """按与 _pop_next 相同的规则模拟出完整的放行顺序（不修改状态）"""
+        groups = deque(deque(deque(q) for q in users.values()) for users in self._waiting.values())
+        order = []
+        while groups:
+            users = groups.popleft()
+            queue = users.popleft()
+            order.append(queue.popleft())
+            if queue:
+                users.append(queue)
+            if users:
+                groups.append(users)
+        return order
+
+    def position(self, ticket: _Ticket) -> int:
+        """票据前方还有多少个本地排队的任务"""
+        for index, item in enumerate(self._grant_order()):
+            if item is ticket:
+                return index
+        return 0
+
+    def _dispatch(self):
+        """在容量允许的范围内依次放行排队中的任务"""
+        capacity = self._capacity()
+        while self._inflight < capacity:
+            ticket = self._pop_next()
+            if ticket is None:
+                break
+            self._inflight += 1
+            ticket.future.set_result(True)
+
+    def release(self):
+        """任务结束（完成、失败或取消）后归还名额"""
+        self._inflight = max(0, self._inflight - 1)
+        self._dispatch()
+
+    async def acquire(self, owner: Optional[tuple] = None, max_wait: float = 300.0,
+                      on_wait_callback=None) -> float:
+        """申请一个名额，返回排队等待的秒数
+
+        超过 max_wait 仍未轮到时不再等待，直接占用名额提交，由 ComfyUI 自身队列接管排队。
+
+        Args:
+            owner: (群标识, 用户标识)，用于公平轮转；None 视为同一个匿名来源
+            max_wait: 最大排队秒数
+            on_wait_callback: async (running: int, pending: int, waited: float) -> None，
+                              首次排队立即调用，之后每分钟调用一次；pending 为前方任务数
+                              （本插件运行中的任务 + 本地排在前面的任务）
+        """
+        from astrbot.api import logger
+
+        if self._inflight < self._capacity() and not self._waiting:
+            self._inflight += 1
+            return 0.0
+
+        group, user = owner if owner else ("", "")
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        ticket = _Ticket(str(group), str(user), loop.create_future())
+        self._enqueue(ticket)
+        self._dispatch()
+        last_notify = None
+        try:
+            while not ticket.future.done():
+                waited = loop.time() - start
+                if waited >= max_wait:
+                    self._remove(ticket)
+                    self._inflight += 1
+                    logger.warning(f"[ComfyUI] 调度排队超时（{max_wait:.0f}s），放弃排队直接提交任务")
+                    return waited
+
+                if on_wait_callback and (last_notify is None or waited - last_notify >= self.NOTIFY_INTERVAL):
+                    last_notify = waited
+                    ahead = self.position(ticket)
+                    logger.info(f"[ComfyUI] 任务排队中 (本插件进行中: {self._inflight}, 前方排队: {ahead}, 已等待: {waited:.0f}s)")
+                    try:
+                        await on_wait_callback(self._inflight, self._inflight + ahead, waited)
+                    except Exception as e:
+                        logger.error(f"[ComfyUI] 队列等待回调异常: {e}")
+                    continue
+
+                next_notify = (last_notify + self.NOTIFY_INTERVAL - waited) if last_notify is not None else self.RECHECK_INTERVAL
+                timeout = max(0.0, min(max_wait - waited, next_notify, self.RECHECK_INTERVAL))
+                try:
+                    await asyncio.wait_for(asyncio.shield(ticket.future), timeout=timeout)
+                except asyncio.TimeoutError:
+                    self._dispatch()
+            return loop.time() - start
+        except asyncio.CancelledError:
+            if ticket.future.done() and not ticket.future.cancelled():
+                # 名额已经放行给本任务，但任务被取消：归还名额
+                self.release()
+            else:
+                self._remove(ticket)
+                ticket.future.cancel()
+            raise
@@ -0,0 +1,99 @@
+import re
+from typing import Iterable, Optional
+
+_TOKEN_SPLIT = re.compile(r'[\s_]+')
+
+
+class SubstringMatcher:
+    """Aho-Corasick 自动机：一次扫描判断文本中是否出现任一违规词（忽略大小写的子串匹配）
+
+    违规词列表变化时重新构建，匹配耗时只与文本长度有关，与违规词数量无关。
+    """
+
+    def __init__(self, patterns: Iterable[str]):
+        # 小写模式串 -> 原始违规词（用于提示）
+        originals = {}
+        for pattern in patterns:
+            originals.setdefault(pattern.lower(), pattern)
+        # 空字符串是任何文本的子串
+        self._empty = originals.get("")
+        self._goto = [{}]
+        self._fail = [0]
+        self._out: list = [None]
+
+        for lowered, original in originals.items():
+            if not lowered:
+                continue
+            state = 0
+            for ch in lowered:
+                nxt = self._goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(None)
+                state = nxt
+            self._out[state] = original
+
+        # 按层遍历建立失配指针；某状态没有自己的输出时继承失配状态的输出
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for ch, nxt in self._goto[state].items():
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fallback = self._goto[fail].get(ch, 0)
+                self._fail[nxt] = fallback if fallback != nxt else 0
+                if self._out[nxt] is None:
+                    self._out[nxt] = self._out[self._fail[nxt]]
+                queue.append(nxt)
+
+    def search(self, text: str) -> Optional[str]:
+        """返回文本中出现的第一个违规词（原始写法），没有则返回 None"""
+        if self._empty is not None:
+            return self._empty
+        goto, fail, out = self._goto, self._fail, self._out
+        state = 0
+        for ch in text.lower():
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state] is not None:
+                return out[state]
+        return None
+
+
+class TokenMatcher:
+    """按 tag token 精确匹配违规词，避免子串误命中（man → woman/human）
+
+    tags 文本按逗号分为多个 tag，每个 tag 再按空格/下划线分为 token；
+    违规词自身含空格/下划线时按 token 序列整体匹配（在同一个 tag 内连续出现），否则匹配单个 token。
+    违规词预先构建为 token 前缀树，每个 token 位置只需沿树向下查找。
+    """
+
+    def __init__(self, keywords: Iterable[str]):
+        # token -> 子节点，None 键保存在此结束的违规词
+        self._root: dict = {}
+        for keyword in {kw.lower() for kw in keywords}:
+            tokens = _TOKEN_SPLIT.split(keyword) if (' ' in keyword or '_' in keyword) else [keyword]
+            node = self._root
+            for token in tokens:
+                node = node.setdefault(token, {})
+            node[None] = keyword
+
+    def search(self, tags_text: str) -> Optional[str]:
+        """返回命中的违规词（小写），没有则返回 None"""
+        if not self._root:
+            return None
+        for tag in tags_text.split(','):
+            tokens = _TOKEN_SPLIT.split(tag.strip().lower())
+            for start in range(len(tokens)):
+                node = self._root
+                for token in tokens[start:]:
+                    node = node.get(token)
+                    if node is None:
+                        break
+                    if None in node:
+                        return node[None]
+        return None
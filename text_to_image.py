@@ -1,11 +1,10 @@
-import json
 import math
-import random
 from typing import Optional
 
 from astrbot.api import logger
 
 from .comfyui_api import ComfyUIAPI
+from .workflow_template import WorkflowTemplate
 
 
 class TextToImage:
@@ -19,7 +18,8 @@ class TextToImage:
                  resolution_node: str = "", width_field: str = "width", height_field: str = "height",
                  upscale_node: str = "", scale_field: str = "resize_scale"):
         self.api = api
-        self.workflow = self._load_workflow(workflow_path)
+        self.template = WorkflowTemplate.load(workflow_path)
+        self.workflow = self.template.workflow
         self.positive_node = positive_node
         self.negative_node = negative_node
         self.resolution_node = resolution_node
@@ -28,26 +28,6 @@ class TextToImage:
         self.upscale_node = upscale_node
         self.scale_field = scale_field
 
-    @staticmethod
-    def _load_workflow(path: str) -> dict:
-        """加载工作流文件"""
-        with open(path, 'r', encoding='utf-8') as f:
-            return json.load(f)
-
-    @staticmethod
-    def _set_prompt(node: dict, prompt: str) -> bool:
-        """设置提示词到节点的第一个输入字段"""
-        if not node or "inputs" not in node:
-            return False
-
-        inputs = node["inputs"]
-        if not inputs:
-            return False
-
-        first_key = next(iter(inputs))
-        inputs[first_key] = prompt
-        return True
-
     @classmethod
     def _clamp_dimensions(cls, width: int, height: int) -> tuple:
         """将用户传入的 width/height 钳制到合法范围内并按 ALIGN 对齐"""
@@ -66,22 +46,24 @@ class TextToImage:
         return w, h
 
     async def generate(self, prompt: str, negative: str = "bad hands", width: int = None, height: int = None,
-                       scale: float = None, max_wait: float = 300.0, on_wait_callback=None, on_submitted_callback=None) -> Optional[bytes]:
-        """生成图片"""
-        workflow = json.loads(json.dumps(self.workflow))
+                       scale: float = None, max_wait: float = 300.0, on_wait_callback=None, on_submitted_callback=None,
+                       owner: Optional[tuple] = None) -> Optional[bytes]:
+        """生成图片
 
-        pos_node = workflow.get(self.positive_node)
-        if not pos_node:
+        owner 为 (群标识, 用户标识)，供调度器做公平排队
+        """
+        patch = self.template.new_request()
+
+        if not patch.has_node(self.positive_node):
             logger.error(f"[ComfyUI] 找不到正面提示词节点 {self.positive_node}")
             return None
 
-        if not self._set_prompt(pos_node, prompt):
+        if not patch.set_prompt(self.positive_node, prompt):
             logger.error(f"[ComfyUI] 节点 {self.positive_node} 没有输入字段")
             return None
 
-        neg_node = workflow.get(self.negative_node)
-        if neg_node:
-            self._set_prompt(neg_node, negative)
+        if patch.has_node(self.negative_node):
+            patch.set_prompt(self.negative_node, negative)
 
         if width is not None and height is not None:
             try:
@@ -92,33 +74,23 @@ class TextToImage:
 
         if width is not None and height is not None:
             if self.resolution_node:
-                if self.resolution_node in workflow:
-                    workflow[self.resolution_node]["inputs"][self.width_field] = width
-                    workflow[self.resolution_node]["inputs"][self.height_field] = height
+                if patch.has_node(self.resolution_node):
+                    patch.set(self.resolution_node, self.width_field, width)
+                    patch.set(self.resolution_node, self.height_field, height)
             else:
-                for node_id, node_data in workflow.items():
-                    if isinstance(node_data, dict) and node_data.get("class_type") == "EmptyLatentImage":
-                        node_data["inputs"]["width"] = width
-                        node_data["inputs"]["height"] = height
-                        break
+                latent_node = self.template.find_node("EmptyLatentImage")
+                if latent_node:
+                    patch.set(latent_node, "width", width)
+                    patch.set(latent_node, "height", height)
 
         if scale is not None and self.upscale_node:
-            if self.upscale_node in workflow:
-                workflow[self.upscale_node]["inputs"][self.scale_field] = scale
-
-        base_seed = random.randint(1, 999999999999999)
-        offset = 0
-        for node_data in workflow.values():
-            if isinstance(node_data, dict):
-                inputs = node_data.get("inputs", {})
-                if "seed" in inputs:
-                    inputs["seed"] = base_seed + offset
-                    offset += 1
-                if "noise_seed" in inputs:
-                    inputs["noise_seed"] = base_seed + offset
-                    offset += 1
-
-        result = await self.api.queue_and_wait_image(workflow, max_wait=max_wait, on_wait_callback=on_wait_callback, on_submitted_callback=on_submitted_callback)
+            if patch.has_node(self.upscale_node):
+                patch.set(self.upscale_node, self.scale_field, scale)
+
+        patch.randomize_seeds()
+        workflow = patch.encode()
+
+        result = await self.api.queue_and_wait_image(workflow, max_wait=max_wait, on_wait_callback=on_wait_callback, on_submitted_callback=on_submitted_callback, owner=owner)
 
         if not result:
             logger.error("[ComfyUI] 生成失败或等待结果超时")
@@ -0,0 +1,195 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+_WHITESPACE = re.compile(r"\s+")
+# 分隔符两侧的空白、重复的分隔符与首尾的分隔符不影响审查结果
+_SEPARATORS = re.compile(r"\s*([,，、;；])\s*")
+_REPEATED_SEPARATORS = re.compile(r"([,，、;；])(?:[,，、;；])+")
+
+
+def normalize_text(text: str) -> str:
+    """规范化提示词：全角/兼容字符统一、忽略大小写、合并空白与重复分隔符"""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    text = _WHITESPACE.sub(" ", text)
+    text = _SEPARATORS.sub(r"\1", text)
+    text = _REPEATED_SEPARATORS.sub(r"\1", text)
+    return text.strip(" ,、;")
+
+
+def verdict_key(*parts: str) -> str:
+    """由各组成部分（审查提示词、模型、规范化后的内容等）生成缓存键
+
+    只保存哈希，缓存文件中不出现用户的提示词原文。
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class VerdictCache:
+    """审查结果缓存：key -> 是否安全，按 LRU 淘汰，超过 ttl 秒失效
+
+    只缓存 LLM 给出的明确判定（通过/违规），出错或无响应的结果不缓存。
+    指定 path 时持久化到 JSON 文件，插件重启后继续有效：写入只标记为待保存，
+    SAVE_DELAY 秒内的多次写入合并为一次，在线程中整体写出；插件停用时调用 flush 立即保存。
+    max_entries 或 ttl 为 0 时不启用。
+    """
+
+    # 写入后延迟保存的秒数
+    SAVE_DELAY = 5.0
+
+    def __init__(self, path: Optional[Path], max_entries: int, ttl: float):
+        self.path = Path(path) if path else None
+        self.max_entries = max(0, int(max_entries))
+        self.ttl = max(0.0, float(ttl))
+        # key -> (是否安全, 过期时间)
+        self._entries: OrderedDict = OrderedDict()
+        self._dirty = False
+        # 延迟保存任务：等待 SAVE_DELAY 秒后写出
+        self._save_task: Optional[asyncio.Task] = None
+        self._save_lock = asyncio.Lock()
+        self._load()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.ttl > 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[bool]:
+        """返回缓存的判定（True 为安全），未命中或已过期返回 None"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        safe, expires = entry
+        if time.time() > expires:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return safe
+
+    def put(self, key: str, safe: bool):
+        if not self.enabled:
+            return
+        self._entries[key] = (bool(safe), time.time() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        self._mark_dirty()
+
+    def clear(self) -> int:
+        """清空缓存，返回清除的条目数"""
+        count = len(self._entries)
+        self._entries.clear()
+        self._mark_dirty()
+        return count
+
+    def _load(self):
+        if not self.enabled or self.path is None or not self.path.exists():
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            now = time.time()
+            # 文件中按最近使用顺序保存
+            for key, (safe, expires) in data.items():
+                if expires > now:
+                    self._entries[key] = (bool(safe), float(expires))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        except Exception as e:
+            from astrbot.api import logger
+            logger.error(f"Error loading {self.path.name}: {e}")
+
+    def _mark_dirty(self):
+        """标记为待保存，SAVE_DELAY 秒后统一写出"""
+        if self.path is None:
+            return
+        self._dirty = True
+        if self._save_task is None or self._save_task.done():
+            self._save_task = asyncio.ensure_future(self._save_later())
+
+    async def _save_later(self):
+        await asyncio.sleep(self.SAVE_DELAY)
+        # 写入开始后即使本任务被 flush 取消也继续完成，flush 通过锁等待它写完
+        await asyncio.shield(self._write())
+
+    async def flush(self):
+        """立即保存尚未写出的修改（插件停用时调用）"""
+        task, self._save_task = self._save_task, None
+        if task is not None and not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        await self._write()
+
+    async def _write(self):
+        """写出当前内容；出错时记录日志并保留待保存标记，不向调用方抛出"""
+        async with self._save_lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            # 快照在事件循环中生成，序列化与写文件在线程中进行
+            snapshot = {key: list(entry) for key, entry in self._entries.items()}
+            try:
+                await asyncio.to_thread(self._save, snapshot)
+            except Exception as e:
+                self._dirty = True
+                from astrbot.api import logger
+                logger.error(f"Error saving {self.path.name}: {e}")
+
+    def _save(self, snapshot: dict):
+        """先写临时文件再替换，写入中断不会截断已有的缓存文件"""
+        try:
+            tmp = self.path.with_suffix(self.path.suffix + ".tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f)
+            os.replace(tmp, self.path)
+        except Exception as e:
+            from astrbot.api import logger
+            logger.error(f"Error saving {self.path.name}: {e}")
+
+
+class ImageVerdictCache(VerdictCache):
+    """图片审查结果缓存：按感知哈希（dHash）查找相近图片的判定
+
+    scope 区分不同的审查场景（输入/输出、审查提示词、模型），不同 scope 的判定互不复用；
+    同一 scope 内与已缓存图片的哈希汉明距离不超过 max_distance 时视为同一张图片。
+    """
+
+    def __init__(self, path: Optional[Path], max_entries: int, ttl: float, max_distance: int):
+        super().__init__(path, max_entries, ttl)
+        self.max_distance = max(0, int(max_distance))
+
+    @staticmethod
+    def _key(scope: str, image_hash: int) -> str:
+        return f"{scope}:{image_hash:016x}"
+
+    def find(self, scope: str, image_hash: int) -> Optional[bool]:
+        """返回最相近图片的判定，没有足够相近的图片返回 None"""
+        exact = self.get(self._key(scope, image_hash))
+        if exact is not None or self.max_distance == 0:
+            return exact
+        prefix = scope + ":"
+        now = time.time()
+        best_key, best_distance = None, self.max_distance + 1
+        for key, (_, expires) in self._entries.items():
+            if expires < now or not key.startswith(prefix):
+                continue
+            distance = bin(int(key[len(prefix):], 16) ^ image_hash).count("1")
+            if distance < best_distance:
+                best_key, best_distance = key, distance
+        return self.get(best_key) if best_key is not None else None
+
+    def add(self, scope: str, image_hash: int, safe: bool):
+        self.put(self._key(scope, image_hash), safe)
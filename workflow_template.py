@@ -0,0 +1,196 @@
+import json
+import random
+from typing import Iterable, Optional
+
+from . import json_codec
+
+
+class WorkflowTemplate:
+    """加载时预编译的工作流模板
+
+    工作流只解析一次，并预先索引每次请求都要修改的位置（LoadImage 节点、seed/noise_seed
+    字段、各节点的提示词字段、按类型查找的节点）。每个请求通过 new_request() 得到一个
+    WorkflowPatch，只记录改动，模板本身不被修改。
+
+    提交时使用 encode()：每个节点在加载时预先编码为 JSON bytes；被改动的节点按
+    (改动字段, 删除字段) 编译一次带占位符的分段，之后每个请求只需把转义后的字段值拼接进去，
+    不必重新序列化整个工作流。
+    """
+
+    # 占位符：包含控制字符，正常的工作流内容不会出现；万一出现则回退为整节点编码
+    _SLOT = "\u0000comfyui_hub_slot_{}\u0000"
+
+    def __init__(self, workflow: dict):
+        self.workflow = workflow
+        # 所有 LoadImage 节点，按工作流中的顺序
+        self.load_image_nodes = [nid for nid, node in workflow.items()
+                                 if isinstance(node, dict) and node.get("class_type") == "LoadImage"]
+        # (节点ID, 字段名) 列表，顺序与逐节点遍历 seed、noise_seed 一致
+        self.seed_fields = []
+        # 节点ID -> 第一个输入字段名（提示词写入位置）
+        self._prompt_fields = {}
+        # class_type -> 第一个该类型节点的ID
+        self._first_by_class = {}
+        for nid, node in workflow.items():
+            if not isinstance(node, dict):
+                continue
+            class_type = node.get("class_type")
+            if class_type and class_type not in self._first_by_class:
+                self._first_by_class[class_type] = nid
+            inputs = node.get("inputs")
+            if not isinstance(inputs, dict):
+                continue
+            if inputs:
+                self._prompt_fields[nid] = next(iter(inputs))
+            for field in ("seed", "noise_seed"):
+                if field in inputs:
+                    self.seed_fields.append((nid, field))
+
+        # 预编码：节点ID -> b'"id":'，节点ID -> 节点 JSON
+        self._key_bytes = {nid: json_codec.dumps(str(nid)) + b":" for nid in workflow}
+        self._node_bytes = {nid: json_codec.dumps(node) for nid, node in workflow.items()}
+        # (节点ID, 改动字段, 删除字段) -> (分段列表, 字段顺序)，无法编译时为 None
+        self._node_codecs: dict = {}
+
+    @classmethod
+    def load(cls, path: str) -> "WorkflowTemplate":
+        """加载工作流文件并编译"""
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls(json.load(f))
+
+    def has_node(self, node_id: str) -> bool:
+        return bool(node_id) and isinstance(self.workflow.get(node_id), dict)
+
+    def class_type(self, node_id: str) -> Optional[str]:
+        node = self.workflow.get(node_id)
+        return node.get("class_type") if isinstance(node, dict) else None
+
+    def find_node(self, class_type: str) -> Optional[str]:
+        """第一个指定类型节点的ID，找不到返回 None"""
+        return self._first_by_class.get(class_type)
+
+    def prompt_field(self, node_id: str) -> Optional[str]:
+        """节点的第一个输入字段名（提示词写入位置），节点不存在或没有输入时返回 None"""
+        return self._prompt_fields.get(node_id)
+
+    def get_input(self, node_id: str, field: str):
+        """读取模板中节点某个输入字段的值，找不到返回 None"""
+        node = self.workflow.get(node_id) if node_id else None
+        if not isinstance(node, dict):
+            return None
+        inputs = node.get("inputs")
+        return inputs.get(field) if isinstance(inputs, dict) else None
+
+    def new_request(self) -> "WorkflowPatch":
+        return WorkflowPatch(self)
+
+    def _patched_node(self, node_id: str, values: dict, dropped) -> dict:
+        node = dict(self.workflow[node_id])
+        inputs = dict(node.get("inputs") or {})
+        inputs.update(values)
+        for field in dropped:
+            inputs.pop(field, None)
+        node["inputs"] = inputs
+        return node
+
+    def _compile_node(self, node_id: str, fields: frozenset, dropped: frozenset):
+        """把节点编码为以占位符分隔的分段：[seg0, seg1, ..., segN] 与对应的字段顺序"""
+        slots = {field: self._SLOT.format(i) for i, field in enumerate(sorted(fields))}
+        encoded = json_codec.dumps(self._patched_node(node_id, slots, dropped))
+        positions = []
+        for field, slot in slots.items():
+            marker = json_codec.dumps(slot)
+            if encoded.count(marker) != 1:
+                return None
+            positions.append((encoded.index(marker), len(marker), field))
+        positions.sort()
+        segments, order, start = [], [], 0
+        for pos, length, field in positions:
+            segments.append(encoded[start:pos])
+            order.append(field)
+            start = pos + length
+        segments.append(encoded[start:])
+        return segments, order
+
+    def encode_node(self, node_id: str, values: dict, dropped=frozenset()) -> bytes:
+        """编码一个被改动的节点：把字段值拼接进预编译的分段"""
+        key = (node_id, frozenset(values), frozenset(dropped))
+        if key not in self._node_codecs:
+            self._node_codecs[key] = self._compile_node(node_id, key[1], key[2])
+        codec = self._node_codecs[key]
+        if codec is None:
+            return json_codec.dumps(self._patched_node(node_id, values, dropped))
+        segments, order = codec
+        parts = [segments[0]]
+        for field, segment in zip(order, segments[1:]):
+            parts.append(json_codec.dumps(values[field]))
+            parts.append(segment)
+        return b"".join(parts)
+
+
+class WorkflowPatch:
+    """单个请求对模板的改动，encode() 生成提交用的工作流 JSON bytes"""
+
+    def __init__(self, template: WorkflowTemplate):
+        self.template = template
+        # 节点ID -> {字段: 新值}
+        self._inputs: dict = {}
+        # 节点ID -> 需要删除的输入字段集合
+        self._dropped: dict = {}
+        self._removed: set = set()
+
+    def has_node(self, node_id: str) -> bool:
+        return self.template.has_node(node_id) and node_id not in self._removed
+
+    def get(self, node_id: str, field: str):
+        """读取字段的当前值（已修改的优先），找不到返回 None"""
+        changed = self._inputs.get(node_id)
+        if changed is not None and field in changed:
+            return changed[field]
+        return self.template.get_input(node_id, field)
+
+    def set(self, node_id: str, field: str, value) -> bool:
+        """修改节点的输入字段，节点不存在或没有 inputs 时返回 False"""
+        if not self.has_node(node_id) or not isinstance(self.template.workflow[node_id].get("inputs"), dict):
+            return False
+        self._inputs.setdefault(node_id, {})[field] = value
+        return True
+
+    def set_prompt(self, node_id: str, prompt: str) -> bool:
+        """设置提示词到节点的第一个输入字段"""
+        field = self.template.prompt_field(node_id)
+        if field is None or not self.has_node(node_id):
+            return False
+        return self.set(node_id, field, prompt)
+
+    def randomize_seeds(self, base_seed: Optional[int] = None):
+        """为所有 seed/noise_seed 字段写入连续的随机种子"""
+        if base_seed is None:
+            base_seed = random.randint(1, 999999999999999)
+        offset = 0
+        for node_id, field in self.template.seed_fields:
+            if node_id in self._removed:
+                continue
+            self.set(node_id, field, base_seed + offset)
+            offset += 1
+
+    def drop_input(self, node_id: str, field: str):
+        """删除节点的某个输入字段（例如指向已移除节点的链接）"""
+        self._dropped.setdefault(node_id, set()).add(field)
+
+    def remove_nodes(self, node_ids: Iterable[str]):
+        self._removed.update(node_ids)
+
+    def encode(self) -> bytes:
+        """生成提交用工作流的 JSON bytes：未改动节点直接使用预编码结果，改动节点拼接字段值"""
+        template = self.template
+        parts = []
+        for node_id, node_bytes in template._node_bytes.items():
+            if node_id in self._removed:
+                continue
+            values = self._inputs.get(node_id)
+            dropped = self._dropped.get(node_id)
+            if values or dropped:
+                node_bytes = template.encode_node(node_id, values or {}, dropped or frozenset())
+            parts.append(template._key_bytes[node_id] + node_bytes)
+        return b"{" + b",".join(parts) + b"}"